@@ -0,0 +1,91 @@
+"""
+Measure the cost of signing and verifying access tokens with each jwt algorithm.
+
+Reports, as JSON, the microseconds per operation of:
+
+* ``sign_us``: issuing a token with ``KeyRing.encode``.
+* ``verify_us``: verifying a token with ``KeyRing.decode``, with the keys parsed once.
+* ``verify_pem_us``: verifying a token with the PEM (or secret) passed to ``jwt.decode``, which
+  parses the key on every call.
+
+Needs the ``cryptography`` package (``pip install fsubs[crypto]``). Run from the ``backend``
+directory::
+
+    python benchmarks/jwt_verify.py --iterations 2000
+"""
+import argparse
+import json
+import pathlib
+import sys
+import time
+from datetime import datetime, timedelta
+
+import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+from fsubs.utils.auth import KeyRing  # noqa: E402
+
+ALGORITHMS = ('HS256', 'RS256', 'PS256', 'ES256', 'ES384')
+CURVES = {'ES256': ec.SECP256R1(), 'ES384': ec.SECP384R1()}
+
+
+def generate_keys(algorithm: str, rsa_bits: int):
+    """Generate a signing key and its verification key, as PEM (or the secret for HMAC)."""
+    if algorithm.startswith('HS'):
+        return b'a' * 32, b'a' * 32
+    if algorithm.startswith('ES'):
+        private_key = ec.generate_private_key(CURVES[algorithm])
+    else:
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=rsa_bits)
+    private_pem = private_key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption())
+    public_pem = private_key.public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+    return private_pem, public_pem
+
+
+def per_op_us(func, iterations: int) -> float:
+    """Time a function, in microseconds per call."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def measure(algorithm: str, iterations: int, rsa_bits: int):
+    """Measure signing and verifying with an algorithm."""
+    private_pem, public_pem = generate_keys(algorithm, rsa_bits)
+    keys = KeyRing()
+    keys.configure(algorithm, signing_key=private_pem, kid='bench')
+    claims = {'identity': 'bench', 'exp': datetime.utcnow() + timedelta(hours=1)}
+    token = keys.encode(claims)
+    return {
+        'sign_us': round(per_op_us(lambda: keys.encode(claims), iterations), 2),
+        'verify_us': round(per_op_us(lambda: keys.decode(token), iterations), 2),
+        'verify_pem_us': round(per_op_us(
+            lambda: jwt.decode(token, public_pem, algorithms=[algorithm]), iterations), 2),
+    }
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=1000,
+                        help='The number of operations timed per measure.')
+    parser.add_argument('--rsa-bits', type=int, default=2048, help='The size of the RSA keys.')
+    parser.add_argument('--algorithms', default=','.join(ALGORITHMS),
+                        help='The comma separated algorithms to measure.')
+    args = parser.parse_args()
+    results = {
+        algorithm: measure(algorithm, args.iterations, args.rsa_bits)
+        for algorithm in args.algorithms.split(',')
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,391 @@
+"""
+Measure the throughput and latency of fsubs under a realistic mix of requests.
+
+Starts fsubs with a generated catalog (see ``benchmarks/serve.py``), then keeps ``--concurrency``
+keep-alive connections busy for ``--duration`` seconds, each running scenarios picked from the
+mix:
+
+* ``browse``: a page of movies.
+* ``title``: a movie, then its versions.
+* ``search``: a page of movies filtered on their versions and sorted by title.
+* ``episodes``: the episodes of a tv show.
+* ``login``: a burst of logins of one user.
+* ``edit``: an update of a movie version, by a power user.
+
+Reports, as JSON, the throughput and the p50, p95 and p99 latencies of each endpoint, which can be
+compared between commits with ``--baseline``. With ``--mirror`` the catalog is served by a
+read-only mirror, which only takes the read scenarios. Run from the ``backend`` directory::
+
+    python benchmarks/load.py --in-memory --concurrency 32 --duration 30 > after.json
+    python benchmarks/load.py --in-memory --baseline before.json
+    python benchmarks/load.py --in-memory --mirror --mix browse=35,title=30,search=15,episodes=12
+    python benchmarks/load.py --in-memory --mirror --workers 4 --mix browse=50,title=50
+"""
+import argparse
+import asyncio
+import json
+import os
+import pathlib
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+
+from serve import add_catalog_arguments
+
+BACKEND_DIR = pathlib.Path(__file__).parent.parent.absolute()
+DEFAULT_MIX = 'browse=35,title=30,search=15,episodes=12,login=3,edit=5'
+LOGIN_BURST = 5
+PASSWORD = 'password123'
+
+
+class Connection():
+    """A minimal HTTP/1.1 keep-alive connection, so the client costs as little as possible."""
+
+    def __init__(self, host: str, port: int):
+        """
+        Initialize a ``Connection``, opened on first use.
+
+        :param host: The host to connect to.
+        :param port: The port to connect to.
+        """
+        self.host = host
+        self.port = port
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def request(self, method: str, path: str, body: bytes = b'',
+                      headers: Dict[str, str] = None) -> Tuple[int, bytes]:
+        """
+        Make a request.
+
+        :param method: The HTTP method.
+        :param path: The path, with its query string.
+        :param body: The body of the request.
+        :param headers: Extra headers.
+        :returns: The status and body of the response.
+        """
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        lines = [f'{method} {path} HTTP/1.1', f'Host: {self.host}:{self.port}',
+                 f'Content-Length: {len(body)}']
+        lines.extend(f'{name}: {value}' for name, value in (headers or {}).items())
+        self._writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        status_line = await self._reader.readline()
+        if not status_line:
+            await self.close()
+            raise ConnectionError('The server closed the connection.')
+        status = int(status_line.split()[1])
+        length, close = 0, False
+        while True:
+            line = await self._reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            name = name.strip().lower()
+            if name == 'content-length':
+                length = int(value)
+            elif name == 'connection' and value.strip().lower() == 'close':
+                close = True
+        response_body = await self._reader.readexactly(length) if length else b''
+        if close:
+            await self.close()
+        return status, response_body
+
+    async def close(self):
+        """Close the connection, it is opened again by the next request."""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = self._reader = None
+
+
+class Client():
+    """A benchmark client, recording the latency of each request by endpoint."""
+
+    def __init__(self, connection: Connection, ids: dict, rng: random.Random,
+                 results: Dict[str, List[Tuple[float, int]]]):
+        """
+        Initialize a ``Client``.
+
+        :param connection: The connection to send requests on.
+        :param ids: The ids of the catalog.
+        :param rng: The random generator picking scenarios and titles.
+        :param results: Where to record the latency and status of each request, by endpoint.
+        """
+        self.connection = connection
+        self.ids = ids
+        self.rng = rng
+        self.results = results
+        self.recording = False
+        self.token: Optional[str] = None
+
+    async def call(self, endpoint: str, method: str, path: str, body: bytes = b'',
+                   headers: Dict[str, str] = None) -> Tuple[int, bytes]:
+        """Make a request and record how long it took."""
+        start = time.perf_counter()
+        status, response = await self.connection.request(method, path, body, headers)
+        if self.recording:
+            self.results[endpoint].append((time.perf_counter() - start, status))
+        return status, response
+
+    async def login(self, username: str) -> Optional[str]:
+        """Log a user in, returning its token."""
+        body = urlencode({'username': username, 'password': PASSWORD}).encode()
+        status, response = await self.call(
+            'POST /authenticate', 'POST', '/authenticate', body,
+            {'Content-Type': 'application/x-www-form-urlencoded'})
+        return json.loads(response)['access_token'] if status == 201 else None
+
+    async def browse(self):
+        """Get a page of movies."""
+        start = self.rng.randrange(max(1, len(self.ids['movie_ids']) - 20))
+        await self.call('GET /movies', 'GET', f'/movies?start={start}&page_length=20')
+
+    async def title(self):
+        """Open a movie and its versions."""
+        movie_id = self.rng.choice(self.ids['movie_ids'])
+        await self.call('GET /movies/{uri}', 'GET', f'/movies/{movie_id}')
+        await self.call('GET /movies/{uri}/versions', 'GET', f'/movies/{movie_id}/versions')
+
+    async def search(self):
+        """Get a page of movies filtered on their versions."""
+        disc_type = self.rng.choice(('DVD', 'BD', 'UHD', 'WEB-DL'))
+        await self.call(
+            'GET /movies?disc_type', 'GET',
+            f'/movies?disc_type={disc_type}&sort=title&page_length=20')
+
+    async def episodes(self):
+        """Get the episodes of a tv show."""
+        tv_show_id = self.rng.choice(self.ids['tv_show_ids'])
+        await self.call(
+            'GET /tv_shows/{uri}/episodes', 'GET', f'/tv_shows/{tv_show_id}/episodes')
+
+    async def login_burst(self):
+        """Log a user in a few times in a row."""
+        username = self.rng.choice(self.ids['usernames'])
+        for _ in range(LOGIN_BURST):
+            await self.login(username)
+
+    async def edit(self):
+        """Update a movie version as a power user."""
+        if self.token is None:
+            # Logging in isn't part of the edit, don't record it.
+            recording, self.recording = self.recording, False
+            usernames = self.ids['usernames']
+            self.token = await self.login(usernames[min(1, len(usernames) - 1)])
+            self.recording = recording
+        version_id = self.rng.choice(self.ids['movie_version_ids'])
+        body = json.dumps({
+            'disc_type': 'BD',
+            'region': 'A',
+            'timestamps': ['00:01:00.000 - 00:01:02.500'] * self.rng.randint(1, 20),
+            'sub_type': 'Forced',
+            'description': 'Edited by the load benchmark.',
+        }).encode()
+        await self.call(
+            'PUT /movies/versions/{uri}', 'PUT', f'/movies/versions/{version_id}', body,
+            {'Content-Type': 'application/json', 'Authorization': f'Bearer {self.token}'})
+
+
+SCENARIOS = {
+    'browse': Client.browse,
+    'title': Client.title,
+    'search': Client.search,
+    'episodes': Client.episodes,
+    'login': Client.login_burst,
+    'edit': Client.edit,
+}
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    """Parse a mix of scenarios, e.g. ``browse=50,title=50``."""
+    weights = {}
+    for entry in mix.split(','):
+        name, _, weight = entry.partition('=')
+        if name.strip() not in SCENARIOS:
+            raise ValueError(f'Unknown scenario {name}, expected one of {list(SCENARIOS)}.')
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+async def run_client(client: Client, mix: Dict[str, float], stop: float):
+    """Run scenarios until the deadline."""
+    names, weights = list(mix), list(mix.values())
+    while time.monotonic() < stop:
+        scenario = client.rng.choices(names, weights)[0]
+        try:
+            await SCENARIOS[scenario](client)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            client.results['errors'].append((0, 0))
+            print(f'{scenario} failed: {e}', file=sys.stderr)
+            await client.connection.close()
+    await client.connection.close()
+
+
+async def run_load(port: int, ids: dict, args) -> Dict[str, List[Tuple[float, int]]]:
+    """Warm up, then run the load for the duration and collect the results."""
+    results: Dict[str, List[Tuple[float, int]]] = defaultdict(list)
+    mix = parse_mix(args.mix)
+    clients = [
+        Client(Connection('127.0.0.1', port), ids, random.Random(f'{args.seed}:{index}'), results)
+        for index in range(args.concurrency)]
+    start = time.monotonic()
+    tasks = [
+        asyncio.ensure_future(run_client(client, mix, start + args.warm_up + args.duration))
+        for client in clients]
+    await asyncio.sleep(args.warm_up)
+    for client in clients:
+        client.recording = True
+    await asyncio.gather(*tasks)
+    for client in clients:
+        client.recording = False
+    return results
+
+
+def percentile(latencies: List[float], fraction: float) -> float:
+    """Get a percentile of sorted latencies, in milliseconds."""
+    index = min(len(latencies) - 1, max(0, int(round(fraction * len(latencies))) - 1))
+    return round(latencies[index] * 1000, 3)
+
+
+def summarize(results: Dict[str, List[Tuple[float, int]]], duration: float) -> Dict[str, dict]:
+    """Summarize the latencies and statuses of each endpoint."""
+    summary = {}
+    for endpoint, calls in sorted(results.items()):
+        if endpoint == 'errors':
+            continue
+        latencies = sorted(latency for latency, _ in calls)
+        summary[endpoint] = {
+            'requests': len(calls),
+            'errors': sum(status >= 400 for _, status in calls),
+            'throughput': round(len(calls) / duration, 1),
+            'p50_ms': percentile(latencies, 0.50),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99),
+        }
+    return summary
+
+
+def compare(summary: Dict[str, dict], baseline: Dict[str, dict]) -> Dict[str, dict]:
+    """Get the ratio of each measure to the one of the baseline."""
+    changes = {}
+    for endpoint, measures in summary.items():
+        before = baseline.get(endpoint)
+        if before:
+            changes[endpoint] = {
+                name: round(value / before[name], 3)
+                for name, value in measures.items()
+                if name in ('throughput', 'p50_ms', 'p95_ms', 'p99_ms') and before.get(name)}
+    return changes
+
+
+def wait_until_ready(port: int, process: subprocess.Popen, timeout: float):
+    """Wait for the server to answer ``/ready``."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('The server exited before being ready.')
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/ready', timeout=1) as response:
+                if response.status == 200:
+                    return
+        except (urllib.error.URLError, ConnectionError):
+            pass
+        time.sleep(0.1)
+    raise RuntimeError('The server was not ready in time.')
+
+
+def git_commit() -> Optional[str]:
+    """Get the commit being measured, if in a git checkout."""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR, check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--in-memory', action='store_true',
+                        help='Serve from an in memory database instead of the configured Mongo.')
+    parser.add_argument('--reset-db', action='store_true',
+                        help='Confirm dropping the catalog collections of the configured Mongo.')
+    parser.add_argument('--mirror', action='store_true',
+                        help='Serve from a read-only snapshot of the catalog.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='The number of worker processes serving the mirror.')
+    parser.add_argument('--port', type=int, default=5056, help='The port to start fsubs on.')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='The number of concurrent connections.')
+    parser.add_argument('--duration', type=float, default=20,
+                        help='How long to measure for, in seconds.')
+    parser.add_argument('--warm-up', type=float, default=3,
+                        help='How long to run the load before measuring, in seconds.')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='The weight of each scenario, e.g. browse=50,title=50.')
+    parser.add_argument('--timeout', type=float, default=120,
+                        help='How long to wait for the server to be ready, in seconds.')
+    parser.add_argument('--baseline', help='A previous report to compare with.')
+    add_catalog_arguments(parser)
+    args = parser.parse_args()
+    if args.mirror and {'login', 'edit'} & set(parse_mix(args.mix)):
+        parser.error('A mirror is read-only, leave login and edit out of --mix.')
+    if args.workers > 1 and not args.mirror:
+        parser.error('Only a mirror can be served by several --workers.')
+
+    with tempfile.TemporaryDirectory() as directory:
+        ids_file = pathlib.Path(directory) / 'ids.json'
+        command = [
+            sys.executable, str(BACKEND_DIR / 'benchmarks' / 'serve.py'),
+            '--port', str(args.port), '--ids-file', str(ids_file),
+            '--movies', str(args.movies), '--versions-per-title', str(args.versions_per_title),
+            '--tv-shows', str(args.tv_shows), '--episodes-per-season',
+            str(args.episodes_per_season), '--users', str(args.users), '--seed', str(args.seed)]
+        command += ['--in-memory'] if args.in_memory else []
+        command += ['--reset-db'] if args.reset_db else []
+        command += ['--mirror', '--workers', str(args.workers)] if args.mirror else []
+        # In its own process group, so the workers are stopped along with it.
+        process = subprocess.Popen(command, cwd=BACKEND_DIR, start_new_session=True)
+        try:
+            wait_until_ready(args.port, process, args.timeout)
+            ids = json.loads(ids_file.read_text())
+            results = asyncio.get_event_loop().run_until_complete(
+                run_load(args.port, ids, args))
+        finally:
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait()
+
+    summary = summarize(results, args.duration)
+    report = {
+        'commit': git_commit(),
+        'database': 'in-memory' if args.in_memory else 'mongo',
+        'mirror': args.mirror,
+        'workers': args.workers,
+        'concurrency': args.concurrency,
+        'duration': args.duration,
+        'mix': args.mix,
+        'catalog': {name: getattr(args, name) for name in (
+            'movies', 'versions_per_title', 'tv_shows', 'episodes_per_season', 'users', 'seed')},
+        'throughput': round(sum(len(calls) for endpoint, calls in results.items()
+                                if endpoint != 'errors') / args.duration, 1),
+        'client_errors': len(results.get('errors', [])),
+        'endpoints': summary,
+    }
+    if args.baseline:
+        report['change'] = compare(
+            summary, json.loads(pathlib.Path(args.baseline).read_text())['endpoints'])
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
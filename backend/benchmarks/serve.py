@@ -0,0 +1,102 @@
+"""
+Serve fsubs with a generated catalog, for ``benchmarks/load.py``.
+
+With ``--in-memory`` the catalog is kept by the memory storage engine of this process, so no Mongo
+is needed. Otherwise the catalog is written to the Mongo of the
+config, after dropping the catalog collections, which ``--reset-db`` must confirm.
+
+Once the catalog is inserted its ids are written as JSON to ``--ids-file`` and the server starts.
+With ``--mirror`` a snapshot of the catalog is built next to the ids file, and served read-only,
+by ``--workers`` processes.
+Rate limits are disabled so the load isn't rejected, admission control stays on.
+"""
+import argparse
+import json
+import os
+import pathlib
+import sys
+
+BACKEND_DIR = pathlib.Path(__file__).parent.parent.absolute()
+COLLECTIONS = ('movies', 'movie_versions', 'tv_shows', 'tv_show_episodes', 'users', 'revocations')
+
+
+def add_catalog_arguments(parser: argparse.ArgumentParser):
+    """Add the arguments describing the catalog to generate."""
+    parser.add_argument('--movies', type=int, default=2000, help='The number of movies.')
+    parser.add_argument('--versions-per-title', default='exp:2',
+                        help='The distribution of versions per movie, e.g. exp:2 or fixed:2.')
+    parser.add_argument('--tv-shows', type=int, default=100, help='The number of tv shows.')
+    parser.add_argument('--episodes-per-season', default='exp:10',
+                        help='The distribution of episodes per season, e.g. uniform:8-24.')
+    parser.add_argument('--users', type=int, default=100, help='The number of users.')
+    parser.add_argument('--seed', type=int, default=0, help='The seed of the catalog.')
+
+
+def main():
+    """Seed the catalog and serve fsubs."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--port', type=int, default=5056, help='The port to serve on.')
+    parser.add_argument('--ids-file', required=True, help='Where to write the catalog ids.')
+    parser.add_argument('--in-memory', action='store_true', help='Use an in memory database.')
+    parser.add_argument('--reset-db', action='store_true',
+                        help='Confirm dropping the catalog collections of the configured Mongo.')
+    parser.add_argument('--mirror', action='store_true',
+                        help='Serve a read-only snapshot of the catalog.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='The number of worker processes, with --mirror.')
+    add_catalog_arguments(parser)
+    args = parser.parse_args()
+    if not args.in_memory and not args.reset_db:
+        parser.error('Seeding a real Mongo drops its catalog, pass --reset-db to confirm.')
+    if args.workers > 1 and not args.mirror:
+        parser.error('The catalog is seeded in this process, only a mirror can have --workers.')
+
+    if args.in_memory:
+        os.environ['FSUBS_DB_ENGINE'] = 'memory'
+    for section in ('auth', 'list', 'read', 'write'):
+        os.environ[f'FSUBS_RATELIMIT_{section.upper()}_RATE'] = '0'
+    os.environ.setdefault('FSUBS_APP_LOG_LEVEL', 'warning')
+
+    sys.path.insert(0, str(BACKEND_DIR))
+    from fsubs.config.config import Config, get_env_vars
+    from fsubs.crud.db import get_engine
+    from fsubs.crud.mirror import build_mirror
+    from fsubs.utils import logs, server
+    from fsubs.utils.catalog import CatalogSpec, insert_catalog, parse_distribution
+
+    config = Config()
+    config.read_dict(vars=get_env_vars())
+    logs.setup_logging_from_config(config)
+    engine = get_engine()
+    for collection in COLLECTIONS:
+        engine.drop(collection)
+    spec = CatalogSpec(
+        movies=args.movies,
+        versions_per_title=parse_distribution(args.versions_per_title),
+        tv_shows=args.tv_shows,
+        episodes_per_season=parse_distribution(args.episodes_per_season),
+        users=args.users,
+        seed=args.seed,
+    )
+    ids = insert_catalog(engine, spec)
+    if args.mirror:
+        snapshot_file = pathlib.Path(args.ids_file).with_name('catalog.fsubs')
+        build_mirror(engine, snapshot_file)
+        config["app"]["read_only_snapshot"] = str(snapshot_file)
+    pathlib.Path(args.ids_file).write_text(json.dumps(ids._asdict()))
+    if args.workers > 1:
+        config.export()
+    server.run(
+        app='fsubs.routers.main:app',
+        host='127.0.0.1',
+        port=args.port,
+        workers=args.workers,
+        loop=config["app"]["loop"],
+        http=config["app"]["http"],
+        log_level=config["app"]["log_level"],
+        log_config=None,
+    )
+
+
+if __name__ == '__main__':
+    main()
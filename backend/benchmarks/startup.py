@@ -0,0 +1,108 @@
+"""
+Measure how long fsubs takes to start.
+
+Reports, as JSON, the median over a few runs (each in a fresh interpreter) of:
+
+* ``import_seconds``: importing ``fsubs.routers.main``.
+* ``create_app_seconds``: building the app with ``create_app``.
+* ``health_seconds`` and ``ready_seconds``: starting ``python -m fsubs`` until ``/health`` and
+  ``/ready`` answer 200. Needs a reachable Mongo, set up as for running fsubs.
+
+Run from the ``backend`` directory::
+
+    python benchmarks/startup.py --runs 5 --port 5055
+"""
+import argparse
+import json
+import pathlib
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+BACKEND_DIR = pathlib.Path(__file__).parent.parent.absolute()
+
+IMPORT_SCRIPT = '''
+import time
+start = time.perf_counter()
+import fsubs.routers.main
+imported = time.perf_counter()
+fsubs.routers.main.create_app()
+print(imported - start, time.perf_counter() - imported)
+'''
+
+
+def time_import():
+    """Time importing the app and building it, in a fresh interpreter."""
+    output = subprocess.run(
+        [sys.executable, '-c', IMPORT_SCRIPT], cwd=BACKEND_DIR, check=True,
+        stdout=subprocess.PIPE, universal_newlines=True).stdout
+    import_seconds, create_app_seconds = output.split()[-2:]
+    return float(import_seconds), float(create_app_seconds)
+
+
+def wait_for(url: str, deadline: float) -> bool:
+    """Poll a url until it answers 200 or the deadline passes."""
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return True
+        except (urllib.error.URLError, ConnectionError):
+            pass
+        time.sleep(0.01)
+    return False
+
+
+def time_server(port: int, timeout: float):
+    """Time starting the server until it is healthy, then ready."""
+    start = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'fsubs', '--bind-port', str(port), '--log-level', 'warning'],
+        cwd=BACKEND_DIR)
+    try:
+        base = f'http://127.0.0.1:{port}'
+        health = ready = None
+        if wait_for(f'{base}/health', start + timeout):
+            health = time.monotonic() - start
+            if wait_for(f'{base}/ready', start + timeout):
+                ready = time.monotonic() - start
+        return health, ready
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def median(values):
+    """Get the median of the values that were measured, if any."""
+    values = [value for value in values if value is not None]
+    return statistics.median(values) if values else None
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--runs', type=int, default=5, help='The number of runs.')
+    parser.add_argument('--port', type=int, default=5055, help='The port to start fsubs on.')
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='How long to wait for the server to be ready, in seconds.')
+    parser.add_argument('--no-server', action='store_true',
+                        help="Only time the import, for when there's no Mongo to start against.")
+    args = parser.parse_args()
+
+    imports = [time_import() for _ in range(args.runs)]
+    servers = [] if args.no_server else [
+        time_server(args.port, args.timeout) for _ in range(args.runs)]
+    print(json.dumps({
+        'runs': args.runs,
+        'import_seconds': median(run[0] for run in imports),
+        'create_app_seconds': median(run[1] for run in imports),
+        'health_seconds': median(run[0] for run in servers),
+        'ready_seconds': median(run[1] for run in servers),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,29 @@
 """Run fsubs app."""
-import inspect
+import asyncio
 import logging
 import pathlib
+import time
 from collections import defaultdict
 from enum import Enum
 from pathlib import Path
 
 import typer
-import uvicorn
 
-from fsubs.config.config import Config
+from fsubs.config.config import Config, get_env_vars
+from fsubs.crud.db import create_client, create_engine
+from fsubs.crud.mirror import build_mirror
+from fsubs.crud.movie import MovieDAO
+from fsubs.crud.tvshow import TVShowDAO
+from fsubs.utils import catalog as catalog_utils
+from fsubs.utils import logs
+from fsubs.utils import server
+from fsubs.utils import users as user_utils
 
-ROOTLOGGER = logging.getLogger(inspect.getmodule(__name__))
 LOGGER = logging.getLogger(__name__)
-LOG_FORMAT = "%(asctime)s - %(name)s:%(funcName)s:%(lineno)s - " \
-             "%(levelname)s - %(message)s"
 
 cli = typer.Typer(add_completion=False)
+snapshot_cli = typer.Typer(help="Build read-only snapshots of the catalog.")
+cli.add_typer(snapshot_cli, name="snapshot")
 config = Config()
 
 
@@ -30,6 +37,50 @@ class LogLevel(str, Enum):
     critical = "critical"
 
 
+class LogFormat(str, Enum):
+    """Available log formats."""
+
+    text = "text"
+    json = "json"
+
+
+class Loop(str, Enum):
+    """Available event loop implementations."""
+
+    auto = "auto"
+    asyncio = "asyncio"
+    uvloop = "uvloop"
+
+
+class HTTPProtocol(str, Enum):
+    """Available HTTP protocol implementations."""
+
+    auto = "auto"
+    h11 = "h11"
+    httptools = "httptools"
+
+
+class KDFAlgorithm(str, Enum):
+    """Available password hashing algorithms."""
+
+    pbkdf2_sha256 = "pbkdf2-sha256"
+    scrypt = "scrypt"
+
+
+class CatalogOutput(str, Enum):
+    """Available outputs of a generated catalog."""
+
+    ndjson = "ndjson"
+    mongo = "mongo"
+
+
+class StorageEngine(str, Enum):
+    """Available storage engines."""
+
+    mongo = "mongo"
+    memory = "memory"
+
+
 class JWTAlgorithm(str, Enum):
     """
     Available jwt algorithms.
@@ -53,13 +104,7 @@ class JWTAlgorithm(str, Enum):
 
 def setup_logging():
     """Set up logging based on provided log params."""
-    formatter = logging.Formatter(LOG_FORMAT)
-    ROOTLOGGER.setLevel(config["app"]["log_level"].upper())
-
-    sh = logging.StreamHandler()
-    sh.setLevel(config["app"]["log_level"].upper())
-    sh.setFormatter(formatter)
-    ROOTLOGGER.addHandler(sh)
+    logs.setup_logging_from_config(config)
 
     LOGGER.info("-------------------------STARTING-------------------------")
     LOGGER.info("INFO Logging Level -- Enabled")
@@ -68,19 +113,56 @@ def setup_logging():
     LOGGER.debug("DEBUG Logging Level -- Enabled")
 
 
-@cli.command()
+def export_config(ctx: typer.Context):
+    """
+    Pass the config on to worker processes, which don't see the CLI args.
+
+    The secrets aren't passed on (see ``Config.export``), so they can't be set through CLI args.
+
+    :param ctx: The typer context, holding the names of the secrets set through CLI args.
+    :raises typer.BadParameter: If a secret was set through a CLI arg.
+    """
+    if ctx.obj["cli_secrets"]:
+        raise typer.BadParameter(
+            f'{", ".join(ctx.obj["cli_secrets"])} would not reach the worker processes, set '
+            'it in the environment or a config file instead.')
+    config.export()
+
+
+@cli.callback(invoke_without_command=True)
 def main(
+    ctx: typer.Context,
     base_url: str = typer.Option(None, help="Set the base url used by fsubs."),
     bind_address: str = typer.Option(None, help="Set application bind IP address."),
     bind_port: int = typer.Option(None, help="Set app bind port."),
+    workers: int = typer.Option(None, min=1, help="Set the number of worker processes."),
+    loop: Loop = typer.Option(None, help="Set the event loop implementation. Default to auto."),
+    http: HTTPProtocol = typer.Option(
+        None, help="Set the HTTP protocol implementation. Default to auto."),
+    backlog: int = typer.Option(
+        None, min=1, help="Set the maximum number of pending connections."),
+    timeout_keep_alive: int = typer.Option(
+        None, min=0, help="Set how long to keep idle connections open, in seconds."),
+    read_only_snapshot: Path = typer.Option(
+        None, exists=True, dir_okay=False,
+        help="Serve the catalog read-only from a snapshot built with `fsubs snapshot build`, "
+             "without a database."),
     cfg: Path = typer.Option("", "--config", "-c", help="Load a custom config file."),
     jwt_algorithm: JWTAlgorithm = typer.Option(
         None,
         help="Set the jwt algorithm used to encode tokens. Default to HS256."),
     jwt_expires_hours: int = typer.Option(None, help="Set jwt expiration in hours."),
     jwt_secret: str = typer.Option(None, help="Set the jwt secret used to encode/decode."),
+    jwt_key_id: str = typer.Option(None, help="Set the kid header of the tokens issued."),
+    jwt_private_key_file: Path = typer.Option(
+        None, help="Set the PEM private key file used to sign tokens with RS, ES or PS."),
+    jwt_public_key_files: str = typer.Option(
+        None, help="Set other PEM public key files accepted to verify tokens, as kid=path,..."),
     log_level: LogLevel = typer.Option(None, "--log-level", "-l", help="Set the log level. Default"
                                                                        " to info."),
+    log_format: LogFormat = typer.Option(None, help="Set the log format. Default to text."),
+    db_engine: StorageEngine = typer.Option(
+        None, help="Set the storage engine. Default to mongo."),
     db_hostname: str = typer.Option(None, help="Set the database hostname."),
     db_password: str = typer.Option(None, help="Set the database password."),
     db_port: int = typer.Option(None, help="Set the database port."),
@@ -88,21 +170,39 @@ def main(
 
 ):
     """Run fsubs backend."""
-    LOGGER.debug(f"Loading config from {cfg}.")
+    LOGGER.debug('Loading config from %s.', cfg)
     config.read(cfg)
+    config.read_dict(vars=get_env_vars())
     cli_args = defaultdict(dict)
     cli_args["app"]["base_url"] = base_url
     cli_args["app"]["bind_address"] = bind_address
     cli_args["app"]["bind_port"] = bind_port
-    cli_args["app"]["jwt_algorithm"] = jwt_algorithm
+    cli_args["app"]["workers"] = workers
+    cli_args["app"]["loop"] = loop.value if loop is not None else None
+    cli_args["app"]["http"] = http.value if http is not None else None
+    cli_args["app"]["backlog"] = backlog
+    cli_args["app"]["timeout_keep_alive"] = timeout_keep_alive
+    cli_args["app"]["read_only_snapshot"] = (
+        str(read_only_snapshot) if read_only_snapshot is not None else None)
+    cli_args["app"]["jwt_algorithm"] = jwt_algorithm.value if jwt_algorithm is not None else None
     cli_args["app"]["jwt_expires_hours"] = jwt_expires_hours
     cli_args["app"]["jwt_secret"] = jwt_secret
+    cli_args["app"]["jwt_key_id"] = jwt_key_id
+    cli_args["app"]["jwt_private_key_file"] = (
+        str(jwt_private_key_file) if jwt_private_key_file is not None else None)
+    cli_args["app"]["jwt_public_key_files"] = jwt_public_key_files
     if log_level is not None:
         cli_args["app"]["log_level"] = log_level.value
+    if log_format is not None:
+        cli_args["app"]["log_format"] = log_format.value
+    cli_args["db"]["engine"] = db_engine.value if db_engine is not None else None
     cli_args["db"]["hostname"] = db_hostname
     cli_args["db"]["port"] = db_port
     cli_args["db"]["username"] = db_username
     cli_args["db"]["password"] = db_password
+    ctx.obj = {"cli_secrets": [
+        option for option, value in (("--jwt-secret", jwt_secret), ("--db-password", db_password))
+        if value is not None]}
 
     actual_args = defaultdict(dict)
     for name, section in cli_args.items():
@@ -114,14 +214,139 @@ def main(
     if config["app"]["base_url"] and not config["app"]["base_url"].startswith("/"):
         config["app"]["base_url"] = f'/{config["app"]["base_url"]}'
     setup_logging()
-    uvicorn.run(
+    if ctx.invoked_subcommand is not None:
+        return
+    if config["db"]["engine"] == 'memory' and config["app"].getint("workers") > 1:
+        # Each worker would have its own copy of the data, which would drift apart.
+        LOGGER.warning('The memory engine lives in a single process, running 1 worker instead '
+                       'of %s.', config["app"]["workers"])
+        config["app"]["workers"] = '1'
+    # A single worker without reload runs in this process, and already has the config.
+    if config["app"].getint("workers") > 1 or config["app"].getboolean("reload"):
+        export_config(ctx)
+    server.run(
         app='fsubs.routers.main:app',
         host=config["app"]["bind_address"],
         port=config["app"].getint("bind_port"),
         reload=config["app"].getboolean("reload"),
         reload_dirs=[pathlib.Path(__file__).parent.absolute()],
+        workers=config["app"].getint("workers"),
+        loop=config["app"]["loop"],
+        http=config["app"]["http"],
+        backlog=config["app"].getint("backlog"),
+        timeout_keep_alive=config["app"].getint("timeout_keep_alive"),
         log_level=config["app"]["log_level"],
+        # Let uvicorn log through the root logger instead of its own blocking handlers.
+        log_config=None,
+    )
+
+
+@cli.command()
+def backfill_stats(
+    batch_size: int = typer.Option(500, min=1, help="Set the number of titles per batch."),
+):
+    """Recompute the version statistics of all movies and tv shows."""
+    engine = create_engine()
+    movies = asyncio.run(MovieDAO(engine=engine).backfill_stats(batch_size=batch_size))
+    tv_shows = asyncio.run(TVShowDAO(engine=engine).backfill_stats(batch_size=batch_size))
+    if config["db"]["engine"] == 'memory' and config["db"]["snapshot_file"]:
+        engine.save_snapshot()
+    LOGGER.info('Backfilled stats for %s movies and %s tv shows.', movies, tv_shows)
+
+
+@snapshot_cli.command("build")
+def build_snapshot(
+    output: Path = typer.Option(
+        "catalog.fsubs", dir_okay=False, help="Set the snapshot file to write."),
+    batch_size: int = typer.Option(500, min=1, help="Set the number of titles per batch."),
+):
+    """Write the catalog of the database to a snapshot, for `--read-only-snapshot` mirrors."""
+    counts = build_mirror(create_engine(), output, batch_size=batch_size)
+    LOGGER.info('Wrote %s documents to %s (%.1f MB).',
+                sum(counts.values()), output, output.stat().st_size / 1e6)
+
+
+@cli.command()
+def calibrate_kdf(
+    algorithm: KDFAlgorithm = typer.Option(
+        KDFAlgorithm.pbkdf2_sha256, help="Set the password hashing algorithm to calibrate."),
+    target_ms: float = typer.Option(
+        250, min=1, help="Set how long hashing a password should take, in milliseconds."),
+):
+    """Find the password hashing cost taking about the target time on this host."""
+    params, elapsed_ms = user_utils.calibrate_kdf(algorithm.value, target_ms)
+    LOGGER.info('Hashing a password with %s %s takes %.0fms.', algorithm.value, params, elapsed_ms)
+    typer.echo('[kdf]')
+    typer.echo(f'algorithm: {algorithm.value}')
+    if algorithm is KDFAlgorithm.scrypt:
+        typer.echo(f'scrypt_n: {params["n"]}\nscrypt_p: {params["p"]}\nscrypt_r: {params["r"]}')
+    else:
+        typer.echo(f'pbkdf2_iterations: {params["i"]}')
+
+
+def parse_distribution(value: str) -> catalog_utils.Distribution:
+    """Parse a distribution option."""
+    try:
+        return catalog_utils.parse_distribution(value)
+    except ValueError as e:
+        raise typer.BadParameter(str(e))
+
+
+@cli.command()
+def generate(
+    ctx: typer.Context,
+    output: CatalogOutput = typer.Option(
+        CatalogOutput.ndjson, help="Set where to write the catalog, to NDJSON or the database."),
+    directory: Path = typer.Option(
+        Path("catalog"), help="Set the directory of the NDJSON files, one per collection."),
+    movies: int = typer.Option(1000, min=0, help="Set the number of movies."),
+    versions_per_title: str = typer.Option(
+        "exp:2", help="Set the distribution of versions per movie, as fixed:N, uniform:LOW-HIGH, "
+                      "exp:MEAN or pareto:MIN:ALPHA."),
+    timestamps_per_version: str = typer.Option(
+        "exp:20", help="Set the distribution of timestamps per version."),
+    tv_shows: int = typer.Option(100, min=0, help="Set the number of tv shows."),
+    seasons_per_show: str = typer.Option(
+        "exp:3", help="Set the distribution of seasons per tv show."),
+    episodes_per_season: str = typer.Option(
+        "exp:10", help="Set the distribution of episodes per season."),
+    users: int = typer.Option(100, min=0, help="Set the number of users."),
+    seed: int = typer.Option(0, help="Set the seed, the same seed giving the same catalog."),
+    workers: int = typer.Option(
+        None, min=1, help="Set the number of processes generating documents. Default to the "
+                          "number of CPUs."),
+    batch_size: int = typer.Option(1000, min=1, help="Set the number of documents per insert."),
+    drop: bool = typer.Option(
+        False, help="Drop the catalog collections before inserting into the database."),
+):
+    """Generate a synthetic catalog of movies, tv shows and users, for load and scale testing."""
+    spec = catalog_utils.CatalogSpec(
+        movies=movies,
+        versions_per_title=parse_distribution(versions_per_title),
+        timestamps_per_version=parse_distribution(timestamps_per_version),
+        tv_shows=tv_shows,
+        seasons_per_show=parse_distribution(seasons_per_show),
+        episodes_per_season=parse_distribution(episodes_per_season),
+        users=users,
+        seed=seed,
     )
+    start = time.perf_counter()
+    if output is CatalogOutput.mongo:
+        if drop:
+            client = create_client()
+            for collection in catalog_utils.COLLECTIONS:
+                client.foreign_subs.drop_collection(collection)
+        # Workers started fresh (e.g. on macOS) only see the config through the environment.
+        export_config(ctx)
+        counts = catalog_utils.insert_catalog_parallel(spec, workers, batch_size)
+    else:
+        counts = catalog_utils.write_ndjson(spec, directory, workers)
+    elapsed = time.perf_counter() - start
+    total = sum(counts.values())
+    for collection in catalog_utils.COLLECTIONS:
+        LOGGER.info('Generated %s %s.', counts.get(collection, 0), collection)
+    LOGGER.info('Generated %s documents in %.1fs, %.0f per second.',
+                total, elapsed, total / elapsed if elapsed else 0)
 
 
 if __name__ == "__main__":
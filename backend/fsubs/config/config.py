@@ -1,5 +1,7 @@
 """Configure fsubs app."""
 
+import json
+import os
 import pathlib
 from collections import defaultdict
 from configparser import ConfigParser
@@ -7,10 +9,19 @@ from os import environ
 
 
 VAR_PREFIX = "FSUBS"
+# Holds the resolved config for worker processes, which don't see the CLI args.
+RESOLVED_CONFIG_VAR = f"{VAR_PREFIX}_RESOLVED_CONFIG"
+# Never exported, workers read them from the environment variables or config files they were set
+# in.
+SECRETS = {"app": ("jwt_secret",), "db": ("password",)}
 
 
 class Config:
-    """Config singleton class."""
+    """
+    Config singleton class.
+
+    The ini files are only read when the config is first used, so creating a ``Config`` is free.
+    """
 
     _instance = None
 
@@ -18,21 +29,51 @@ class Config:
         """Implement singleton pattern."""
         if Config._instance is None:
             Config._instance = object.__new__(cls)
-            Config._instance.config = ConfigParser()
-            with open(f"{pathlib.Path(__file__).parent.absolute()}/default.ini") as f:
-                Config._instance.config.read_file(f)
-            Config._instance.config.read(
-                f"{pathlib.Path(__file__).parent.absolute()}/default_reload.ini")
+            Config._instance._config = None
+            Config._instance._files = []
         return Config._instance
 
+    @property
+    def config(self) -> ConfigParser:
+        """Get the parsed config, reading the ini files the first time."""
+        if self._config is None:
+            config = ConfigParser()
+            with open(f"{pathlib.Path(__file__).parent.absolute()}/default.ini") as f:
+                config.read_file(f)
+            config.read(f"{pathlib.Path(__file__).parent.absolute()}/default_reload.ini")
+            if RESOLVED_CONFIG_VAR in environ:
+                resolved = json.loads(environ[RESOLVED_CONFIG_VAR])
+                # The files first, for their secrets. The resolved config overrides the rest.
+                self._files = config.read(resolved["files"])
+                config.read_dict(resolved["config"])
+                config.read_dict(get_env_vars(secrets_only=True))
+            self._config = config
+        return self._config
+
     def read(self, cfg_file):
         """Add a new config file."""
-        self.config.read(cfg_file)
+        self._files.extend(os.path.abspath(name) for name in self.config.read(cfg_file))
 
     def read_dict(self, vars):
         """Add environment variables to config."""
         self.config.read_dict(vars)
 
+    def export(self):
+        """
+        Pass this config on to worker processes started from now on, through the environment.
+
+        The secrets (see ``SECRETS``) are left out. The workers read the config files this config
+        was read from again, and the environment variables they inherit, to get them.
+        """
+        environ[RESOLVED_CONFIG_VAR] = json.dumps({
+            "files": self._files,
+            "config": {
+                name: {key: value for key, value in section.items()
+                       if key not in SECRETS.get(name, ())}
+                for name, section in self.config.items()
+            },
+        })
+
     def __getitem__(self, key):
         """
         Get the section in the ``Config`` object with the given key.
@@ -59,25 +100,86 @@ class Config:
         return str({name: dict(section) for name, section in self.config.items()})
 
 
-def get_env_vars():
-    """Read environment variables to a dict."""
+def get_env_vars(secrets_only: bool = False):
+    """
+    Read environment variables to a dict.
+
+    :param secrets_only: Whether to only read the secrets (see ``SECRETS``).
+    :returns: The values set, by section and key.
+    """
     vars = defaultdict(dict)
     names = [
+        "ADMISSION_AUTH_LIMIT",
+        "ADMISSION_AUTH_QUEUE",
+        "ADMISSION_AUTH_QUEUE_TIMEOUT_MS",
+        "ADMISSION_LIST_LIMIT",
+        "ADMISSION_LIST_QUEUE",
+        "ADMISSION_LIST_QUEUE_TIMEOUT_MS",
+        "ADMISSION_READ_LIMIT",
+        "ADMISSION_READ_QUEUE",
+        "ADMISSION_READ_QUEUE_TIMEOUT_MS",
+        "ADMISSION_WRITE_LIMIT",
+        "ADMISSION_WRITE_QUEUE",
+        "ADMISSION_WRITE_QUEUE_TIMEOUT_MS",
+        "APP_BACKLOG",
         "APP_BASE_URL",
         "APP_BIND_ADDRESS",
         "APP_BIND_PORT",
+        "APP_HTTP",
         "APP_JWT_ALGORITHM",
         "APP_JWT_EXPIRES_HOURS",
+        "APP_JWT_KEY_ID",
+        "APP_JWT_PRIVATE_KEY_FILE",
+        "APP_JWT_PUBLIC_KEY_FILES",
         "APP_JWT_SECRET",
+        "APP_LOG_FORMAT",
         "APP_LOG_LEVEL",
+        "APP_LOG_SAMPLE_RATES",
+        "APP_LOOP",
+        "APP_READ_ONLY_SNAPSHOT",
+        "APP_REQUEST_TIMEOUT_MS",
+        "APP_REVOCATION_REFRESH_SECONDS",
+        "APP_STALE_CACHE_MAX_AGE_SECONDS",
+        "APP_STALE_CACHE_SIZE",
+        "APP_TIMEOUT_KEEP_ALIVE",
+        "APP_TOKEN_CACHE_SIZE",
+        "APP_WORKERS",
+        "DB_BREAKER_FAILURES",
+        "DB_BREAKER_RESET_SECONDS",
+        "DB_CONNECT_TIMEOUT_MS",
+        "DB_ENGINE",
         "DB_HOSTNAME",
+        "DB_MAX_TIME_MS",
+        "DB_MIN_POOL_SIZE",
         "DB_PASSWORD",
         "DB_PORT",
+        "DB_SERVER_SELECTION_TIMEOUT_MS",
+        "DB_SNAPSHOT_FILE",
+        "DB_SNAPSHOT_INTERVAL_SECONDS",
+        "DB_SOCKET_TIMEOUT_MS",
         "DB_USERNAME",
+        "KDF_ALGORITHM",
+        "KDF_PBKDF2_ITERATIONS",
+        "KDF_SCRYPT_N",
+        "KDF_SCRYPT_P",
+        "KDF_SCRYPT_R",
+        "RATELIMIT_AUTH_BURST",
+        "RATELIMIT_AUTH_RATE",
+        "RATELIMIT_BACKEND",
+        "RATELIMIT_LIST_BURST",
+        "RATELIMIT_LIST_PAGE_SIZE",
+        "RATELIMIT_LIST_RATE",
+        "RATELIMIT_MAX_KEYS",
+        "RATELIMIT_READ_BURST",
+        "RATELIMIT_READ_RATE",
+        "RATELIMIT_WRITE_BURST",
+        "RATELIMIT_WRITE_RATE",
     ]
     for name in names:
+        section, key = name.lower().split("_", 1)
+        if secrets_only and key not in SECRETS.get(section, ()):
+            continue
         try:
-            section, key = name.lower().split("_", 1)
             vars[section][key] = environ[f"{VAR_PREFIX}_{name}"]
         except KeyError:
             pass
@@ -1 +1,4 @@
 """CRUD DAOs."""
+
+# Imported for its side effect of registering the slow query listener before any client exists.
+from fsubs.utils import slow_queries  # noqa: F401
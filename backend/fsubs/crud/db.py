@@ -0,0 +1,172 @@
+"""Database client helpers."""
+
+import os
+import threading
+from typing import Any, Dict
+
+from pymongo import MongoClient
+
+from fsubs.config.config import Config
+from fsubs.crud.engine import MongoEngine
+from fsubs.crud.memory import MemoryEngine
+from fsubs.utils.metrics import POOL_LISTENER
+from fsubs.utils.slow_queries import SLOW_QUERIES
+
+_SHARED_CLIENT = None
+_SHARED_ENGINE = None
+
+
+class LazyClient():
+    """
+    A ``MongoClient`` stand in that connects on first use, once per process.
+
+    ``MongoClient`` is not fork safe, so a client created before a worker process is forked must
+    not be used by the worker. This proxy builds the real client the first time it is used and
+    builds a new one if it is then used from another process, so each worker gets its own pool.
+    The ``[db]`` section of the config is only read then too, so creating one does no I/O.
+    """
+
+    def __init__(self, **kwargs):
+        """
+        Initialize a ``LazyClient``.
+
+        :param kwargs: Arguments to build the ``MongoClient`` with, on top of the ``[db]`` section
+        of the config.
+        """
+        self._kwargs = kwargs
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self) -> MongoClient:
+        """
+        Get the ``MongoClient`` of the current process, building it if needed.
+
+        :returns: The ``MongoClient``.
+        """
+        pid = os.getpid()
+        if self._client is None or self._pid != pid:
+            if self._pid != pid:
+                # A lock held at fork time stays held in the child, start from a fresh one.
+                self._lock = threading.Lock()
+            with self._lock:
+                if self._client is None or self._pid != pid:
+                    self._client = MongoClient(**{**client_settings(), **self._kwargs})
+                    self._pid = pid
+        return self._client
+
+    def __getattr__(self, name):
+        """Get an attribute of the ``MongoClient`` (e.g. a database)."""
+        return getattr(self.get(), name)
+
+    def __getitem__(self, name):
+        """Get a database of the ``MongoClient``."""
+        return self.get()[name]
+
+
+def client_settings() -> Dict[str, Any]:
+    """
+    Get the ``MongoClient`` arguments from the ``[db]`` section of the config.
+
+    The clients get the listeners recording pool metrics and slow queries.
+
+    :returns: The arguments.
+    """
+    config = Config()
+    return {
+        'host': config["db"]["hostname"],
+        'port': config["db"].getint("port"),
+        'username': config["db"]["username"],
+        'password': config["db"]["password"],
+        'minPoolSize': config["db"].getint("min_pool_size"),
+        # Fail fast instead of waiting on pymongo's 30s default when Mongo is unreachable.
+        'serverSelectionTimeoutMS': config["db"].getint("server_selection_timeout_ms"),
+        'connectTimeoutMS': config["db"].getint("connect_timeout_ms"),
+        'socketTimeoutMS': config["db"].getint("socket_timeout_ms"),
+        'event_listeners': [POOL_LISTENER, SLOW_QUERIES],
+    }
+
+
+def create_client(**kwargs) -> LazyClient:
+    """
+    Create a client from the ``[db]`` section of the config.
+
+    The client only reads the config and connects on first use, in the process using it.
+
+    :param kwargs: Arguments to build the ``MongoClient`` with, on top of the config.
+    :returns: The new client.
+    """
+    return LazyClient(**kwargs)
+
+
+class LazyEngine():
+    """
+    A storage engine stand in that builds the engine of the ``[db]`` section on first use.
+
+    With ``engine: mongo`` the engine is a ``MongoEngine`` over the shared client. With
+    ``engine: memory`` it is a ``MemoryEngine``, loaded from ``snapshot_file`` if it exists.
+    """
+
+    def __init__(self):
+        """Initialize a ``LazyEngine``."""
+        self._engine = None
+        self._lock = threading.Lock()
+
+    def resolve(self):
+        """
+        Get the engine, building it if needed.
+
+        :returns: The ``MongoEngine`` or ``MemoryEngine``.
+        """
+        if self._engine is None:
+            with self._lock:
+                if self._engine is None:
+                    self._engine = create_engine()
+        return self._engine
+
+    def __getattr__(self, name):
+        """Get an attribute of the engine (e.g. a method)."""
+        return getattr(self.resolve(), name)
+
+
+def create_engine(client=None):
+    """
+    Create the storage engine of the ``[db]`` section of the config.
+
+    :param client: The client of a Mongo engine. Defaults to the shared client.
+    :returns: The ``MongoEngine`` or ``MemoryEngine``.
+    :raises ValueError: If the engine is unknown.
+    """
+    config = Config()
+    engine = config["db"]["engine"]
+    if engine == 'memory':
+        return MemoryEngine(snapshot_file=config["db"]["snapshot_file"] or None)
+    if engine == 'mongo':
+        return MongoEngine(client or get_client())
+    raise ValueError(f'Unknown storage engine {engine}, expected mongo or memory.')
+
+
+def get_engine() -> LazyEngine:
+    """
+    Get the storage engine shared by the DAOs.
+
+    :returns: The shared engine.
+    """
+    global _SHARED_ENGINE
+    if _SHARED_ENGINE is None:
+        _SHARED_ENGINE = LazyEngine()
+    return _SHARED_ENGINE
+
+
+def get_client() -> LazyClient:
+    """
+    Get the client shared by the routers.
+
+    Sharing it gives a worker one connection pool instead of one per router.
+
+    :returns: The shared client.
+    """
+    global _SHARED_CLIENT
+    if _SHARED_CLIENT is None:
+        _SHARED_CLIENT = create_client()
+    return _SHARED_CLIENT
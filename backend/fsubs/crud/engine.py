@@ -0,0 +1,319 @@
+"""The storage engine the DAOs keep documents in, backed by Mongo."""
+
+import logging
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from bson.objectid import ObjectId
+from pymongo import IndexModel, ReturnDocument, UpdateOne
+
+from fsubs.crud.queries import TITLE_COLLATION, find_titles, summarize_explain, title_pipeline
+from fsubs.crud.stats import increment_stats
+from fsubs.utils.deadlines import command_options, max_time_ms
+from fsubs.utils.timing import timed_queries
+
+LOGGER = logging.getLogger(__name__)
+
+
+def to_id(document_id: Any) -> Any:
+    """
+    Get the ``_id`` of a document from its id as a string.
+
+    :param document_id: The id, as a string or an ``ObjectId``.
+    :returns: The ``ObjectId``, or the id itself if it isn't one (e.g. ``jti:...``).
+    """
+    if isinstance(document_id, str) and ObjectId.is_valid(document_id):
+        return ObjectId(document_id)
+    return document_id
+
+
+@timed_queries()
+class MongoEngine():
+    """
+    Documents in the ``foreign_subs`` database of a Mongo client.
+
+    Every method is a single query, bounded by the time budget of the request being handled and
+    counted as a round trip of the request. The documents returned are the raw documents, with
+    their ``_id``.
+    """
+
+    name = 'mongo'
+
+    def __init__(self, client):
+        """
+        Initialize a ``MongoEngine``.
+
+        :param client: The MongoClient object to use for the engine.
+        """
+        self.client = client
+
+    def ping(self):
+        """Check that the database answers, opening a connection if needed."""
+        self.client.admin.command('ping')
+
+    def ensure_indexes(self, collection: str, indexes: List[IndexModel]):
+        """
+        Create indexes if they don't exist.
+
+        :param collection: The collection to index.
+        :param indexes: The indexes to create.
+        """
+        self.client.foreign_subs[collection].create_indexes(indexes)
+
+    def insert(self, collection: str, document: Dict[str, Any]) -> Any:
+        """
+        Insert a document.
+
+        :param collection: The collection to insert into.
+        :param document: The document.
+        :returns: The id of the document.
+        :raises DuplicateKeyError: If a unique index already has one of its values.
+        """
+        return self.client.foreign_subs[collection].insert_one(document).inserted_id
+
+    def insert_many(self, collection: str, documents: List[Dict[str, Any]]):
+        """
+        Insert documents in a single unordered batch.
+
+        :param collection: The collection to insert into.
+        :param documents: The documents.
+        """
+        self.client.foreign_subs[collection].insert_many(documents, ordered=False)
+
+    def replace(self, collection: str, document: Dict[str, Any]):
+        """
+        Insert a document, or replace the one with the same ``_id``.
+
+        :param collection: The collection to write to.
+        :param document: The document, with its ``_id``.
+        """
+        self.client.foreign_subs[collection].replace_one(
+            {'_id': document['_id']}, document, upsert=True)
+
+    def get(self, collection: str, document_id: Any,
+            projection: Dict[str, Any] = None) -> Optional[Dict[str, Any]]:
+        """
+        Read a document by id.
+
+        :param collection: The collection to read from.
+        :param document_id: The id of the document.
+        :param projection: The fields to read. Defaults to all the fields.
+        :returns: The document, or ``None`` if there is none.
+        """
+        return self.client.foreign_subs[collection].find_one(
+            {'_id': to_id(document_id)}, projection=projection, max_time_ms=max_time_ms())
+
+    def get_many(self, collection: str, document_ids: Iterable[Any],
+                 projection: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+        """
+        Read several documents by id with a single query.
+
+        :param collection: The collection to read from.
+        :param document_ids: The ids of the documents.
+        :param projection: The fields to read. Defaults to all the fields.
+        :returns: The documents that were found, in no particular order.
+        """
+        return list(self.client.foreign_subs[collection].find(
+            {'_id': {'$in': [to_id(document_id) for document_id in set(document_ids)]}},
+            projection=projection, max_time_ms=max_time_ms()))
+
+    def find_one(self, collection: str, search: Dict[str, Any],
+                 projection: Dict[str, Any] = None) -> Optional[Dict[str, Any]]:
+        """
+        Read the first document with the given field values.
+
+        :param collection: The collection to read from.
+        :param search: The values the fields must equal (e.g. ``{'username': 'joe'}``).
+        :param projection: The fields to read. Defaults to all the fields.
+        :returns: The document, or ``None`` if there is none.
+        """
+        return self.client.foreign_subs[collection].find_one(
+            search, projection=projection, max_time_ms=max_time_ms())
+
+    def find(self, collection: str, search: Dict[str, Any] = None,
+             children: Tuple[str, Dict[str, Any]] = None, limit: int = 0, skip: int = 0,
+             sort_by: Optional[str] = None, descending: bool = False,
+             projection: Dict[str, Any] = None, explain: bool = False) -> Any:
+        """
+        Read a page of the documents with the given field values.
+
+        :param collection: The collection to read from.
+        :param search: The values the fields must equal (e.g. ``{'no_subs': True}``).
+        :param children: If supplied, a child collection and the values the fields of a child
+         must equal (e.g. ``('movie_versions', {'disc_type': 'DVD'})``). Only the documents with at
+         least one such child, by ``video_base_id``, are read.
+        :param limit: The number of documents to read, ``0`` for all of them.
+        :param skip: The number of documents to skip.
+        :param sort_by: The name of the field to sort by, one of ``SORT_FIELDS``. Defaults to the
+         natural order.
+        :param descending: Whether to sort in descending order.
+        :param projection: The fields to read. Defaults to all the fields.
+        :param explain: If ``True``, return a summary of the query plan instead of the documents.
+        :returns: The documents.
+        """
+        if children is not None:
+            return self._aggregate_titles(
+                collection, search or {}, children, limit=limit, skip=skip, sort_by=sort_by,
+                descending=descending, projection=projection, explain=explain)
+        cursor = find_titles(
+            self.client.foreign_subs[collection],
+            search=search or {},
+            limit=limit,
+            skip=skip,
+            sort_by=sort_by,
+            descending=descending,
+            projection=projection)
+        if explain:
+            return summarize_explain(cursor.explain())
+        return list(cursor)
+
+    def _aggregate_titles(self, collection: str, search: Dict[str, Any],
+                          children: Tuple[str, Dict[str, Any]], limit: int, skip: int,
+                          sort_by: Optional[str], descending: bool,
+                          projection: Optional[Dict[str, Any]], explain: bool) -> Any:
+        """Read a page of titles with a matching child, with the pipeline of ``title_pipeline``."""
+        pipeline = title_pipeline(
+            search, children, limit=limit, skip=skip, sort_by=sort_by, descending=descending,
+            projection=projection)
+        collation = TITLE_COLLATION if sort_by == 'title' else None
+        if explain:
+            options = {'collation': collation.document} if collation else {}
+            return summarize_explain(self.client.foreign_subs.command(
+                'aggregate', collection, pipeline=pipeline, explain=True, **options))
+        return list(self.client.foreign_subs[collection].aggregate(
+            pipeline, collation=collation, **command_options()))
+
+    def find_in(self, collection: str, field: str, values: Iterable[Any],
+                projection: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+        """
+        Read the documents with a field equal to any of the given values.
+
+        :param collection: The collection to read from.
+        :param field: The field (e.g. ``video_base_id``).
+        :param values: The values.
+        :param projection: The fields to read. Defaults to all the fields.
+        :returns: The documents, in their natural order.
+        """
+        return list(self.client.foreign_subs[collection].find(
+            {field: {'$in': list(values)}}, projection=projection, max_time_ms=max_time_ms()))
+
+    def find_since(self, collection: str, field: str,
+                   since: Optional[datetime]) -> List[Dict[str, Any]]:
+        """
+        Read the documents with a field at or after a time, oldest first.
+
+        :param collection: The collection to read from.
+        :param field: The field holding the time.
+        :param since: The time, ``None`` to read every document.
+        :returns: The documents.
+        """
+        search = {field: {'$gte': since}} if since is not None else {}
+        return list(self.client.foreign_subs[collection].find(search).sort(field, 1))
+
+    def ids_after(self, collection: str, after: Any, limit: int) -> List[Any]:
+        """
+        Get the ids of documents in id order, to go through a whole collection in batches.
+
+        :param collection: The collection to read from.
+        :param after: The id to start after, ``None`` to start from the first one.
+        :param limit: The number of ids to get.
+        :returns: The ids.
+        """
+        search = {'_id': {'$gt': after}} if after is not None else {}
+        return [
+            document['_id'] for document in self.client.foreign_subs[collection].find(
+                search, projection={'_id': True}).sort('_id', 1).limit(limit)]
+
+    def update(self, collection: str, document_id: Any, fields: Dict[str, Any],
+               search: Dict[str, Any] = None, return_after: bool = False,
+               projection: Dict[str, Any] = None) -> Optional[Dict[str, Any]]:
+        """
+        Set fields of a document.
+
+        :param collection: The collection to write to.
+        :param document_id: The id of the document.
+        :param fields: The values to set.
+        :param search: Other values the fields of the document must equal for it to be updated.
+        :param return_after: Whether to return the document as updated rather than as before.
+        :param projection: The fields to return. Defaults to all the fields.
+        :returns: The document, or ``None`` if no document was updated.
+        :raises DuplicateKeyError: If a unique index already has one of the values.
+        """
+        return self.client.foreign_subs[collection].find_one_and_update(
+            {**(search or {}), '_id': to_id(document_id)}, {'$set': fields},
+            projection=projection,
+            return_document=ReturnDocument.AFTER if return_after else ReturnDocument.BEFORE)
+
+    def update_each(self, collection: str, updates: List[Tuple[Any, Dict[str, Any]]]):
+        """
+        Set fields of several documents with a single bulk write.
+
+        :param collection: The collection to write to.
+        :param updates: Pairs of document id and values to set.
+        """
+        if updates:
+            self.client.foreign_subs[collection].bulk_write(
+                [UpdateOne({'_id': to_id(document_id)}, {'$set': fields})
+                 for document_id, fields in updates],
+                ordered=False)
+
+    def increment(self, collection: str, search: Dict[str, Any], deltas: Dict[str, Any],
+                  projection: Dict[str, Any] = None) -> Optional[Dict[str, Any]]:
+        """
+        Atomically increment fields of the first document with the given field values.
+
+        :param collection: The collection to write to.
+        :param search: The values the fields must equal.
+        :param deltas: The amount to change each field by.
+        :param projection: The fields to return. Defaults to all the fields.
+        :returns: The document as updated, or ``None`` if there is none.
+        """
+        return self.client.foreign_subs[collection].find_one_and_update(
+            search, {'$inc': deltas}, projection=projection,
+            return_document=ReturnDocument.AFTER)
+
+    def increment_stats(self, collection: str, document_id: Any, deltas: Dict[str, Any],
+                        flag_counter: Optional[str] = 'foreign_subs_version_count'):
+        """
+        Atomically apply statistic deltas to a document and recompute its ``has_foreign_subs``.
+
+        :param collection: The collection to write to.
+        :param document_id: The id of the document.
+        :param deltas: The amount to change each statistic by.
+        :param flag_counter: The counter that ``has_foreign_subs`` is derived from, ``None`` for
+        documents without the flag.
+        """
+        self.client.foreign_subs[collection].update_one(
+            {'_id': to_id(document_id)}, increment_stats(deltas, flag_counter=flag_counter))
+
+    def delete(self, collection: str, document_id: Any,
+               projection: Dict[str, Any] = None) -> Optional[Dict[str, Any]]:
+        """
+        Delete a document.
+
+        :param collection: The collection to delete from.
+        :param document_id: The id of the document.
+        :param projection: The fields to return. Defaults to all the fields.
+        :returns: The deleted document, or ``None`` if there is none.
+        """
+        return self.client.foreign_subs[collection].find_one_and_delete(
+            {'_id': to_id(document_id)}, projection=projection)
+
+    def delete_where(self, collection: str, field: str, value: Any) -> int:
+        """
+        Delete the documents with a field equal to a value.
+
+        :param collection: The collection to delete from.
+        :param field: The field.
+        :param value: The value.
+        :returns: The number of documents deleted.
+        """
+        return self.client.foreign_subs[collection].delete_many({field: value}).deleted_count
+
+    def drop(self, collection: str):
+        """
+        Delete a collection and its indexes.
+
+        :param collection: The collection.
+        """
+        self.client.foreign_subs.drop_collection(collection)
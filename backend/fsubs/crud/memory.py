@@ -0,0 +1,686 @@
+"""A storage engine keeping the documents in memory, for benchmarks and small deployments."""
+
+import asyncio
+import bisect
+import logging
+import os
+import pathlib
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import bson
+from bson.objectid import ObjectId
+from pymongo import IndexModel
+from pymongo.errors import DuplicateKeyError
+
+from fsubs.crud.engine import to_id
+from fsubs.crud.queries import SORT_FIELDS, VERSION_FILTER_FIELDS
+from fsubs.utils.singleflight import run_in_executor
+from fsubs.utils.timing import timed_queries
+
+LOGGER = logging.getLogger(__name__)
+
+# The fields each collection is indexed on. Searches on them only look at the matching documents,
+# searches on other fields go through the whole collection.
+MEMORY_INDEXES = {
+    'movies': ('imdb_id',),
+    'movie_versions': ('video_base_id', *VERSION_FILTER_FIELDS),
+    'tv_shows': ('imdb_id',),
+    'tv_show_episodes': ('video_base_id',),
+    'users': ('username', 'email'),
+}
+# The indexed fields no two documents of a collection may share a value of.
+MEMORY_UNIQUE = {
+    'users': ('username', 'email'),
+}
+# Documents are dropped once the time in this field has passed, like with a Mongo TTL index.
+MEMORY_TTL = {
+    'revocations': 'expires',
+}
+
+
+def field_value(document: Dict[str, Any], field: str) -> Any:
+    """Get the value of a field of a document, which may be a dotted path."""
+    if '.' not in field:
+        return document.get(field)
+    value = document
+    for part in field.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def sort_key(sort_by: str):
+    """Get the sort key of a sort field, ordering missing values first like Mongo does."""
+    field = SORT_FIELDS.get(sort_by, sort_by)
+
+    def key(document: Dict[str, Any]) -> Tuple:
+        value = field_value(document, field)
+        if sort_by == 'title' and isinstance(value, str):
+            # Like the title collation, which ignores case.
+            value = value.casefold()
+        return (value is not None, value, document['_id'])
+    return key
+
+
+def _stored(value: Any) -> Any:
+    """
+    Copy a value to store, the way Mongo stores it.
+
+    Datetimes become naive UTC with millisecond precision and tuples become lists, so documents
+    read back, or loaded from a snapshot, are the same as the ones read from Mongo.
+    """
+    if isinstance(value, dict):
+        return {key: _stored(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_stored(item) for item in value]
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.replace(microsecond=value.microsecond // 1000 * 1000)
+    return value
+
+
+def _copied(value: Any) -> Any:
+    """Copy the dicts and lists of a stored value, so readers can't change the stored one."""
+    if isinstance(value, dict):
+        return {key: _copied(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copied(item) for item in value]
+    return value
+
+
+def _project(document: Dict[str, Any], projection: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Copy a document, keeping only the projected fields and the ``_id``."""
+    if not projection:
+        return _copied(document)
+    projected = {
+        field: _copied(document[field]) for field, include in projection.items()
+        if include and field in document}
+    if projection.get('_id', True):
+        projected['_id'] = document['_id']
+    return projected
+
+
+class MemoryCollection():
+    """
+    The documents of a collection by id, in insertion order, with hash indexes on some fields.
+
+    Stored documents are never modified, writes replace them, so a document can be handed to a
+    reader or a snapshot while others write.
+    """
+
+    def __init__(self, name: str):
+        """
+        Initialize an empty ``MemoryCollection``.
+
+        :param name: The name of the collection.
+        """
+        self.name = name
+        self.documents: Dict[Any, Dict[str, Any]] = {}
+        self.indexes: Dict[str, Dict[Any, Set[Any]]] = {
+            field: {} for field in MEMORY_INDEXES.get(name, ())}
+        self.unique = MEMORY_UNIQUE.get(name, ())
+        # Bumped by every write, to know when the cached sort orders are stale.
+        self.version = 0
+        self._positions: Dict[Any, int] = {}
+        self._next_position = 0
+        self._sorted: Dict[str, Tuple[int, List[Dict[str, Any]]]] = {}
+
+    def add(self, document: Dict[str, Any], replacing: Dict[str, Any] = None):
+        """
+        Store a new version of a document, keeping the indexes up to date.
+
+        :param document: The document.
+        :param replacing: The version of the document it replaces, if any.
+        :raises DuplicateKeyError: If the id or a unique field value is already taken.
+        """
+        if replacing is None and document['_id'] in self.documents:
+            raise DuplicateKeyError(
+                f'E11000 duplicate key error collection: {self.name} index: _id_', 11000,
+                {'keyPattern': {'_id': 1}})
+        for field in self.unique:
+            value = document.get(field)
+            if replacing is not None and replacing.get(field) == value:
+                continue
+            if self.indexes[field].get(value):
+                raise DuplicateKeyError(
+                    f'E11000 duplicate key error collection: {self.name} index: {field}_unique',
+                    11000, {'keyPattern': {field: 1}})
+        if replacing is not None:
+            self._unindex(replacing)
+        else:
+            self._positions[document['_id']] = self._next_position
+            self._next_position += 1
+        self.documents[document['_id']] = document
+        for field, index in self.indexes.items():
+            value = field_value(document, field)
+            if value is not None and not isinstance(value, (dict, list)):
+                index.setdefault(value, set()).add(document['_id'])
+        self.version += 1
+
+    def remove(self, document_id: Any) -> Optional[Dict[str, Any]]:
+        """
+        Remove a document.
+
+        :param document_id: The id of the document.
+        :returns: The document, or ``None`` if there is none.
+        """
+        document = self.documents.pop(document_id, None)
+        if document is not None:
+            self._unindex(document)
+            del self._positions[document_id]
+            self.version += 1
+        return document
+
+    def _unindex(self, document: Dict[str, Any]):
+        """Remove a document from the indexes."""
+        for field, index in self.indexes.items():
+            value = field_value(document, field)
+            if value is None or isinstance(value, (dict, list)):
+                continue
+            ids = index.get(value)
+            if ids is not None:
+                ids.discard(document['_id'])
+                if not ids:
+                    del index[value]
+
+    def candidates(self, search: Dict[str, Any]) -> Tuple[Optional[List[Any]], List[str]]:
+        """
+        Narrow a search down with the indexes.
+
+        :param search: The values the fields must equal.
+        :returns: The ids of the documents that may match in insertion order, or ``None`` if every
+         document may, and the indexes used.
+        """
+        sets, used = [], []
+        for field, value in search.items():
+            if field in self.indexes:
+                sets.append(self.indexes[field].get(value, set()))
+                used.append(field)
+        if not sets:
+            return None, used
+        sets.sort(key=len)
+        matching = set(sets[0]).intersection(*sets[1:])
+        return sorted(matching, key=self._positions.__getitem__), used
+
+    def sorted(self, sort_by: str) -> List[Dict[str, Any]]:
+        """
+        Get every document in the order of a sort field, cached until the next write.
+
+        :param sort_by: The name of the sort field, one of ``SORT_FIELDS`` or ``_id``.
+        :returns: The documents, in ascending order.
+        """
+        version, documents = self._sorted.get(sort_by, (None, None))
+        if version != self.version:
+            documents = sorted(self.documents.values(), key=sort_key(sort_by))
+            self._sorted[sort_by] = (self.version, documents)
+        return documents
+
+
+@timed_queries(exclude=('save_snapshot', 'load_snapshot'))
+class MemoryEngine():
+    """
+    Documents in dicts of this process, with the same methods as ``MongoEngine``.
+
+    Documents are kept by id, with hash indexes on the fields of ``MEMORY_INDEXES``. Sorted pages
+    use a sort order computed once per write. Every worker has its own documents, so this is only
+    meant for a single worker. The documents can be saved to a snapshot file and loaded back on
+    start.
+
+    Each method call counts as the database round trip the same call on a ``MongoEngine`` makes,
+    so query counts measured with either engine are the same.
+    """
+
+    name = 'memory'
+
+    def __init__(self, snapshot_file: str = None):
+        """
+        Initialize a ``MemoryEngine``, loading the snapshot if there is one.
+
+        :param snapshot_file: Where to save the documents to and load them from. Defaults to not
+        saving them.
+        """
+        self.snapshot_file = pathlib.Path(snapshot_file) if snapshot_file else None
+        self._collections: Dict[str, MemoryCollection] = {}
+        # DAOs also read from executor threads.
+        self._lock = threading.RLock()
+        if self.snapshot_file is not None and self.snapshot_file.exists():
+            self.load_snapshot(self.snapshot_file)
+
+    def _collection(self, name: str) -> MemoryCollection:
+        """Get a collection, creating it if needed."""
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections[name] = MemoryCollection(name)
+        return collection
+
+    def _find(self, collection: MemoryCollection,
+              search: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], List[str], int]:
+        """
+        Find the documents with the given field values.
+
+        :returns: The documents, the indexed fields used and the number of documents examined.
+        """
+        candidate_ids, used = collection.candidates(search)
+        if candidate_ids is None:
+            documents = collection.documents.values()
+        else:
+            documents = [collection.documents[document_id] for document_id in candidate_ids]
+        rest = {field: value for field, value in search.items() if field not in used}
+        matching = [
+            document for document in documents
+            if all(field_value(document, field) == value for field, value in rest.items())]
+        return matching, used, len(documents)
+
+    def _with_children(self, documents: Iterable[Dict[str, Any]],
+                       children: Tuple[str, Dict[str, Any]], skip: int,
+                       limit: int) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        Page through the documents with at least one matching child.
+
+        Like the ``$lookup`` of the Mongo engine, the children of one document are looked up at a
+        time through the ``video_base_id`` index, until the page is full.
+
+        :returns: The page and the number of documents examined.
+        """
+        child_collection, child_search = children
+        child_collection = self._collection(child_collection)
+        page, matched, examined = [], 0, 0
+        for document in documents:
+            if limit and len(page) == limit:
+                break
+            examined += 1
+            child_search_of_document = {**child_search, 'video_base_id': str(document['_id'])}
+            if not self._find(child_collection, child_search_of_document)[0]:
+                continue
+            matched += 1
+            if matched > skip:
+                page.append(document)
+        return page, examined
+
+    def ping(self):
+        """Nothing to connect to."""
+
+    def ensure_indexes(self, collection: str, indexes: List[IndexModel]):
+        """
+        Nothing to create, the indexes of ``MEMORY_INDEXES`` are always kept.
+
+        :param collection: The collection to index.
+        :param indexes: The Mongo indexes, which are ignored.
+        """
+
+    def insert(self, collection: str, document: Dict[str, Any]) -> Any:
+        """
+        Insert a document.
+
+        :param collection: The collection to insert into.
+        :param document: The document.
+        :returns: The id of the document.
+        :raises DuplicateKeyError: If a unique field value is already taken.
+        """
+        document = _stored(document)
+        document.setdefault('_id', ObjectId())
+        with self._lock:
+            self._collection(collection).add(document)
+        return document['_id']
+
+    def insert_many(self, collection: str, documents: List[Dict[str, Any]]):
+        """
+        Insert documents.
+
+        :param collection: The collection to insert into.
+        :param documents: The documents.
+        """
+        for document in documents:
+            self.insert(collection, document)
+
+    def replace(self, collection: str, document: Dict[str, Any]):
+        """
+        Insert a document, or replace the one with the same ``_id``.
+
+        :param collection: The collection to write to.
+        :param document: The document, with its ``_id``.
+        """
+        document = _stored(document)
+        with self._lock:
+            memory_collection = self._collection(collection)
+            memory_collection.add(
+                document, replacing=memory_collection.documents.get(document['_id']))
+
+    def get(self, collection: str, document_id: Any,
+            projection: Dict[str, Any] = None) -> Optional[Dict[str, Any]]:
+        """
+        Read a document by id.
+
+        :param collection: The collection to read from.
+        :param document_id: The id of the document.
+        :param projection: The fields to read. Defaults to all the fields.
+        :returns: The document, or ``None`` if there is none.
+        """
+        with self._lock:
+            document = self._collection(collection).documents.get(to_id(document_id))
+        return _project(document, projection) if document is not None else None
+
+    def get_many(self, collection: str, document_ids: Iterable[Any],
+                 projection: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+        """
+        Read several documents by id.
+
+        :param collection: The collection to read from.
+        :param document_ids: The ids of the documents.
+        :param projection: The fields to read. Defaults to all the fields.
+        :returns: The documents that were found.
+        """
+        with self._lock:
+            documents = self._collection(collection).documents
+            found = [documents.get(document_id)
+                     for document_id in {to_id(document_id) for document_id in document_ids}]
+        return [_project(document, projection) for document in found if document is not None]
+
+    def find_one(self, collection: str, search: Dict[str, Any],
+                 projection: Dict[str, Any] = None) -> Optional[Dict[str, Any]]:
+        """
+        Read the first document with the given field values.
+
+        :param collection: The collection to read from.
+        :param search: The values the fields must equal (e.g. ``{'username': 'joe'}``).
+        :param projection: The fields to read. Defaults to all the fields.
+        :returns: The document, or ``None`` if there is none.
+        """
+        with self._lock:
+            documents, _, _ = self._find(self._collection(collection), search)
+        return _project(documents[0], projection) if documents else None
+
+    def find(self, collection: str, search: Dict[str, Any] = None,
+             children: Tuple[str, Dict[str, Any]] = None, limit: int = 0, skip: int = 0,
+             sort_by: Optional[str] = None, descending: bool = False,
+             projection: Dict[str, Any] = None, explain: bool = False) -> Any:
+        """
+        Read a page of the documents with the given field values.
+
+        :param collection: The collection to read from.
+        :param search: The values the fields must equal (e.g. ``{'no_subs': True}``).
+        :param children: If supplied, a child collection and the values the fields of a child
+         must equal (e.g. ``('movie_versions', {'disc_type': 'DVD'})``). Only the documents with at
+         least one such child, by ``video_base_id``, are read.
+        :param limit: The number of documents to read, ``0`` for all of them.
+        :param skip: The number of documents to skip.
+        :param sort_by: The name of the field to sort by, one of ``SORT_FIELDS``. Defaults to the
+         insertion order.
+        :param descending: Whether to sort in descending order.
+        :param projection: The fields to read. Defaults to all the fields.
+        :param explain: If ``True``, return a summary of the query plan instead of the documents.
+        :returns: The documents.
+        """
+        search = search or {}
+        with self._lock:
+            memory_collection = self._collection(collection)
+            if sort_by and not search:
+                # The whole collection, straight from the cached order.
+                documents, used = memory_collection.sorted(sort_by), [f'{sort_by}_sort']
+                examined = skip + limit if limit else len(documents)
+            else:
+                documents, used, examined = self._find(memory_collection, search)
+                if sort_by:
+                    documents = sorted(documents, key=sort_key(sort_by))
+            if sort_by and descending:
+                documents = documents[::-1]
+            if children is not None:
+                page, examined = self._with_children(documents, children, skip, limit)
+                used = [*used, 'video_base_id']
+            else:
+                page = documents[skip:skip + limit] if limit else documents[skip:]
+        if explain:
+            return {
+                'indexes': used,
+                'winning_plan': {'stage': 'MEMORY_INDEX' if used else 'MEMORY_SCAN'},
+                'execution_stats': {'nReturned': len(page), 'totalDocsExamined': examined},
+            }
+        return [_project(document, projection) for document in page]
+
+    def find_in(self, collection: str, field: str, values: Iterable[Any],
+                projection: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+        """
+        Read the documents with a field equal to any of the given values.
+
+        :param collection: The collection to read from.
+        :param field: The field (e.g. ``video_base_id``).
+        :param values: The values.
+        :param projection: The fields to read. Defaults to all the fields.
+        :returns: The documents, in insertion order.
+        """
+        with self._lock:
+            memory_collection = self._collection(collection)
+            documents = []
+            for value in values:
+                documents.extend(self._find(memory_collection, {field: value})[0])
+            documents.sort(key=lambda document: memory_collection._positions[document['_id']])
+        return [_project(document, projection) for document in documents]
+
+    def find_since(self, collection: str, field: str,
+                   since: Optional[datetime]) -> List[Dict[str, Any]]:
+        """
+        Read the documents with a field at or after a time, oldest first.
+
+        :param collection: The collection to read from.
+        :param field: The field holding the time.
+        :param since: The time, ``None`` to read every document.
+        :returns: The documents.
+        """
+        with self._lock:
+            memory_collection = self._collection(collection)
+            self._expire(memory_collection)
+            documents = [
+                document for document in memory_collection.documents.values()
+                if since is None or document[field] >= since]
+        return [_copied(document) for document in sorted(documents, key=lambda d: d[field])]
+
+    def _expire(self, collection: MemoryCollection):
+        """Drop the documents whose time to live has passed."""
+        field = MEMORY_TTL.get(collection.name)
+        if field is None:
+            return
+        now = datetime.utcnow()
+        for document_id in [
+                document['_id'] for document in collection.documents.values()
+                if document[field] <= now]:
+            collection.remove(document_id)
+
+    def ids_after(self, collection: str, after: Any, limit: int) -> List[Any]:
+        """
+        Get the ids of documents in id order, to go through a whole collection in batches.
+
+        :param collection: The collection to read from.
+        :param after: The id to start after, ``None`` to start from the first one.
+        :param limit: The number of ids to get.
+        :returns: The ids.
+        """
+        with self._lock:
+            ids = [document['_id'] for document in self._collection(collection).sorted('_id')]
+        start = bisect.bisect_right(ids, after) if after is not None else 0
+        return ids[start:start + limit]
+
+    def update(self, collection: str, document_id: Any, fields: Dict[str, Any],
+               search: Dict[str, Any] = None, return_after: bool = False,
+               projection: Dict[str, Any] = None) -> Optional[Dict[str, Any]]:
+        """
+        Set fields of a document.
+
+        :param collection: The collection to write to.
+        :param document_id: The id of the document.
+        :param fields: The values to set.
+        :param search: Other values the fields of the document must equal for it to be updated.
+        :param return_after: Whether to return the document as updated rather than as before.
+        :param projection: The fields to return. Defaults to all the fields.
+        :returns: The document, or ``None`` if no document was updated.
+        :raises DuplicateKeyError: If a unique field value is already taken.
+        """
+        fields = _stored(fields)
+        with self._lock:
+            memory_collection = self._collection(collection)
+            old = memory_collection.documents.get(to_id(document_id))
+            if old is None or any(field_value(old, f) != v for f, v in (search or {}).items()):
+                return None
+            new = {**old, **fields}
+            memory_collection.add(new, replacing=old)
+        return _project(new if return_after else old, projection)
+
+    def update_each(self, collection: str, updates: List[Tuple[Any, Dict[str, Any]]]):
+        """
+        Set fields of several documents.
+
+        :param collection: The collection to write to.
+        :param updates: Pairs of document id and values to set.
+        """
+        for document_id, fields in updates:
+            self.update(collection, document_id, fields)
+
+    def increment(self, collection: str, search: Dict[str, Any], deltas: Dict[str, Any],
+                  projection: Dict[str, Any] = None) -> Optional[Dict[str, Any]]:
+        """
+        Atomically increment fields of the first document with the given field values.
+
+        :param collection: The collection to write to.
+        :param search: The values the fields must equal.
+        :param deltas: The amount to change each field by.
+        :param projection: The fields to return. Defaults to all the fields.
+        :returns: The document as updated, or ``None`` if there is none.
+        """
+        with self._lock:
+            memory_collection = self._collection(collection)
+            documents, _, _ = self._find(memory_collection, search)
+            if not documents:
+                return None
+            old = documents[0]
+            new = {**old, **{field: old.get(field, 0) + delta for field, delta in deltas.items()}}
+            memory_collection.add(new, replacing=old)
+        return _project(new, projection)
+
+    def increment_stats(self, collection: str, document_id: Any, deltas: Dict[str, Any],
+                        flag_counter: Optional[str] = 'foreign_subs_version_count'):
+        """
+        Atomically apply statistic deltas to a document and recompute its ``has_foreign_subs``.
+
+        :param collection: The collection to write to.
+        :param document_id: The id of the document.
+        :param deltas: The amount to change each statistic by.
+        :param flag_counter: The counter that ``has_foreign_subs`` is derived from, ``None`` for
+        documents without the flag.
+        """
+        with self._lock:
+            memory_collection = self._collection(collection)
+            old = memory_collection.documents.get(to_id(document_id))
+            if old is None:
+                return
+            new = {**old, **{field: (old.get(field) or 0) + delta
+                             for field, delta in deltas.items()}}
+            if flag_counter is not None:
+                new['has_foreign_subs'] = (new.get(flag_counter) or 0) > 0
+            memory_collection.add(new, replacing=old)
+
+    def delete(self, collection: str, document_id: Any,
+               projection: Dict[str, Any] = None) -> Optional[Dict[str, Any]]:
+        """
+        Delete a document.
+
+        :param collection: The collection to delete from.
+        :param document_id: The id of the document.
+        :param projection: The fields to return. Defaults to all the fields.
+        :returns: The deleted document, or ``None`` if there is none.
+        """
+        with self._lock:
+            document = self._collection(collection).remove(to_id(document_id))
+        return _project(document, projection) if document is not None else None
+
+    def delete_where(self, collection: str, field: str, value: Any) -> int:
+        """
+        Delete the documents with a field equal to a value.
+
+        :param collection: The collection to delete from.
+        :param field: The field.
+        :param value: The value.
+        :returns: The number of documents deleted.
+        """
+        with self._lock:
+            memory_collection = self._collection(collection)
+            documents, _, _ = self._find(memory_collection, {field: value})
+            for document in documents:
+                memory_collection.remove(document['_id'])
+        return len(documents)
+
+    def drop(self, collection: str):
+        """
+        Delete a collection.
+
+        :param collection: The collection.
+        """
+        with self._lock:
+            self._collections.pop(collection, None)
+
+    def save_snapshot(self, path: pathlib.Path = None) -> int:
+        """
+        Save every document to a snapshot file, replacing it atomically.
+
+        The documents are listed under the lock, then encoded without it, so writes carry on while
+        the snapshot is written.
+
+        :param path: The file to write. Defaults to the snapshot file of the engine.
+        :returns: The number of documents saved.
+        """
+        path = path or self.snapshot_file
+        with self._lock:
+            collections = [
+                (name, list(collection.documents.values()))
+                for name, collection in self._collections.items()]
+        start = time.perf_counter()
+        temporary = path.with_name(f'{path.name}.tmp')
+        count = 0
+        with temporary.open('wb') as f:
+            for name, documents in collections:
+                for document in documents:
+                    f.write(bson.encode({'collection': name, 'document': document}))
+                    count += 1
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+        LOGGER.info('Saved %s documents to %s in %.3fs.', count, path, time.perf_counter() - start)
+        return count
+
+    def load_snapshot(self, path: pathlib.Path) -> int:
+        """
+        Load the documents of a snapshot file, on top of the documents already in memory.
+
+        :param path: The file to read.
+        :returns: The number of documents loaded.
+        """
+        start = time.perf_counter()
+        count = 0
+        with path.open('rb') as f, self._lock:
+            for record in bson.decode_file_iter(f):
+                memory_collection = self._collection(record['collection'])
+                document = record['document']
+                memory_collection.add(
+                    document, replacing=memory_collection.documents.get(document['_id']))
+                count += 1
+        LOGGER.info('Loaded %s documents from %s in %.3fs.', count, path,
+                    time.perf_counter() - start)
+        return count
+
+
+async def save_snapshots(engine: MemoryEngine, interval: float):
+    """
+    Keep saving snapshots of a memory engine, forever.
+
+    :param engine: The engine to save.
+    :param interval: How long to wait between snapshots, in seconds.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_in_executor(engine.save_snapshot)
+        except OSError as e:
+            LOGGER.warning('Unable to save a snapshot to %s: %s', engine.snapshot_file, e)
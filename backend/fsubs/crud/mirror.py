@@ -0,0 +1,423 @@
+"""
+Read-only snapshots of the catalog, served from a memory-mapped file by mirror replicas.
+
+A snapshot holds every movie, movie version, tv show and tv show episode as the JSON the API
+responds with, so a mirror sends slices of the file as they are. The file is laid out as:
+
+* A header: the magic bytes, the format version, the number of tables and when it was built.
+* A directory with the name, offset and number of entries of each table.
+* The JSON of the documents. The versions of a movie (and the episodes of a tv show) are written
+  as a single JSON array, and each of them is a slice of that array.
+* The tables. A record table maps ids to the offset and length of their JSON, with the ids
+  sorted so they can be binary searched. An order table lists the positions of the records in
+  the order of a sort field.
+
+Integers are little endian. The file is built to a temporary file then renamed, so replicas can
+reload it while it is rebuilt.
+"""
+
+import bisect
+import json
+import logging
+import mmap
+import os
+import pathlib
+import struct
+import sys
+import time
+from array import array
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from bson.objectid import ObjectId
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel, ValidationError
+
+from fsubs.crud.memory import sort_key
+from fsubs.crud.queries import SORT_FIELDS
+from fsubs.models.tvshow import TVShowEpisodeInDB, TVShowInDB
+from fsubs.models.video import VideoBaseInDB, VideoInstanceInDB
+
+LOGGER = logging.getLogger(__name__)
+
+MIRROR_MAGIC = b'FSUBSMIR'
+MIRROR_VERSION = 1
+
+# Magic, format version, number of tables and build time in milliseconds since the epoch.
+HEADER = struct.Struct('<8sIIQ')
+# Name, offset and number of entries.
+TABLE = struct.Struct('<32sQQ')
+ID_SIZE = 12
+
+# The title collections, with their child collection and the response model of each.
+TITLES = {
+    'movies': ('movie_versions', VideoBaseInDB, VideoInstanceInDB),
+    'tv_shows': ('tv_show_episodes', TVShowInDB, TVShowEpisodeInDB),
+}
+
+
+def children_table(collection: str) -> str:
+    """Get the name of the table of the child lists of a title collection."""
+    return f'{collection}:children'
+
+
+def order_table(collection: str, sort_by: str) -> str:
+    """Get the name of the table of a title collection in the order of a sort field."""
+    return f'{collection}:order:{sort_by}'
+
+
+def _table_names() -> List[str]:
+    """List the tables of a snapshot, in the order of its directory."""
+    names = []
+    for collection, (child_collection, _, _) in TITLES.items():
+        names.extend((collection, child_collection, children_table(collection)))
+        names.extend(order_table(collection, sort_by) for sort_by in SORT_FIELDS)
+    return names
+
+
+def _binary_id(document_id: Any) -> Optional[bytes]:
+    """Get the 12 bytes of an ``ObjectId``, or ``None`` if it isn't one."""
+    if isinstance(document_id, ObjectId):
+        return document_id.binary
+    if isinstance(document_id, str) and ObjectId.is_valid(document_id):
+        return ObjectId(document_id).binary
+    return None
+
+
+def _aligned(offset: int) -> int:
+    """Round an offset up to a multiple of 8."""
+    return (offset + 7) & ~7
+
+
+class _Ids():
+    """The sorted ids of a record table, as a sequence ``bisect`` can search."""
+
+    def __init__(self, view: memoryview):
+        self._view = view
+
+    def __len__(self) -> int:
+        return len(self._view) // ID_SIZE
+
+    def __getitem__(self, position: int) -> bytes:
+        start = position * ID_SIZE
+        return bytes(self._view[start:start + ID_SIZE])
+
+
+class RecordTable():
+    """A table of records of a snapshot, looked up by id."""
+
+    def __init__(self, view: memoryview, offset: int, count: int):
+        """
+        Initialize a ``RecordTable``.
+
+        :param view: The whole snapshot.
+        :param offset: The offset of the table.
+        :param count: The number of records.
+        """
+        self._view = view
+        self._ids = _Ids(view[offset:offset + count * ID_SIZE])
+        offset = _aligned(offset + count * ID_SIZE)
+        self._offsets = view[offset:offset + count * 8].cast('Q')
+        offset += count * 8
+        self._lengths = view[offset:offset + count * 4].cast('I')
+
+    def __len__(self) -> int:
+        """Get the number of records."""
+        return len(self._offsets)
+
+    def at(self, position: int) -> memoryview:
+        """
+        Get the JSON of a record by position in id order, without copying it.
+
+        :param position: The position.
+        :returns: The JSON.
+        """
+        offset = self._offsets[position]
+        return self._view[offset:offset + self._lengths[position]]
+
+    def get(self, document_id: Any) -> Optional[memoryview]:
+        """
+        Get the JSON of a record by id, without copying it.
+
+        :param document_id: The id, as a string or an ``ObjectId``.
+        :returns: The JSON, or ``None`` if there is no record with this id.
+        """
+        key = _binary_id(document_id)
+        if key is None:
+            return None
+        position = bisect.bisect_left(self._ids, key)
+        if position == len(self) or self._ids[position] != key:
+            return None
+        return self.at(position)
+
+
+class MirrorSnapshot():
+    """
+    A snapshot of the catalog, memory-mapped from its file.
+
+    Lookups return ``memoryview`` slices of the file: nothing is read or copied until a response
+    is sent, and the pages are shared by every process mapping the same file.
+    """
+
+    def __init__(self, path):
+        """
+        Open a ``MirrorSnapshot``.
+
+        :param path: The file to map.
+        :raises ValueError: If the file is not a snapshot this version of fsubs can read.
+        """
+        if sys.byteorder != 'little':
+            raise ValueError('Snapshots can only be mapped on little endian hosts.')
+        self.path = pathlib.Path(path)
+        with self.path.open('rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        if len(view) < HEADER.size:
+            raise ValueError(f'{self.path} is not a snapshot.')
+        magic, version, table_count, built_ms = HEADER.unpack_from(view)
+        if magic != MIRROR_MAGIC:
+            raise ValueError(f'{self.path} is not a snapshot.')
+        if version != MIRROR_VERSION:
+            raise ValueError(
+                f'{self.path} is a version {version} snapshot, expected version {MIRROR_VERSION}.')
+        self.built_at = datetime.fromtimestamp(built_ms / 1000, tz=timezone.utc)
+        self._tables = {}
+        for index in range(table_count):
+            name, offset, count = TABLE.unpack_from(view, HEADER.size + index * TABLE.size)
+            self._tables[name.rstrip(b'\0').decode()] = (offset, count)
+        self._view = view
+        self._records = {
+            name: RecordTable(view, *self._tables[name])
+            for name in self._tables if ':order:' not in name}
+        self._orders = {
+            name: view[offset:offset + count * 4].cast('I')
+            for name, (offset, count) in self._tables.items() if ':order:' in name}
+
+    def counts(self) -> Dict[str, int]:
+        """
+        Get the number of documents of each collection.
+
+        :returns: The counts.
+        """
+        return {
+            collection: len(self._records[collection])
+            for title_collection, (child_collection, _, _) in TITLES.items()
+            for collection in (title_collection, child_collection)}
+
+    def get(self, collection: str, document_id: Any) -> Optional[memoryview]:
+        """
+        Get the JSON of a document.
+
+        :param collection: The collection (e.g. ``movie_versions``).
+        :param document_id: The id of the document.
+        :returns: The JSON, or ``None`` if there is no such document.
+        """
+        return self._records[collection].get(document_id)
+
+    def children(self, collection: str, document_id: Any) -> Optional[memoryview]:
+        """
+        Get the JSON array of the versions of a movie or the episodes of a tv show.
+
+        :param collection: The title collection (``movies`` or ``tv_shows``).
+        :param document_id: The id of the title.
+        :returns: The JSON array, or ``None`` if the title has none.
+        """
+        return self._records[children_table(collection)].get(document_id)
+
+    def titles(self, collection: str, skip: int = 0, limit: int = 0,
+               sort_by: Optional[str] = None, descending: bool = False,
+               keep: Callable[[memoryview], bool] = None) -> List[memoryview]:
+        """
+        Get a page of the JSON of the titles of a collection.
+
+        Without ``keep`` only the records of the page are looked at. With it, the titles are gone
+        through in order until the page is full.
+
+        :param collection: The title collection (``movies`` or ``tv_shows``).
+        :param skip: The number of titles to skip.
+        :param limit: The number of titles to get, ``0`` for all of them.
+        :param sort_by: The name of the field to sort by, one of ``SORT_FIELDS``. Defaults to the
+         order of the ids.
+        :param descending: Whether to sort in descending order.
+        :param keep: If supplied, only get the titles whose JSON it returns ``True`` for.
+        :returns: The JSON of the titles.
+        """
+        records = self._records[collection]
+        positions = self._orders[order_table(collection, sort_by)] if sort_by else None
+        if positions is None:
+            positions = range(len(records))
+        if sort_by and descending:
+            positions = positions[::-1]
+        if keep is None:
+            stop = skip + limit if limit else None
+            return [records.at(position) for position in positions[skip:stop]]
+        page = []
+        for position in positions:
+            record = records.at(position)
+            if not keep(record):
+                continue
+            if skip:
+                skip -= 1
+                continue
+            page.append(record)
+            if len(page) == limit:
+                break
+        return page
+
+    def close(self):
+        """Unmap the file, once no slice of it is in use anymore."""
+        self._orders.clear()
+        self._records.clear()
+        self._view.release()
+        self._mmap.close()
+
+
+def encode(model: BaseModel, document: Dict[str, Any]) -> bytes:
+    """
+    Encode a document as the JSON the API responds with.
+
+    :param model: The response model of the document.
+    :param document: The document, with its ``_id``.
+    :returns: The JSON.
+    :raises ValidationError: If the document doesn't fit the model.
+    """
+    document = dict(document)
+    document['id'] = str(document.pop('_id'))
+    # The same encoding as FastAPI's JSONResponse.
+    return json.dumps(
+        jsonable_encoder(model(**document)),
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(',', ':'),
+    ).encode('utf-8')
+
+
+class _Writer():
+    """Writes the documents of a snapshot, keeping the entries of its tables."""
+
+    def __init__(self, f):
+        self.f = f
+        self.entries: Dict[str, List[Tuple[bytes, int, int]]] = defaultdict(list)
+        self.sort_keys: Dict[str, Dict[str, List[Tuple]]] = defaultdict(lambda: defaultdict(list))
+        self.skipped = Counter()
+
+    def write(self, data: bytes) -> int:
+        """Write data, returning its offset."""
+        offset = self.f.tell()
+        self.f.write(data)
+        return offset
+
+    def encode(self, collection: str, model: BaseModel,
+               document: Dict[str, Any]) -> Optional[bytes]:
+        """Encode a document, skipping the ones the API couldn't respond with."""
+        try:
+            return encode(model, document)
+        except ValidationError as e:
+            LOGGER.warning('Skipping %s %s: %s', collection, document.get('_id'), e)
+            self.skipped[collection] += 1
+            return None
+
+    def add_title(self, collection: str, document: Dict[str, Any],
+                  children: List[Dict[str, Any]]):
+        """Write a title and its children."""
+        child_collection, model, child_model = TITLES[collection]
+        data = self.encode(collection, model, document)
+        if data is None:
+            return
+        self.entries[collection].append((document['_id'].binary, self.write(data), len(data)))
+        for sort_by in SORT_FIELDS:
+            self.sort_keys[collection][sort_by].append(sort_key(sort_by)(document))
+        encoded = []
+        for child in children:
+            child_data = self.encode(child_collection, child_model, child)
+            if child_data is not None:
+                encoded.append((child['_id'].binary, child_data))
+        if not encoded:
+            return
+        offset = self.write(b'[' + b','.join(data for _, data in encoded) + b']')
+        self.entries[children_table(collection)].append(
+            (document['_id'].binary, offset, self.f.tell() - offset))
+        # Each child is a slice of the array, after the opening bracket and the previous commas.
+        child_offset = offset + 1
+        for child_id, child_data in encoded:
+            self.entries[child_collection].append((child_id, child_offset, len(child_data)))
+            child_offset += len(child_data) + 1
+
+    def write_tables(self) -> Dict[str, Tuple[int, int]]:
+        """Write the tables after the documents, returning their offsets and counts."""
+        tables = {}
+        for name in _table_names():
+            self.f.write(b'\0' * (_aligned(self.f.tell()) - self.f.tell()))
+            if ':order:' in name:
+                collection, _, sort_by = name.split(':')
+                ids = sorted(entry[0] for entry in self.entries[collection])
+                positions = {document_id: position for position, document_id in enumerate(ids)}
+                # The keys end with the id, which breaks ties.
+                keys = sorted(self.sort_keys[collection][sort_by])
+                tables[name] = (self.f.tell(), len(keys))
+                self.f.write(array('I', (positions[key[-1].binary] for key in keys)).tobytes())
+                continue
+            entries = sorted(self.entries[name])
+            tables[name] = (self.f.tell(), len(entries))
+            self.f.write(b''.join(entry[0] for entry in entries))
+            self.f.write(b'\0' * (_aligned(self.f.tell()) - self.f.tell()))
+            self.f.write(array('Q', (entry[1] for entry in entries)).tobytes())
+            self.f.write(array('I', (entry[2] for entry in entries)).tobytes())
+        return tables
+
+
+def build_mirror(engine, path, batch_size: int = 500) -> Counter:
+    """
+    Build a snapshot of the catalog of a storage engine.
+
+    The titles are read in batches of ids, each with its children in a single query.
+
+    :param engine: The storage engine to read from (see ``fsubs.crud.db.get_engine``).
+    :param path: The file to write.
+    :param batch_size: The number of titles per batch.
+    :returns: The number of documents written, per collection.
+    """
+    start = time.perf_counter()
+    path = pathlib.Path(path)
+    temporary = path.with_name(f'{path.name}.tmp')
+    names = _table_names()
+    with temporary.open('wb') as f:
+        f.write(b'\0' * (HEADER.size + len(names) * TABLE.size))
+        writer = _Writer(f)
+        for collection, (child_collection, _, _) in TITLES.items():
+            after = None
+            while True:
+                title_ids = engine.ids_after(collection, after, batch_size)
+                if not title_ids:
+                    break
+                after = title_ids[-1]
+                titles = sorted(
+                    engine.get_many(collection, title_ids), key=lambda title: title['_id'])
+                children = defaultdict(list)
+                parent_ids = [str(title_id) for title_id in title_ids]
+                for child in engine.find_in(child_collection, 'video_base_id', parent_ids):
+                    children[child['video_base_id']].append(child)
+                for title in titles:
+                    writer.add_title(collection, title, children[str(title['_id'])])
+            LOGGER.info('Wrote %s %s and %s %s.', len(writer.entries[collection]), collection,
+                        len(writer.entries[child_collection]), child_collection)
+        tables = writer.write_tables()
+        f.seek(0)
+        f.write(HEADER.pack(MIRROR_MAGIC, MIRROR_VERSION, len(names), int(time.time() * 1000)))
+        for name in names:
+            f.write(TABLE.pack(name.encode(), *tables[name]))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+    counts = Counter({
+        collection: len(writer.entries[collection])
+        for title_collection, (child_collection, _, _) in TITLES.items()
+        for collection in (title_collection, child_collection)})
+    if writer.skipped:
+        LOGGER.warning('Skipped documents the API could not respond with: %s.',
+                       dict(writer.skipped))
+    LOGGER.info('Built a snapshot of %s documents in %s in %.1fs.',
+                sum(counts.values()), path, time.perf_counter() - start)
+    return counts
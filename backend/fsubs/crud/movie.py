@@ -1,25 +1,31 @@
 """CRUD functions for movies."""
 
 import logging
-from typing import Any, Dict, List
-
-from bson.objectid import ObjectId
+from typing import Any, Dict, List, Optional
 
+from fsubs.crud.queries import TITLE_INDEXES, VERSION_INDEXES, find_by_ids, projection_key
+from fsubs.crud.stats import VERSION_STATS
 from fsubs.models.video import VideoBaseInDB, VideoInstanceInDB
+from fsubs.utils.metrics import instrument
+from fsubs.utils.singleflight import BatchLoader, SingleFlight
+from fsubs.utils.videos import version_stats
 
 LOGGER = logging.getLogger(__name__)
 
 
+@instrument
 class MovieDAO():
     """The DAO for interacting with movies."""
 
-    def __init__(self, client):
+    def __init__(self, engine):
         """
         Initialize a ``MovieDAO``.
 
-        :param client: The MongoClient object to use for the DAO.
+        :param engine: The storage engine to use for the DAO (see ``fsubs.crud.db.get_engine``).
         """
-        self.client = client
+        self.engine = engine
+        self._reads = SingleFlight()
+        self._loader = BatchLoader(self._find_many)
 
     async def create(self, movie: VideoBaseInDB) -> str:
         """
@@ -28,37 +34,94 @@ class MovieDAO():
         :param movie: The ``VideoBaseInDB`` object representing the movie to create.
         :returns: The id of the newly created movie.
         """
-        LOGGER.debug(f'Creating movie: <{VideoBaseInDB}>.')
-        return self.client.foreign_subs.movies.insert_one(movie).inserted_id
+        LOGGER.debug('Creating movie: <%s>.', VideoBaseInDB)
+        movie = {**movie, **VERSION_STATS}
+        return self.engine.insert('movies', movie)
 
-    async def read(self, movie_id: str) -> Dict[str, Any]:
+    async def read(self, movie_id: str, projection: Dict[str, Any] = None) -> Dict[str, Any]:
         """
         Read a movie.
 
+        Concurrent reads of the same movie share a single query.
+
         :param movie_id: The id of the movie to read.
+        :param projection: The fields to read. Defaults to all the fields.
         :returns: Dict representing the movie.
         """
-        LOGGER.debug(f'Reading movie: <{movie_id}>.')
-        movie = self.client.foreign_subs.movies.find_one({'_id': ObjectId(movie_id)})
-        if movie:
-            movie['id'] = str(movie.pop('_id'))
-        return movie
+        LOGGER.debug('Reading movie: <%s>.', movie_id)
+        return await self._reads.do(
+            ('read', str(movie_id), projection_key(projection)),
+            self._find_one, movie_id, projection)
+
+    async def load(self, movie_id: str) -> Dict[str, Any]:
+        """
+        Read a movie as part of a batch.
+
+        All the movies loaded within the same event loop tick are read with a single query.
+
+        :param movie_id: The id of the movie to read.
+        :returns: Dict representing the movie.
+        """
+        LOGGER.debug('Loading movie: <%s>.', movie_id)
+        return await self._loader.load(str(movie_id))
+
+    async def read_many(self, movie_ids: List[str],
+                        projection: Dict[str, Any] = None) -> List[Optional[Dict[str, Any]]]:
+        """
+        Read several movies by id.
+
+        :param movie_ids: The ids of the movies to read.
+        :param projection: The fields to read. Defaults to all the fields.
+        :returns: The movies in the same order as the ids, with ``None`` for missing movies.
+        """
+        LOGGER.debug('Reading movies: <%s>.', movie_ids)
+        movies = find_by_ids(self.engine, 'movies', movie_ids, projection=projection)
+        return [movies.get(movie_id) for movie_id in movie_ids]
 
-    async def read_multi(self, limit=100, skip=0) -> List[Dict[str, Any]]:
+    async def read_multi(self, limit=100, skip=0, search=None, version_search=None, sort_by=None,
+                         descending=False, explain=False,
+                         projection=None) -> List[Dict[str, Any]]:
         """
         Read multiple movies.
 
         :param limit: The number of movies to read.
         :param skip: The number of movies to skip.
+        :param search: The values the fields of the movies must equal (e.g.
+         ``{'no_subs': True}``).
+        :param version_search: If supplied, only read movies that have at least one version
+         matching this filter (e.g. ``{'disc_type': 'DVD'}``).
+        :param sort_by: The name of the field to sort by (``title``, ``date_created`` or
+         ``last_modified``). Defaults to the natural order.
+        :param descending: Whether to sort in descending order.
+        :param explain: If ``True``, return a summary of the query plan instead of the movies.
+        :param projection: The fields to read. Defaults to all the fields.
         :returns: A list of Dicts representing movies.
         """
-        LOGGER.debug(f'Reading all movies with limit: <{limit}> and skip: <{skip}>.')
-        movies = self.client.foreign_subs.movies.find().skip(skip).limit(limit)
-        movies = list(movies)
+        LOGGER.debug('Reading all movies with limit: <%s>, skip: <%s>, search: <%s>, '
+                     'version_search: <%s> and sort_by: <%s>.',
+                     limit, skip, search, version_search, sort_by)
+        movies = self.engine.find(
+            'movies',
+            search=search,
+            children=('movie_versions', version_search) if version_search else None,
+            limit=limit,
+            skip=skip,
+            sort_by=sort_by,
+            descending=descending,
+            projection=projection,
+            explain=explain)
+        if explain:
+            return movies
         for movie in movies:
             movie['id'] = str(movie.pop('_id'))
         return movies
 
+    async def ensure_indexes(self):
+        """Create the indexes used by movie and movie version queries if they don't exist."""
+        LOGGER.debug('Ensuring movie indexes.')
+        self.engine.ensure_indexes('movies', TITLE_INDEXES)
+        self.engine.ensure_indexes('movie_versions', VERSION_INDEXES)
+
     async def update(self, movie_id: str, movie: VideoBaseInDB):
         """
         Update a movie.
@@ -66,8 +129,8 @@ class MovieDAO():
         :param movie_id: The id of the movie to update.
         :param movie: The movie data to update with.
         """
-        LOGGER.debug(f'Updating movie with uri: <{movie_id}> and movie: <{movie}>.')
-        self.client.foreign_subs.movies.update({'_id': ObjectId(movie_id)}, {'$set': movie})
+        LOGGER.debug('Updating movie with uri: <%s> and movie: <%s>.', movie_id, movie)
+        self.engine.update('movies', movie_id, movie)
 
     async def delete(self, movie_id: str):
         """
@@ -75,61 +138,118 @@ class MovieDAO():
 
         :param movie_id: The id of the movie to delete.
         """
-        LOGGER.debug(f'Deleting movie: <{movie_id}>.')
-        self.client.foreign_subs.movies.delete_one({'_id': ObjectId(movie_id)})
+        LOGGER.debug('Deleting movie: <%s>.', movie_id)
+        self.engine.delete('movies', movie_id, projection={'_id': True})
 
     async def create_version(self, movie_version: VideoInstanceInDB) -> str:
         """
         Create a movie version.
 
+        Also updates the version statistics of the movie the version belongs to.
+
         :param movie_version: A dict representing the movie version.
         :returns: The id of the newly created movie version.
         """
-        LOGGER.debug(f'Creating movie version: <{movie_version}>.')
-        return self.client.foreign_subs.movie_versions.insert_one(movie_version).inserted_id
+        LOGGER.debug('Creating movie version: <%s>.', movie_version)
+        stats = version_stats(movie_version.get('timestamps'))
+        movie_version = {**movie_version, **stats}
+        movie_version_id = self.engine.insert('movie_versions', movie_version)
+        self._update_movie_stats(
+            movie_id=movie_version['video_base_id'],
+            version_count=1,
+            foreign_subs_version_count=int(stats['cue_count'] > 0),
+            **stats)
+        return movie_version_id
 
-    async def read_version(self, movie_version_id: str) -> Dict[str, Any]:
+    async def read_version(self, movie_version_id: str,
+                           projection: Dict[str, Any] = None) -> Dict[str, Any]:
         """
         Read a movie version.
 
         :param movie_version_id: The id of the movie to read.
+        :param projection: The fields to read. Defaults to all the fields.
         :returns: Dict representing the movie version.
         """
-        LOGGER.debug(f'Reading movie version: <{movie_version_id}>.')
-        movie_version = self.client.foreign_subs.movie_versions.find_one(
-            {'_id': ObjectId(movie_version_id)})
+        LOGGER.debug('Reading movie version: <%s>.', movie_version_id)
+        movie_version = self.engine.get('movie_versions', movie_version_id, projection=projection)
         if movie_version:
             movie_version['id'] = str(movie_version.pop('_id'))
         return movie_version
 
-    async def read_movie_versions(self, movie_id: str) -> Dict[str, Any]:
+    async def read_versions(self, movie_version_ids: List[str],
+                            projection: Dict[str, Any] = None) -> List[Optional[Dict[str, Any]]]:
+        """
+        Read several movie versions by id.
+
+        :param movie_version_ids: The ids of the movie versions to read.
+        :param projection: The fields to read. Defaults to all the fields.
+        :returns: The movie versions in the same order as the ids, with ``None`` for missing
+         movie versions.
+        """
+        LOGGER.debug('Reading movie versions: <%s>.', movie_version_ids)
+        movie_versions = find_by_ids(
+            self.engine, 'movie_versions', movie_version_ids, projection=projection)
+        return [movie_versions.get(movie_version_id) for movie_version_id in movie_version_ids]
+
+    async def read_movie_versions(self, movie_id: str,
+                                  projection: Dict[str, Any] = None) -> Dict[str, Any]:
         """
         Read all the versions of a movie.
 
+        Concurrent reads of the versions of the same movie share a single query.
+
         :param movie_id: The id of the movie to read versions for.
+        :param projection: The fields to read. Defaults to all the fields.
         :returns: List of movie versions.
         """
-        LOGGER.debug(f'Reading movie versions for: <{movie_id}>.')
-        movie_versions = self.client.foreign_subs.movie_versions.find(
-            {'video_base_id': str(movie_id)})
-        versions = []
-        for v in movie_versions:
-            v['id'] = str(v.pop('_id'))
-            versions.append(v)
-        return versions
+        LOGGER.debug('Reading movie versions for: <%s>.', movie_id)
+        return await self._reads.do(
+            ('read_movie_versions', str(movie_id), projection_key(projection)),
+            self._find_movie_versions, movie_id, projection)
 
-    async def update_version(self, movie_version_id: str, movie_version) -> VideoInstanceInDB:
+    async def update_version(self, movie_version_id: str, movie_version) -> Dict[str, Any]:
         """
         Update a movie version.
 
+        If the version is moved to another movie (a new ``video_base_id``), its statistics are
+        moved from the old movie to the new one.
+
         :param movie_version_id: The id of the movie version to update.
         :param movie_version: The movie version data to update with.
+        :returns: Dict representing the updated movie version, or ``None`` if it doesn't exist.
         """
-        LOGGER.debug(f'Updating movie version with uri: <{movie_version_id}> and movie_version: '
-                     f'<{movie_version}>.')
-        self.client.foreign_subs.movie_versions.update(
-            {'_id': ObjectId(movie_version_id)},
-            {'$set': movie_version})
+        LOGGER.debug('Updating movie version with uri: <%s> and movie_version: <%s>.',
+                     movie_version_id, movie_version)
+        stats = version_stats(movie_version.get('timestamps'))
+        old_movie_version = self.engine.update(
+            'movie_versions', movie_version_id, {**movie_version, **stats})
+        if not old_movie_version:
+            return None
+        # Build the updated document from the old one rather than reading it back.
+        updated_movie_version = {**old_movie_version, **movie_version, **stats}
+        updated_movie_version['id'] = str(updated_movie_version.pop('_id'))
+        old_cue_count = old_movie_version.get('cue_count', 0)
+        old_movie_id = old_movie_version['video_base_id']
+        if updated_movie_version['video_base_id'] != old_movie_id:
+            self._update_movie_stats(
+                movie_id=old_movie_id,
+                version_count=-1,
+                foreign_subs_version_count=-int(old_cue_count > 0),
+                cue_count=-old_cue_count,
+                subs_duration=-old_movie_version.get('subs_duration', 0))
+            self._update_movie_stats(
+                movie_id=updated_movie_version['video_base_id'],
+                version_count=1,
+                foreign_subs_version_count=int(stats['cue_count'] > 0),
+                **stats)
+        elif (old_cue_count != stats['cue_count']
+                or old_movie_version.get('subs_duration', 0) != stats['subs_duration']):
+            self._update_movie_stats(
+                movie_id=old_movie_id,
+                foreign_subs_version_count=int(stats['cue_count'] > 0) - int(old_cue_count > 0),
+                cue_count=stats['cue_count'] - old_cue_count,
+                subs_duration=stats['subs_duration'] - old_movie_version.get('subs_duration', 0))
+        return updated_movie_version
 
     async def delete_version(self, movie_version_id: str):
         """
@@ -137,8 +257,19 @@ class MovieDAO():
 
         :param movie_version_id: The id of the movie version to delete.
         """
-        LOGGER.debug(f'Deleting movie version: <{movie_version_id}>.')
-        self.client.foreign_subs.movie_versions.delete_one({'_id': ObjectId(movie_version_id)})
+        LOGGER.debug('Deleting movie version: <%s>.', movie_version_id)
+        movie_version = self.engine.delete(
+            'movie_versions', movie_version_id,
+            projection={'video_base_id': True, 'cue_count': True, 'subs_duration': True})
+        if not movie_version:
+            return
+        cue_count = movie_version.get('cue_count', 0)
+        self._update_movie_stats(
+            movie_id=movie_version['video_base_id'],
+            version_count=-1,
+            foreign_subs_version_count=-int(cue_count > 0),
+            cue_count=-cue_count,
+            subs_duration=-movie_version.get('subs_duration', 0))
 
     async def delete_movie_versions(self, movie_id: str):
         """
@@ -146,5 +277,80 @@ class MovieDAO():
 
         :param movie_id: The id of the movie to delete with.
         """
-        LOGGER.debug(f'Deleting movie version for: <{movie_id}>.')
-        self.client.foreign_subs.movie_versions.delete_many({'video_base_id': str(movie_id)})
+        LOGGER.debug('Deleting movie version for: <%s>.', movie_id)
+        self.engine.delete_where('movie_versions', 'video_base_id', str(movie_id))
+        self.engine.update('movies', movie_id, VERSION_STATS, projection={'_id': True})
+
+    async def backfill_stats(self, batch_size: int = 500) -> int:
+        """
+        Recompute the version statistics of every movie and movie version.
+
+        Movies are processed in batches ordered by id, reading the versions of each batch with a
+        single query and writing the results back with bulk writes.
+
+        :param batch_size: The number of movies to process per batch.
+        :returns: The number of movies processed.
+        """
+        LOGGER.debug('Backfilling movie stats with batch size: <%s>.', batch_size)
+        processed = 0
+        last_id = None
+        while True:
+            movie_ids = self.engine.ids_after('movies', last_id, batch_size)
+            if not movie_ids:
+                return processed
+            last_id = movie_ids[-1]
+
+            totals = {str(movie_id): dict(VERSION_STATS) for movie_id in movie_ids}
+            version_updates = []
+            movie_versions = self.engine.find_in(
+                'movie_versions', 'video_base_id', list(totals),
+                projection={'video_base_id': True, 'timestamps': True})
+            for movie_version in movie_versions:
+                stats = version_stats(movie_version.get('timestamps'))
+                version_updates.append((movie_version['_id'], stats))
+                movie_totals = totals[movie_version['video_base_id']]
+                movie_totals['version_count'] += 1
+                movie_totals['foreign_subs_version_count'] += int(stats['cue_count'] > 0)
+                movie_totals['cue_count'] += stats['cue_count']
+                movie_totals['subs_duration'] += stats['subs_duration']
+            self.engine.update_each('movie_versions', version_updates)
+
+            movie_updates = []
+            for movie_id, movie_totals in totals.items():
+                movie_totals['has_foreign_subs'] = movie_totals['foreign_subs_version_count'] > 0
+                movie_totals['subs_duration'] = round(movie_totals['subs_duration'], 3)
+                movie_updates.append((movie_id, movie_totals))
+            self.engine.update_each('movies', movie_updates)
+            processed += len(movie_ids)
+            LOGGER.info('Backfilled stats for %s movies.', processed)
+
+    def _find_one(self, movie_id: str, projection: Dict[str, Any] = None) -> Dict[str, Any]:
+        """Query a single movie."""
+        movie = self.engine.get('movies', movie_id, projection=projection)
+        if movie:
+            movie['id'] = str(movie.pop('_id'))
+        return movie
+
+    def _find_many(self, movie_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Query several movies at once, keyed by id."""
+        return find_by_ids(self.engine, 'movies', movie_ids)
+
+    def _find_movie_versions(self, movie_id: str,
+                             projection: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+        """Query all the versions of a movie."""
+        movie_versions = self.engine.find_in(
+            'movie_versions', 'video_base_id', [str(movie_id)], projection=projection)
+        versions = []
+        for v in movie_versions:
+            v['id'] = str(v.pop('_id'))
+            versions.append(v)
+        return versions
+
+    def _update_movie_stats(self, movie_id: str, **deltas):
+        """
+        Atomically apply version statistic deltas to a movie.
+
+        :param movie_id: The id of the movie to update.
+        :param deltas: The amount to change each statistic by.
+        """
+        self.engine.increment_stats('movies', movie_id, deltas)
@@ -0,0 +1,225 @@
+"""Shared query, sort and index definitions for title collections."""
+
+import itertools
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.collation import Collation, CollationStrength
+
+from fsubs.utils.deadlines import max_time_ms
+
+# Case-insensitive ordering used for sorting by title.
+TITLE_COLLATION = Collation(locale='en', strength=CollationStrength.SECONDARY)
+
+SORT_FIELDS = {
+    'title': 'title',
+    'date_created': 'metadata.date_created',
+    'last_modified': 'metadata.last_modified',
+}
+
+# Equality filters supported on title collections. Every combination of them is paired with every
+# sort field.
+FILTER_FIELDS = ('no_subs', 'metadata.created_by')
+
+VERSION_FILTER_FIELDS = ('disc_type', 'region', 'sub_type')
+
+
+def _title_indexes() -> List[IndexModel]:
+    """
+    Build the indexes backing every supported filter and sort combination on a title collection.
+
+    Each index puts the equality filters before the sort field so a filtered and sorted page never
+    needs an in-memory sort. ``_id`` is the tie breaker to keep pagination stable.
+
+    :returns: The indexes to create.
+    """
+    indexes = []
+    for sort_name, sort_field in SORT_FIELDS.items():
+        options = {'collation': TITLE_COLLATION} if sort_name == 'title' else {}
+        for count in range(len(FILTER_FIELDS) + 1):
+            for filter_fields in itertools.combinations(FILTER_FIELDS, count):
+                keys = [
+                    *((filter_field, ASCENDING) for filter_field in filter_fields),
+                    (sort_field, ASCENDING),
+                    ('_id', ASCENDING),
+                ]
+                name = '_'.join(
+                    [*(field.split('.')[-1] for field in filter_fields), sort_name, 'sort'])
+                indexes.append(IndexModel(keys, name=name, **options))
+    return indexes
+
+
+TITLE_INDEXES = _title_indexes()
+
+
+def _version_indexes() -> List[IndexModel]:
+    """
+    Build the indexes backing every supported filter combination on the versions of a title.
+
+    Versions are only ever looked up by the title they belong to, so each index starts with
+    ``video_base_id``, followed by the equality filters. ``title_pipeline`` only projects
+    ``video_base_id`` out of the matching version, so its lookups read the index only.
+
+    :returns: The indexes to create.
+    """
+    indexes = []
+    for count in range(len(VERSION_FILTER_FIELDS) + 1):
+        for filter_fields in itertools.combinations(VERSION_FILTER_FIELDS, count):
+            keys = [('video_base_id', ASCENDING),
+                    *((filter_field, ASCENDING) for filter_field in filter_fields)]
+            indexes.append(IndexModel(keys, name='_'.join(['video_base_id', *filter_fields])))
+    return indexes
+
+
+VERSION_INDEXES = _version_indexes()
+
+
+def sort_spec(sort_by: Optional[str], descending: bool = False) -> Optional[List[Tuple[str, int]]]:
+    """
+    Get the pymongo sort specification for a sort field.
+
+    :param sort_by: The name of the field to sort by, one of ``SORT_FIELDS``. ``None`` keeps the
+    natural order.
+    :param descending: Whether to sort in descending order.
+    :returns: The sort specification, or ``None`` if not sorting.
+    """
+    if not sort_by:
+        return None
+    direction = DESCENDING if descending else ASCENDING
+    return [(SORT_FIELDS[sort_by], direction), ('_id', direction)]
+
+
+def find_titles(collection, search: Dict[str, Any], limit: int, skip: int,
+                sort_by: Optional[str] = None, descending: bool = False,
+                projection: Optional[Dict[str, Any]] = None):
+    """
+    Build a cursor over a title collection.
+
+    The title collation is only used when sorting by title so that the other sorts can use
+    their (non collated) indexes.
+
+    :param collection: The pymongo collection to query.
+    :param search: The filter to apply.
+    :param limit: The number of documents to read.
+    :param skip: The number of documents to skip.
+    :param sort_by: The name of the field to sort by.
+    :param descending: Whether to sort in descending order.
+    :param projection: The fields to read. Defaults to all the fields.
+    :returns: The pymongo cursor.
+    """
+    options = {'projection': projection, 'max_time_ms': max_time_ms()}
+    if sort_by:
+        options['sort'] = sort_spec(sort_by, descending)
+    if sort_by == 'title':
+        options['collation'] = TITLE_COLLATION
+    return collection.find(search, **options).skip(skip).limit(limit)
+
+
+def title_pipeline(search: Dict[str, Any], children: Tuple[str, Dict[str, Any]], limit: int,
+                   skip: int, sort_by: Optional[str] = None, descending: bool = False,
+                   projection: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """
+    Build the aggregation pipeline of a page of titles with at least one child matching a filter.
+
+    Titles are read through the index of the filter and sort, and each is joined with at most one
+    of its matching children through the ``VERSION_INDEXES`` index of the child filter, until the
+    page is full. Each title read costs one index probe, without reading any child document, so
+    the work grows with the number of titles read rather than with the number of children. A
+    filter that few titles match still reads the titles up to the last one it matches. Needs
+    MongoDB 5.0 or later, for ``$lookup`` with both ``localField`` and ``pipeline``.
+
+    :param search: The values the fields of the titles must equal.
+    :param children: The child collection and the values the fields of a child must equal.
+    :param limit: The number of titles to read, ``0`` for all of them.
+    :param skip: The number of titles to skip.
+    :param sort_by: The name of the field to sort by. Defaults to the natural order.
+    :param descending: Whether to sort in descending order.
+    :param projection: The fields to read. Defaults to all the fields.
+    :returns: The pipeline.
+    """
+    child_collection, child_search = children
+    pipeline = [{'$match': search}]
+    if sort_by:
+        pipeline.append({'$sort': dict(sort_spec(sort_by, descending))})
+    pipeline.extend([
+        # Children refer to their title by the string of its id.
+        {'$addFields': {'_title_id': {'$toString': '$_id'}}},
+        {'$lookup': {
+            'from': child_collection,
+            'localField': '_title_id',
+            'foreignField': 'video_base_id',
+            # Only indexed fields, so the lookup is covered by the index of the child filter.
+            'pipeline': [{'$match': child_search}, {'$limit': 1},
+                         {'$project': {'_id': False, 'video_base_id': True}}],
+            'as': '_children',
+        }},
+        {'$match': {'_children': {'$ne': []}}},
+    ])
+    if skip:
+        pipeline.append({'$skip': skip})
+    if limit:
+        pipeline.append({'$limit': limit})
+    pipeline.append({'$project': projection or {'_title_id': False, '_children': False}})
+    return pipeline
+
+
+def find_by_ids(engine, collection: str, ids: List[str],
+                projection: Optional[Dict[str, Any]] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Read several documents by id with a single query.
+
+    :param engine: The storage engine to query.
+    :param collection: The name of the collection to query.
+    :param ids: The ids of the documents to read.
+    :param projection: The fields to read. Defaults to all the fields.
+    :returns: The documents that were found, keyed by id.
+    """
+    found = {}
+    for document in engine.get_many(collection, ids, projection=projection):
+        document['id'] = str(document.pop('_id'))
+        found[document['id']] = document
+    return found
+
+
+def projection_key(projection: Optional[Dict[str, Any]]) -> Optional[Tuple[str, ...]]:
+    """
+    Get a hashable key for a projection, used to tell identical reads apart.
+
+    :param projection: The projection.
+    :returns: The sorted projected fields, or ``None`` if reading all the fields.
+    """
+    return tuple(sorted(projection)) if projection else None
+
+
+def _index_names(stage: Dict[str, Any]) -> List[str]:
+    """Collect the names of the indexes used by an explain plan stage and its children."""
+    names = [stage['indexName']] if 'indexName' in stage else []
+    children = stage.get('inputStages', [])
+    if 'inputStage' in stage:
+        children = [stage['inputStage'], *children]
+    for child in children:
+        names.extend(_index_names(child))
+    return names
+
+
+def summarize_explain(explain: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Summarize the output of a pymongo ``explain()``.
+
+    :param explain: The explain output, of a query or of an aggregation pipeline.
+    :returns: The indexes used by the winning plan, the plan itself and execution stats.
+    """
+    if 'stages' in explain:
+        # The plan of a pipeline is the plan of the query its first stage reads with.
+        explain = explain['stages'][0].get('$cursor', {})
+    winning_plan = explain.get('queryPlanner', {}).get('winningPlan', {})
+    stats = explain.get('executionStats', {})
+    return {
+        'indexes': _index_names(winning_plan),
+        'winning_plan': winning_plan,
+        'execution_stats': {
+            key: stats[key] for key in (
+                'nReturned', 'totalKeysExamined', 'totalDocsExamined', 'executionTimeMillis')
+            if key in stats
+        },
+    }
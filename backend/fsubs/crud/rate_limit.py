@@ -0,0 +1,60 @@
+"""CRUD functions for rate limit token buckets shared between workers."""
+
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict
+
+from pymongo import IndexModel, ReturnDocument
+
+from fsubs.utils.metrics import instrument
+
+LOGGER = logging.getLogger(__name__)
+
+# Buckets are deleted once they would be full again, which is the same as not having one.
+BUCKET_INDEXES = [IndexModel([('expires', 1)], expireAfterSeconds=0)]
+
+
+@instrument
+class RateLimitDAO():
+    """The DAO for interacting with rate limit token buckets."""
+
+    def __init__(self, client):
+        """
+        Initialize a ``RateLimitDAO``.
+
+        :param client: The MongoClient object to use for the DAO.
+        """
+        self.client = client
+
+    async def ensure_indexes(self):
+        """Create the index expiring idle buckets if it doesn't exist."""
+        LOGGER.debug('Ensuring rate limit indexes.')
+        self.client.foreign_subs.rate_limits.create_indexes(BUCKET_INDEXES)
+
+    async def take(self, key: str, rate: float, burst: float, cost: float,
+                   now: float) -> Dict[str, Any]:
+        """
+        Refill a bucket and take tokens from it if it has enough, atomically.
+
+        :param key: The key of the bucket.
+        :param rate: The number of tokens added per second.
+        :param burst: The capacity of the bucket.
+        :param cost: The number of tokens to take.
+        :param now: The current time, in seconds since the epoch.
+        :returns: The bucket, with the tokens left and whether the tokens were ``allowed``.
+        """
+        refilled = {'$min': [burst, {'$add': [
+            {'$ifNull': ['$tokens', burst]},
+            {'$multiply': [
+                {'$max': [0, {'$subtract': [now, {'$ifNull': ['$updated', now]}]}]}, rate]},
+        ]}]}
+        pipeline = [
+            {'$set': {'tokens': refilled, 'updated': now}},
+            {'$set': {'allowed': {'$gte': ['$tokens', cost]}}},
+            {'$set': {
+                'tokens': {'$cond': ['$allowed', {'$subtract': ['$tokens', cost]}, '$tokens']},
+                'expires': datetime.utcfromtimestamp(now) + timedelta(seconds=burst / rate),
+            }},
+        ]
+        return self.client.foreign_subs.rate_limits.find_one_and_update(
+            {'_id': key}, pipeline, upsert=True, return_document=ReturnDocument.AFTER)
@@ -0,0 +1,85 @@
+"""CRUD functions for revoked access tokens."""
+
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from pymongo import IndexModel
+
+from fsubs.utils.metrics import instrument
+
+LOGGER = logging.getLogger(__name__)
+
+# Revocations are deleted once the tokens they revoke would have expired anyway.
+REVOCATION_INDEXES = [
+    IndexModel([('expires', 1)], expireAfterSeconds=0),
+    IndexModel([('created', 1)]),
+]
+
+
+@instrument
+class RevocationDAO():
+    """The DAO for interacting with revoked access tokens."""
+
+    def __init__(self, engine):
+        """
+        Initialize a ``RevocationDAO``.
+
+        :param engine: The storage engine to use for the DAO (see ``fsubs.crud.db.get_engine``).
+        """
+        self.engine = engine
+
+    async def ensure_indexes(self):
+        """Create the revocation indexes if they don't exist."""
+        LOGGER.debug('Ensuring revocation indexes.')
+        self.engine.ensure_indexes('revocations', REVOCATION_INDEXES)
+
+    async def revoke_token(self, jti: str, identity: str, expires: datetime) -> Dict[str, Any]:
+        """
+        Revoke a single token.
+
+        :param jti: The id of the token.
+        :param identity: The user the token was issued to.
+        :param expires: When the token expires.
+        :returns: The revocation.
+        """
+        LOGGER.debug('Revoking token <%s> of <%s>.', jti, identity)
+        revocation = {
+            '_id': f'jti:{jti}',
+            'jti': jti,
+            'identity': identity,
+            'created': datetime.utcnow(),
+            'expires': expires,
+        }
+        self.engine.replace('revocations', revocation)
+        return revocation
+
+    async def revoke_user(self, identity: str, token_version: int,
+                          expires: datetime) -> Dict[str, Any]:
+        """
+        Revoke the tokens of a user issued before a token version.
+
+        :param identity: The user.
+        :param token_version: The first token version still valid.
+        :param expires: When the last token revoked expires.
+        :returns: The revocation.
+        """
+        LOGGER.debug('Revoking tokens of <%s> before version %s.', identity, token_version)
+        revocation = {
+            '_id': f'user:{identity}',
+            'identity': identity,
+            'token_version': token_version,
+            'created': datetime.utcnow(),
+            'expires': expires,
+        }
+        self.engine.replace('revocations', revocation)
+        return revocation
+
+    async def read_since(self, since: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        """
+        Read the revocations created since a time.
+
+        :param since: The time to read from, ``None`` to read them all.
+        :returns: The revocations, oldest first.
+        """
+        return self.engine.find_since('revocations', 'created', since)
@@ -0,0 +1,41 @@
+"""Helpers for maintaining denormalized statistics on parent documents."""
+
+from typing import Any, Dict, List, Optional, Union
+
+VERSION_STATS = {
+    'version_count': 0,
+    'foreign_subs_version_count': 0,
+    'has_foreign_subs': False,
+    'cue_count': 0,
+    'subs_duration': 0.0,
+}
+
+# Episodes have no versions, so tv shows only count their episodes.
+TV_SHOW_STATS = {
+    'episode_count': 0,
+}
+
+
+def increment_stats(
+        deltas: Dict[str, Union[int, float]],
+        flag_counter: Optional[str] = 'foreign_subs_version_count') -> List[Dict[str, Any]]:
+    """
+    Build an update pipeline that increments counters and recomputes ``has_foreign_subs``.
+
+    Both stages run as a single atomic update of the document, so concurrent writers can never
+    leave the flag out of sync with the counter it is derived from.
+
+    :param deltas: The amount to increment each counter by.
+    :param flag_counter: The counter that ``has_foreign_subs`` is derived from, ``None`` for
+    documents without the flag.
+    :returns: The update pipeline to pass to ``update_one``.
+    """
+    pipeline = [
+        {'$set': {
+            field: {'$add': [{'$ifNull': [f'${field}', 0]}, delta]}
+            for field, delta in deltas.items()
+        }},
+    ]
+    if flag_counter is not None:
+        pipeline.append({'$set': {'has_foreign_subs': {'$gt': [f'${flag_counter}', 0]}}})
+    return pipeline
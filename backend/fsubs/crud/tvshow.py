@@ -1,26 +1,33 @@
 """CRUD functions for TV shows."""
 
 import logging
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 
-from bson.objectid import ObjectId
+from pymongo import IndexModel
 
+from fsubs.crud.queries import TITLE_INDEXES, find_by_ids, projection_key
+from fsubs.crud.stats import TV_SHOW_STATS
 from fsubs.models.video import VideoBaseInDB
 from fsubs.models.tvshow import TVShowEpisodeInDB
+from fsubs.utils.metrics import instrument
+from fsubs.utils.singleflight import BatchLoader, SingleFlight
 
 LOGGER = logging.getLogger(__name__)
 
 
+@instrument
 class TVShowDAO():
     """The DAO for interacting with users."""
 
-    def __init__(self, client):
+    def __init__(self, engine):
         """
         Initialize a ``TVShowDAO``.
 
-        :param client: The MongoClient object ot use for the DAO.
+        :param engine: The storage engine to use for the DAO (see ``fsubs.crud.db.get_engine``).
         """
-        self.client = client
+        self.engine = engine
+        self._reads = SingleFlight()
+        self._loader = BatchLoader(self._find_many)
 
     async def create(self, tv_show: VideoBaseInDB) -> str:
         """
@@ -30,36 +37,76 @@ class TVShowDAO():
         :returns: The id of the newly created tv show.
         """
         LOGGER.debug('Creating tv show from DAO.')
-        return self.client.foreign_subs.tv_shows.insert_one(tv_show).inserted_id
+        tv_show = {**tv_show, **TV_SHOW_STATS}
+        return self.engine.insert('tv_shows', tv_show)
 
-    async def read(self, tv_show_id: str) -> Dict[str, Any]:
+    async def read(self, tv_show_id: str, projection: Dict[str, Any] = None) -> Dict[str, Any]:
         """
         Read a tv show.
 
+        Concurrent reads of the same tv show share a single query.
+
         :param tv_show_id: The id of the tv show to read.
+        :param projection: The fields to read. Defaults to all the fields.
         :returns: Dict representing the tv show.
         """
-        LOGGER.debug(f'Reading tv show: <{tv_show_id}>.')
-        tv_show = self.client.foreign_subs.tv_shows.find_one({'_id': ObjectId(tv_show_id)})
-        if tv_show:
-            tv_show['id'] = str(tv_show.pop('_id'))
-        return tv_show
+        LOGGER.debug('Reading tv show: <%s>.', tv_show_id)
+        return await self._reads.do(
+            ('read', str(tv_show_id), projection_key(projection)),
+            self._find_one, tv_show_id, projection)
+
+    async def load(self, tv_show_id: str) -> Dict[str, Any]:
+        """
+        Read a tv show as part of a batch.
+
+        All the tv shows loaded within the same event loop tick are read with a single query.
+
+        :param tv_show_id: The id of the tv show to read.
+        :returns: Dict representing the tv show.
+        """
+        LOGGER.debug('Loading tv show: <%s>.', tv_show_id)
+        return await self._loader.load(str(tv_show_id))
 
-    async def read_multi(self, limit=100, skip=0) -> List[Dict[str, Any]]:
+    async def read_multi(self, limit=100, skip=0, search=None, sort_by=None, descending=False,
+                         explain=False, projection=None) -> List[Dict[str, Any]]:
         """
         Read multiple tv shows.
 
         :param limit: The number of tv shows to read.
         :param skip: The number of tv shows to skip.
+        :param search: The values the fields of the tv shows must equal (e.g.
+         ``{'no_subs': True}``).
+        :param sort_by: The name of the field to sort by (``title``, ``date_created`` or
+         ``last_modified``). Defaults to the natural order.
+        :param descending: Whether to sort in descending order.
+        :param explain: If ``True``, return a summary of the query plan instead of the tv shows.
+        :param projection: The fields to read. Defaults to all the fields.
         :returns: A list of Dicts representing tv shows.
         """
-        LOGGER.debug(f'Reading all tv shows with limit: <{limit}> and skip: <{skip}>.')
-        tv_shows = self.client.foreign_subs.tv_shows.find().skip(skip).limit(limit)
-        tv_shows = list(tv_shows)
+        LOGGER.debug('Reading all tv shows with limit: <%s>, skip: <%s>, search: <%s> and '
+                     'sort_by: <%s>.', limit, skip, search, sort_by)
+        tv_shows = self.engine.find(
+            'tv_shows',
+            search=search,
+            limit=limit,
+            skip=skip,
+            sort_by=sort_by,
+            descending=descending,
+            projection=projection,
+            explain=explain)
+        if explain:
+            return tv_shows
         for tv_show in tv_shows:
             tv_show['id'] = str(tv_show.pop('_id'))
         return tv_shows
 
+    async def ensure_indexes(self):
+        """Create the indexes used by tv show and tv episode queries if they don't exist."""
+        LOGGER.debug('Ensuring tv show indexes.')
+        self.engine.ensure_indexes('tv_shows', TITLE_INDEXES)
+        self.engine.ensure_indexes(
+            'tv_show_episodes', [IndexModel('video_base_id', name='video_base_id')])
+
     async def update(self, tv_show_id: str, tv_show: VideoBaseInDB):
         """
         Update a tv show.
@@ -67,8 +114,8 @@ class TVShowDAO():
         :param tv_show_id: The id of the tv show to update.
         :param tv_show: The tv show data to update with.
         """
-        LOGGER.debug(f'Updating tv show with uri: <{tv_show_id}> and tv_show: <{tv_show}>.')
-        self.client.foreign_subs.tv_show.update({'_id': ObjectId(tv_show_id)}, {'$set': tv_show})
+        LOGGER.debug('Updating tv show with uri: <%s> and tv_show: <%s>.', tv_show_id, tv_show)
+        self.engine.update('tv_shows', tv_show_id, tv_show, projection={'_id': True})
 
     async def delete(self, tv_show_id: str):
         """
@@ -76,48 +123,68 @@ class TVShowDAO():
 
         :param tv_show_id: The id of the tv show to delete.
         """
-        LOGGER.debug(f'Deleting tv show: <{tv_show_id}>.')
-        self.client.foreign_subs.tv_shows.delete_one({'_id': ObjectId(tv_show_id)})
+        LOGGER.debug('Deleting tv show: <%s>.', tv_show_id)
+        self.engine.delete('tv_shows', tv_show_id, projection={'_id': True})
 
     async def create_episode(self, episode: TVShowEpisodeInDB) -> str:
         """
         Create a tv episode.
 
+        Also updates the episode count of the tv show the episode belongs to.
+
         :param episode: The ``TVShowEpisodeInDB`` object representing the tv episode to create.
         :returns: The id of the newly created tv episode.
         """
         LOGGER.debug('Creating tv episode from DAO.')
-        return self.client.foreign_subs.tv_show_episodes.insert_one(episode).inserted_id
+        episode_id = self.engine.insert('tv_show_episodes', episode)
+        self._update_tv_show_stats(tv_show_id=episode['video_base_id'], episode_count=1)
+        return episode_id
 
-    async def read_episode(self, episode_id: str) -> Dict[str, Any]:
+    async def read_episode(self, episode_id: str,
+                           projection: Dict[str, Any] = None) -> Dict[str, Any]:
         """
         Read a tv episode.
 
         :param episode_id: The id of the tv episode to read.
+        :param projection: The fields to read. Defaults to all the fields.
         :returns: Dict representing the tv episode.
         """
-        LOGGER.debug(f'Reading tv episode: <{episode_id}>.')
-        tv_episode = self.client.foreign_subs.tv_show_episodes.find_one(
-            {'_id': ObjectId(episode_id)})
+        LOGGER.debug('Reading tv episode: <%s>.', episode_id)
+        tv_episode = self.engine.get('tv_show_episodes', episode_id, projection=projection)
         if tv_episode:
             tv_episode['id'] = str(tv_episode.pop('_id'))
         return tv_episode
 
-    async def read_tv_show_episodes(self, tv_show_id: str) -> List[Dict[str, Any]]:
+    async def read_episodes(self, episode_ids: List[str],
+                            projection: Dict[str, Any] = None) -> List[Optional[Dict[str, Any]]]:
+        """
+        Read several tv episodes by id.
+
+        :param episode_ids: The ids of the tv episodes to read.
+        :param projection: The fields to read. Defaults to all the fields.
+        :returns: The tv episodes in the same order as the ids, with ``None`` for missing tv
+         episodes.
+        """
+        LOGGER.debug('Reading tv episodes: <%s>.', episode_ids)
+        episodes = find_by_ids(
+            self.engine, 'tv_show_episodes', episode_ids, projection=projection)
+        return [episodes.get(episode_id) for episode_id in episode_ids]
+
+    async def read_tv_show_episodes(self, tv_show_id: str,
+                                    projection: Dict[str, Any] = None) -> List[Dict[str, Any]]:
         """
         Read all tv episodes for a tv show.
 
+        Concurrent reads of the episodes of the same tv show share a single query.
+
         :param tv_show_id: The id of the tv show to read episodes for.
+        :param projection: The fields to read. Defaults to all the fields.
         :returns: Dict representing all the tv episodes for the tv show.
         """
-        LOGGER.debug(f'Reading tv episodes for tv_show_id: {tv_show_id}.')
-        tv_episodes = self.client.foreign_subs.tv_show_episodes.find(
-            {'video_base_id': tv_show_id})
-        tv_episodes = list(tv_episodes)
-        for episode in tv_episodes:
-            episode['id'] = str(episode.pop('_id'))
-        print(f'Found episodes: {tv_episodes}.')
-        return tv_episodes
+        LOGGER.debug('Reading tv episodes for tv_show_id: %s.', tv_show_id)
+        return await self._reads.do(
+            ('read_tv_show_episodes', str(tv_show_id), projection_key(projection)),
+            self._find_tv_show_episodes, tv_show_id, projection)
 
     async def update_episode(self, episode_id: str, episode: TVShowEpisodeInDB):
         """
@@ -126,9 +193,8 @@ class TVShowDAO():
         :param episode_id: The id of the tv episode to update.
         :param episode: The episode data to update with.
         """
-        LOGGER.debug(f'Updating tv episode with uri: <{episode_id}> and episode: <{episode}>.')
-        self.client.foreign_subs.tv_show_episodes.update(
-            {'_id': ObjectId(episode_id)}, {'$set': episode})
+        LOGGER.debug('Updating tv episode with uri: <%s> and episode: <%s>.', episode_id, episode)
+        self.engine.update('tv_show_episodes', episode_id, episode, projection={'_id': True})
 
     async def delete_episode(self, episode_id: str):
         """
@@ -136,5 +202,69 @@ class TVShowDAO():
 
         :param episode_id: The id of the episode to delete.
         """
-        LOGGER.debug(f'Deleting tv episode: <{episode_id}>.')
-        self.client.foreign_subs.tv_show_episodes.delete_one({'_id': ObjectId(episode_id)})
+        LOGGER.debug('Deleting tv episode: <%s>.', episode_id)
+        episode = self.engine.delete(
+            'tv_show_episodes', episode_id, projection={'video_base_id': True})
+        if not episode:
+            return
+        self._update_tv_show_stats(tv_show_id=episode['video_base_id'], episode_count=-1)
+
+    async def backfill_stats(self, batch_size: int = 500) -> int:
+        """
+        Recount the episodes of every tv show.
+
+        TV shows are processed in batches ordered by id, reading the episodes of each batch with a
+        single query and writing the results back with a bulk write.
+
+        :param batch_size: The number of tv shows to process per batch.
+        :returns: The number of tv shows processed.
+        """
+        LOGGER.debug('Backfilling tv show stats with batch size: <%s>.', batch_size)
+        processed = 0
+        last_id = None
+        while True:
+            tv_show_ids = self.engine.ids_after('tv_shows', last_id, batch_size)
+            if not tv_show_ids:
+                return processed
+            last_id = tv_show_ids[-1]
+
+            totals = {str(tv_show_id): dict(TV_SHOW_STATS) for tv_show_id in tv_show_ids}
+            episodes = self.engine.find_in(
+                'tv_show_episodes', 'video_base_id', list(totals),
+                projection={'video_base_id': True})
+            for episode in episodes:
+                totals[episode['video_base_id']]['episode_count'] += 1
+            self.engine.update_each('tv_shows', list(totals.items()))
+            processed += len(tv_show_ids)
+            LOGGER.info('Backfilled stats for %s tv shows.', processed)
+
+    def _find_one(self, tv_show_id: str, projection: Dict[str, Any] = None) -> Dict[str, Any]:
+        """Query a single tv show."""
+        tv_show = self.engine.get('tv_shows', tv_show_id, projection=projection)
+        if tv_show:
+            tv_show['id'] = str(tv_show.pop('_id'))
+        return tv_show
+
+    def _find_many(self, tv_show_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Query several tv shows at once, keyed by id."""
+        return find_by_ids(self.engine, 'tv_shows', tv_show_ids)
+
+    def _find_tv_show_episodes(self, tv_show_id: str,
+                               projection: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+        """Query all the episodes of a tv show."""
+        tv_episodes = self.engine.find_in(
+            'tv_show_episodes', 'video_base_id', [tv_show_id], projection=projection)
+        for episode in tv_episodes:
+            episode['id'] = str(episode.pop('_id'))
+        LOGGER.debug('Found episodes: %s.', tv_episodes)
+        return tv_episodes
+
+    def _update_tv_show_stats(self, tv_show_id: str, **deltas):
+        """
+        Atomically apply episode statistic deltas to a tv show.
+
+        :param tv_show_id: The id of the tv show to update.
+        :param deltas: The amount to change each statistic by.
+        """
+        # TV shows have no ``has_foreign_subs`` until episodes have versions.
+        self.engine.increment_stats('tv_shows', tv_show_id, deltas, flag_counter=None)
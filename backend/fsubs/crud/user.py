@@ -1,25 +1,56 @@
 """CRUD functions for users."""
 
 import logging
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 
-from bson.objectid import ObjectId
+from pymongo import IndexModel
+from pymongo.errors import DuplicateKeyError, OperationFailure
 
 from fsubs.models.user import UserCreateToDAO
+from fsubs.utils.metrics import instrument
 
 LOGGER = logging.getLogger(__name__)
 
+# The fields that must be unique across users, each enforced by its own index.
+UNIQUE_FIELDS = ('username', 'email')
+USER_INDEXES = [
+    IndexModel([(field, 1)], unique=True, name=f'{field}_unique') for field in UNIQUE_FIELDS]
 
+
+class DuplicateUserError(Exception):
+    """Another user already has the same username or email."""
+
+    def __init__(self, field: Optional[str]):
+        """
+        Initialize a ``DuplicateUserError``.
+
+        :param field: The field that is already in use (``username`` or ``email``), or ``None`` if
+        the server didn't say which.
+        """
+        super().__init__(f'That {field or "username or email"} is already in use.')
+        self.field = field
+
+
+def _duplicate_field(error: DuplicateKeyError) -> Optional[str]:
+    """Get the user field a duplicate key error is about."""
+    key_pattern = (error.details or {}).get('keyPattern') or {}
+    for field in UNIQUE_FIELDS:
+        if field in key_pattern or f'{field}_unique' in str(error):
+            return field
+    return None
+
+
+@instrument
 class UserDAO():
     """The DAO for interacting with users."""
 
-    def __init__(self, client):
+    def __init__(self, engine):
         """
         Initialize a ``UserDAO``.
 
-        :param client: The MongoClient object ot use for the DAO.
+        :param engine: The storage engine to use for the DAO (see ``fsubs.crud.db.get_engine``).
         """
-        self.client = client
+        self.engine = engine
 
     async def create(self, user: UserCreateToDAO) -> str:
         """
@@ -27,35 +58,59 @@ class UserDAO():
 
         :param user: The ``UserInDB`` object representing the user to create.
         :returns: The id of the newly created user.
+        :raises DuplicateUserError: If another user already has the same username or email.
         """
         LOGGER.debug('Creating user from DAO.')
-        return self.client.foreign_subs.users.insert_one(user.dict()).inserted_id
+        try:
+            return self.engine.insert('users', user.dict())
+        except DuplicateKeyError as e:
+            raise DuplicateUserError(_duplicate_field(e)) from e
+
+    async def ensure_indexes(self):
+        """
+        Create the unique indexes on usernames and emails if they don't exist.
 
-    async def read(self, user_id: str) -> Dict[str, Any]:
+        Fails with an error in the log, rather than an exception, if existing users already share
+        a username or email, since the app can still run without the indexes.
+        """
+        LOGGER.debug('Ensuring user indexes.')
+        try:
+            self.engine.ensure_indexes('users', USER_INDEXES)
+        except OperationFailure as e:
+            # 11000 is the duplicate key error code.
+            if e.code != 11000:
+                raise
+            LOGGER.error('Unable to create the unique user indexes, some users share a username '
+                         'or email and must be fixed by hand: %s', e)
+
+    async def read(self, user_id: str, projection: Dict[str, Any] = None) -> Dict[str, Any]:
         """
         Read a user.
 
         :param user_id: The id of the user to read.
+        :param projection: The fields to read. Defaults to all the fields.
         :returns: Dict representing the user.
         """
-        LOGGER.debug(f'Reading user: <{user_id}>.')
-        user = self.client.foreign_subs.users.find_one({'_id': ObjectId(user_id)})
+        LOGGER.debug('Reading user: <%s>.', user_id)
+        user = self.engine.get('users', user_id, projection=projection)
         if user:
             user['id'] = str(user.pop('_id'))
         return user
 
-    async def read_by_username(self, username: str) -> Dict[str, Any]:
+    async def read_by_username(self, username: str,
+                               projection: Dict[str, Any] = None) -> Dict[str, Any]:
         """
         Read a user by username.
 
         :param username: The username of the user to read.
+        :param projection: The fields to read. Defaults to all the fields.
         :returns: Dict representing the user.
         """
-        LOGGER.debug(f'Reading user: <{username}>.')
-        user = self.client.foreign_subs.users.find_one({'username': username})
+        LOGGER.debug('Reading user: <%s>.', username)
+        user = self.engine.find_one('users', {'username': username}, projection=projection)
         if user:
             user['id'] = str(user.pop('_id'))
-        LOGGER.debug(f'User read is: {user}.')
+        LOGGER.debug('User read is: %s.', user)
         return user
 
     async def read_by_email(self, email: str) -> Dict[str, Any]:
@@ -65,39 +120,77 @@ class UserDAO():
         :param email: The email of the user to read.
         :returns: Dict representing the user.
         """
-        LOGGER.debug(f'Reading user: <{email}>.')
-        user = self.client.foreign_subs.users.find_one({'email': email})
+        LOGGER.debug('Reading user: <%s>.', email)
+        user = self.engine.find_one('users', {'email': email})
         if user:
             user['id'] = str(user.pop('_id'))
-        LOGGER.debug(f'User read is: {user}.')
+        LOGGER.debug('User read is: %s.', user)
         return user
 
-    async def read_multi(self, limit=100, skip=0, search=None) -> List[Dict[str, Any]]:
+    async def read_multi(self, limit=100, skip=0, search=None,
+                         projection=None) -> List[Dict[str, Any]]:
         """
         Read multiple users.
 
         :param limit: The number of users to read.
         :param skip: The number of users to skip.
-        :param search: A dictionary of things to inject into pymongo find (e.g.
+        :param search: The values the fields of the users must equal (e.g.
          ``{'email': 'j@e.com'}``))
+        :param projection: The fields to read. Defaults to all the fields.
         :returns: A list of Dicts representing users.
         """
-        LOGGER.debug(f'Reading all user with limit: <{limit}> and skip: <{skip}>.')
-        users = self.client.foreign_subs.users.find(search).skip(skip).limit(limit)
-        users = list(users)
+        LOGGER.debug('Reading all user with limit: <%s> and skip: <%s>.', limit, skip)
+        users = self.engine.find(
+            'users', search=search, limit=limit, skip=skip, projection=projection)
         for user in users:
             user['id'] = str(user.pop('_id'))
         return users
 
-    async def update(self, user_id: str, user: UserCreateToDAO) -> Dict[str, Any]:
+    async def update(self, user_id: str, user: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """
         Update a user.
 
         :param user_id: The id of the user to update.
         :param user: The user data to update with.
+        :returns: Dict representing the updated user, or ``None`` if there is no such user.
+        :raises DuplicateUserError: If another user already has the same username or email.
+        """
+        LOGGER.debug('Updating user with uri: <%s> and user: <%s>.', user_id, user)
+        try:
+            updated = self.engine.update('users', user_id, user, return_after=True)
+        except DuplicateKeyError as e:
+            raise DuplicateUserError(_duplicate_field(e)) from e
+        if updated:
+            updated['id'] = str(updated.pop('_id'))
+        return updated
+
+    async def update_password_hash(self, user_id: str, old_hash: str, new_hash: str) -> bool:
+        """
+        Replace the hash of a user's password, unless the password changed in the meantime.
+
+        :param user_id: The id of the user.
+        :param old_hash: The hash the password was verified against.
+        :param new_hash: The hash to replace it with.
+        :returns: True if the hash was replaced.
+        """
+        LOGGER.debug('Rehashing password of user: <%s>.', user_id)
+        updated = self.engine.update(
+            'users', user_id, {'hashed_password': new_hash, 'salt': None},
+            search={'hashed_password': old_hash}, projection={'_id': True})
+        return updated is not None
+
+    async def bump_token_version(self, username: str) -> Optional[int]:
+        """
+        Increment the token version of a user, so the tokens issued before can be revoked.
+
+        :param username: The username of the user.
+        :returns: The new token version, or ``None`` if there is no such user.
         """
-        LOGGER.debug(f'Updating user with uri: <{user_id}> and user: <{user}>.')
-        self.client.foreign_subs.users.update({'_id': ObjectId(user_id)}, {'$set': user})
+        LOGGER.debug('Bumping token version of user: <%s>.', username)
+        updated = self.engine.increment(
+            'users', {'username': username}, {'token_version': 1},
+            projection={'token_version': True})
+        return updated['token_version'] if updated else None
 
     async def delete(self, user_id: str):
         """
@@ -105,5 +198,5 @@ class UserDAO():
 
         :param user_id: The id of the user to delete.
         """
-        LOGGER.debug(f'Deleting user: <{user_id}>.')
-        self.client.foreign_subs.users.delete_one({'_id': ObjectId(user_id)})
+        LOGGER.debug('Deleting user: <%s>.', user_id)
+        self.engine.delete('users', user_id, projection={'_id': True})
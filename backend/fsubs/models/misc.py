@@ -1,5 +1,6 @@
 """Miscellaneous models."""
 from datetime import datetime, timezone
+from enum import Enum
 
 import bson
 from pydantic import BaseModel
@@ -23,6 +24,28 @@ class ObjectIdStr(str):
         return str(v)
 
 
+class SortBy(str, Enum):
+    """The fields a list of titles can be sorted by."""
+
+    title = 'title'
+    date_created = 'date_created'
+    last_modified = 'last_modified'
+
+
+class SortOrder(str, Enum):
+    """The order to sort in."""
+
+    asc = 'asc'
+    desc = 'desc'
+
+
+class ProfileFormat(str, Enum):
+    """The output formats of the profiler."""
+
+    collapsed = 'collapsed'
+    speedscope = 'speedscope'
+
+
 class Metadata(BaseModel):
     """
     Metadata info.
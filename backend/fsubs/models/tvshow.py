@@ -13,10 +13,13 @@ class TVShowInDB(VideoBase):
     **id** - The id of the item in the database.
 
     **metadata** - The Metadata object to be associated with the item.
+
+    **episode_count** - The number of episodes of the tv show.
     """
 
     id: str
     metadata: Metadata = Metadata()
+    episode_count: int = 0
 
 
 class TVShowEpisode(VideoBase):
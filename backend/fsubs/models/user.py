@@ -1,6 +1,7 @@
 """User models."""
 from enum import Enum
 import re
+from typing import Optional
 
 from pydantic import BaseModel, validator
 
@@ -137,15 +138,16 @@ class UserCreateToDAO(UserBase):
     """
     User creation data sent to DAO.
 
-    **salt** The salt used for the user's password.
+    **salt** The salt used for the user's password, only for hashes made before hashes described
+    themselves.
 
-    **hashed_password** The hash of the user's password.
+    **hashed_password** The hash of the user's password, including its algorithm, cost and salt.
 
     **metadata** The metadata of the user.
 
     """
 
-    salt: str
+    salt: Optional[str] = None
     hashed_password: str
 
 
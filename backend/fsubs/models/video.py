@@ -110,11 +110,36 @@ class VideoInstanceInDB(VideoInstance):
     **id** - The id of the item in the database.
 
     **video_base_id** - The id of the `VideoBaseInDB` to associate the `VideoInstanceInDB` with.
+
+    **cue_count** - The number of subtitle cues (timestamps) of the instance.
+
+    **subs_duration** - The total duration of the subtitle cues in seconds.
     """
 
     id: str
     video_base_id: str
     metadata: Metadata = Metadata()
+    cue_count: int = 0
+    subs_duration: float = 0
+
+
+class VideoSummary(BaseModel):
+    """
+    Summary of the versions of a video. Kept up to date by the DAOs.
+
+    **version_count** - The number of versions of the video.
+
+    **has_foreign_subs** - Whether any version of the video has foreign subtitles.
+
+    **cue_count** - The total number of subtitle cues across all versions.
+
+    **subs_duration** - The total duration of the subtitle cues across all versions in seconds.
+    """
+
+    version_count: int = 0
+    has_foreign_subs: bool = False
+    cue_count: int = 0
+    subs_duration: float = 0
 
 
 class VideoBase(BaseModel):
@@ -136,7 +161,7 @@ class VideoBase(BaseModel):
     no_subs: bool = False
 
 
-class VideoBaseInDB(VideoBase):
+class VideoBaseInDB(VideoBase, VideoSummary):
     """
     The VideoBase class stored in db.
 
@@ -1,56 +1,131 @@
 """Defines logic used for endpoints at ``/authenticate``."""
 
 import logging
-from datetime import timedelta
+from datetime import datetime, timedelta
+from typing import Optional
 
 import addict as ad
-import jwt
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import Response
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from pymongo import MongoClient
 from jwt import PyJWTError
+from pymongo.errors import PyMongoError
 from starlette.status import HTTP_401_UNAUTHORIZED
 
 from fsubs.config.config import Config
+from fsubs.crud.db import get_engine
+from fsubs.crud.revocation import RevocationDAO
 from fsubs.crud.user import UserDAO
+from fsubs.models.user import Access
 from fsubs.utils import auth as auth_utils
 from fsubs.utils import users as user_utils
+from fsubs.utils import timing
+from fsubs.utils.breaker import CircuitOpen
+from fsubs.utils.revocation import NOT_LOADED_RETRY_SECONDS, REVOCATIONS, REVOKED_REJECTED
+from fsubs.utils.singleflight import run_in_executor
 
-router = APIRouter()
+router = APIRouter(route_class=timing.TimedRoute)
 
 LOGGER = logging.getLogger(__name__)
 config = Config()
-base_url = config["app"]["base_url"]
-token_url = f'{base_url or ""}/authenticate'
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl=token_url)
-
-client = MongoClient(
-    host=config["db"]["hostname"],
-    port=config["db"].getint("port"),
-    username='root',
-    password='example',
-)
-USER_DAO = UserDAO(client=client)
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl='/authenticate')
+# For endpoints open to anonymous users, where some options need a token.
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl='/authenticate', auto_error=False)
+
+engine = get_engine()
+USER_DAO = UserDAO(engine=engine)
+REVOCATION_DAO = RevocationDAO(engine=engine)
+
 
+def set_token_url(base_url: str):
+    """
+    Point the OpenAPI docs at the token endpoint under a base url.
+
+    :param base_url: The base url fsubs is served at.
+    """
+    for scheme in (oauth2_scheme, optional_oauth2_scheme):
+        scheme.model.flows.password.tokenUrl = f'{base_url or ""}/authenticate'
 
-async def get_token_header(token: str = Depends(oauth2_scheme)) -> str:
-    """Get the token from the header of the request."""
+
+async def get_token_claims(token: str = Depends(oauth2_scheme)) -> dict:
+    """
+    Get the claims of the token from the header of the request, if it is valid.
+
+    :raises HTTPException: 401 if the token is invalid or revoked, 503 if the revoked tokens
+    haven't been loaded yet, e.g. while the worker warms up.
+    """
     credentials_exception = HTTPException(
         status_code=HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(
-            token,
-            config["app"]["jwt_secret"],
-            algorithms=[config["app"]["jwt_algorithm"]])
-        username: str = payload.get("identity")
-        if username is None:
+    with timing.track('auth'):
+        try:
+            payload = auth_utils.decode_access_token(token)
+            username: str = payload.get("identity")
+            if username is None:
+                raise credentials_exception
+        except PyJWTError:
             raise credentials_exception
-    except PyJWTError:
-        raise credentials_exception
-    return username
+        if not REVOCATIONS.loaded:
+            # Fail closed, the token may have been revoked.
+            raise HTTPException(
+                status_code=503,
+                detail='Unable to check tokens yet, try again later.',
+                headers={'Retry-After': str(NOT_LOADED_RETRY_SECONDS)},
+            )
+        if REVOCATIONS.is_revoked(payload):
+            REVOKED_REJECTED.inc()
+            raise credentials_exception
+    return payload
+
+
+async def get_token_header(claims: dict = Depends(get_token_claims)) -> str:
+    """Get the username of the token from the header of the request."""
+    return claims["identity"]
+
+
+async def get_explain(
+        explain: bool = False,
+        token: Optional[str] = Depends(optional_oauth2_scheme)) -> bool:
+    """
+    Get the ``explain`` query parameter of a listing, which only admins may set.
+
+    :raises HTTPException: If ``explain`` is set without a valid token, or by a user that doesn't
+    have ``admin`` access.
+    """
+    if not explain:
+        return False
+    if token is None:
+        raise HTTPException(
+            status_code=HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    username = (await get_token_claims(token))["identity"]
+    user = ad.Dict(await USER_DAO.read_by_username(username=username))
+    if not user:
+        raise HTTPException(status_code=401, detail=f'User {username} unauthorized, were '
+                                                    'you deleted?')
+    await user_utils.check_access(user=user, username=username, level=Access.admin)
+    return True
+
+
+async def rehash_password(user: ad.Dict, password: str):
+    """
+    Hash a user's password again with the KDF and cost of the config.
+
+    Failing to store the new hash doesn't fail the login, it is tried again on the next one.
+
+    :param user: The user, whose password was just verified.
+    :param password: The password of the user.
+    """
+    new_hash = await run_in_executor(user_utils.hash_password, password)
+    try:
+        if await USER_DAO.update_password_hash(user.id, user.hashed_password, new_hash):
+            LOGGER.info('Rehashed password of %s.', user.username)
+    except (PyMongoError, CircuitOpen) as e:
+        LOGGER.warning('Unable to rehash password of %s: %s', user.username, e)
 
 
 @router.post("", tags=["authenticate"], status_code=201)
@@ -69,12 +144,10 @@ async def authenticate(form_data: OAuth2PasswordRequestForm = Depends()):
         headers={"WWW-Authenticate": "Bearer"},
     )
     user = ad.Dict(await USER_DAO.read_by_username(username=username))
-    LOGGER.debug(f'User salt: {user.salt} with type: {type(user.salt)}.')
     if user:
-        authenticated = user_utils.verify_password(
-            password=password,
-            salt=user.salt,
-            key=user.hashed_password)
+        # Hashing releases the GIL, so it doesn't hold up the event loop in the executor.
+        authenticated = await run_in_executor(
+            user_utils.verify_password, password, user.hashed_password, user.salt or None)
     else:
         raise credentials_exception
     if authenticated is False:
@@ -84,12 +157,18 @@ async def authenticate(form_data: OAuth2PasswordRequestForm = Depends()):
         LOGGER.error(msg)
         raise HTTPException(500, detail=msg)
 
+    if user_utils.needs_rehash(user.hashed_password):
+        await rehash_password(user, password)
+
+    if not auth_utils.KEYS.can_sign():
+        raise HTTPException(503, detail='This server can only verify tokens, not issue them.')
+
     # Generate an access token
     access_token_expires = timedelta(hours=int(config['app']['jwt_expires_hours']))
     token = auth_utils.create_access_token(
-        data={"identity": username},
+        data={"identity": username, "tv": user.get('token_version', 0)},
         expires_delta=access_token_expires)
-    LOGGER.debug(f'Generated access token for {username}: {token}')
+    LOGGER.debug('Generated access token for %s.', username)
     return {"access_token": token, "token_type": "bearer"}
 
 
@@ -103,3 +182,52 @@ async def authenticate(form_data: OAuth2PasswordRequestForm = Depends()):
 async def check_token():
     """Check the authentication token."""
     return 'You have a valid token.'
+
+
+@router.post("/revoke", tags=["authenticate"], status_code=204)
+async def revoke_token(claims: dict = Depends(get_token_claims)):
+    """
+    Revoke the token used to make this request, e.g. to log out.
+
+    **returns** - No content.
+    """
+    if not claims.get('jti'):
+        raise HTTPException(
+            status_code=422,
+            detail='This token was issued without an id, use /authenticate/logout-all instead.')
+    LOGGER.info('Revoking a token of %s.', claims['identity'])
+    revocation = await REVOCATION_DAO.revoke_token(
+        jti=claims['jti'],
+        identity=claims['identity'],
+        expires=datetime.utcfromtimestamp(claims['exp']))
+    # Other workers see the revocation on their next refresh.
+    REVOCATIONS.apply([revocation])
+    return Response(status_code=204)
+
+
+@router.post("/logout-all", tags=["authenticate"], status_code=204)
+async def logout_all(username: str = None, acting_username: str = Depends(get_token_header)):
+    """
+    Revoke every token issued so far to a user, e.g. after their password leaked.
+
+    A user must have `admin` access to log out other users.
+
+    **username** - The user to log out. Defaults to the user making the request.
+
+    **returns** - No content.
+    """
+    username = username or acting_username
+    if username != acting_username:
+        acting_user = ad.Dict(await USER_DAO.read_by_username(username=acting_username))
+        await user_utils.check_access(user=acting_user, username=acting_username,
+                                      level=Access.admin)
+    LOGGER.info('Revoking every token of %s.', username)
+    token_version = await USER_DAO.bump_token_version(username=username)
+    if token_version is None:
+        raise HTTPException(status_code=404, detail=f'Unable to find user {username}.')
+    # Every token revoked has expired by then.
+    expires = datetime.utcnow() + timedelta(hours=int(config['app']['jwt_expires_hours']))
+    revocation = await REVOCATION_DAO.revoke_user(
+        identity=username, token_version=token_version, expires=expires)
+    REVOCATIONS.apply([revocation])
+    return Response(status_code=204)
@@ -0,0 +1,150 @@
+"""Defines logic used for endpoints at ``/debug``."""
+
+import asyncio
+import logging
+from typing import Any, Dict, List
+
+import addict as ad
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+
+from fsubs.crud.db import get_client, get_engine
+from fsubs.crud.queries import summarize_explain
+from fsubs.crud.user import UserDAO
+from fsubs.models.misc import ProfileFormat
+from fsubs.models.user import Access
+from fsubs.routers.authenticate import get_token_header
+from fsubs.utils.profiler import ProfilerBusy, Sampler
+from fsubs.utils.slow_queries import SLOW_QUERIES
+from fsubs.utils.timing import TimedRoute
+from fsubs.utils.users import check_access
+from fsubs.utils.watchdog import WATCHDOG
+
+router = APIRouter(route_class=TimedRoute)
+
+LOGGER = logging.getLogger(__name__)
+
+client = get_client()
+USER_DAO = UserDAO(engine=get_engine())
+
+
+async def require_admin(username: str = Depends(get_token_header)) -> str:
+    """Only allow admins through."""
+    user = ad.Dict(await USER_DAO.read_by_username(username=username))
+    if not user:
+        raise HTTPException(status_code=401, detail=f'User {username} unauthorized, were '
+                                                    'you deleted?')
+    await check_access(
+        user=user,
+        username=username,
+        level=Access.admin)
+    return username
+
+
+@router.get("/slow-queries", tags=["debug"])
+async def get_slow_queries(
+        limit: int = Query(50, ge=1),
+        username: str = Depends(require_admin)) -> List[Dict[str, Any]]:
+    """
+    Get the most recent Mongo queries that went over the `slow_query_ms` threshold of this worker.
+
+    Requires `admin` level access. Filter values are redacted.
+
+    **limit** - The number of queries to get.
+
+    **returns** - The slow queries, most recent first, with their filter shape, duration and the
+    number of documents returned.
+    """
+    LOGGER.info('Getting slow queries with limit: <%s>.', limit)
+    return SLOW_QUERIES.records(limit=limit)
+
+
+@router.get("/slow-queries/{query_id}/explain", tags=["debug"])
+async def explain_slow_query(
+        query_id: int,
+        username: str = Depends(require_admin)) -> Dict[str, Any]:
+    """
+    Explain a slow query, re-running it with its original filter values.
+
+    Requires `admin` level access.
+
+    **query_id** - The id of the slow query to explain.
+
+    **returns** - The indexes used by the winning plan, the plan itself and execution stats
+    (including the number of keys and documents examined).
+    """
+    LOGGER.info('Explaining slow query: <%s>.', query_id)
+    explain = SLOW_QUERIES.explain(client, query_id)
+    if explain is None:
+        raise HTTPException(status_code=404, detail=f'Slow query {query_id} not found.')
+    return summarize_explain(explain)
+
+
+@router.delete("/slow-queries", tags=["debug"], status_code=204)
+async def clear_slow_queries(username: str = Depends(require_admin)):
+    """
+    Clear the slow queries of this worker.
+
+    Requires `admin` level access.
+    """
+    LOGGER.info('Clearing slow queries for user: <%s>.', username)
+    SLOW_QUERIES.clear()
+
+
+@router.get("/blocking", tags=["debug"])
+async def get_blocking_calls(username: str = Depends(require_admin)) -> List[Dict[str, Any]]:
+    """
+    Get the call sites that blocked the event loop of this worker for over `blocking_threshold_ms`.
+
+    Requires `admin` level access. Empty unless `blocking_threshold_ms` is set.
+
+    **returns** - The call sites, the one that blocked the loop the longest in total first, with
+    how many times and how long they blocked it and an example stack.
+    """
+    LOGGER.info('Getting blocking calls.')
+    return WATCHDOG.offenders()
+
+
+@router.delete("/blocking", tags=["debug"], status_code=204)
+async def clear_blocking_calls(username: str = Depends(require_admin)):
+    """
+    Clear the blocking call sites of this worker.
+
+    Requires `admin` level access.
+    """
+    LOGGER.info('Clearing blocking calls for user: <%s>.', username)
+    WATCHDOG.clear()
+
+
+@router.post("/profile", tags=["debug"])
+async def profile(
+        seconds: float = Query(10, gt=0, le=60),
+        interval_ms: float = Query(5, ge=1, le=100),
+        format: ProfileFormat = ProfileFormat.collapsed,
+        username: str = Depends(require_admin)):
+    """
+    Profile this worker by sampling the stacks of all of its threads.
+
+    Requires `admin` level access. Only one profile can run at a time.
+
+    **seconds** - How long to profile for.
+
+    **interval_ms** - The time between samples in milliseconds.
+
+    **format** - `collapsed` for collapsed stacks (one `thread;outer;...;inner count` line per
+    stack, as used by flamegraph.pl) or `speedscope` for a file that can be opened at
+    https://www.speedscope.app.
+
+    **returns** - The profile.
+    """
+    LOGGER.info('Profiling for %ss for user: <%s>.', seconds, username)
+    sampler = Sampler(interval=interval_ms / 1000)
+    loop = asyncio.get_event_loop()
+    try:
+        # Sample from another thread so the event loop keeps serving the traffic being profiled.
+        await loop.run_in_executor(None, sampler.run, seconds)
+    except ProfilerBusy:
+        raise HTTPException(status_code=409, detail='A profile is already running.')
+    if format == ProfileFormat.speedscope:
+        return sampler.speedscope()
+    return PlainTextResponse(sampler.collapsed())
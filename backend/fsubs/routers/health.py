@@ -0,0 +1,39 @@
+"""Defines logic used for the ``/health`` and ``/ready`` endpoints."""
+
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse
+
+from fsubs.utils.timing import TimedRoute
+
+router = APIRouter(route_class=TimedRoute)
+
+
+@router.get("/health", tags=["health"])
+async def health(request: Request):
+    """
+    Check that this worker is alive. Doesn't touch the database.
+
+    **returns** - `{"status": "ok"}`, or a 503 with `{"status": "failed"}` if the worker failed
+    to warm up and is stopping.
+    """
+    if getattr(request.app.state, 'warm_up_error', None):
+        return JSONResponse({'status': 'failed'}, status_code=503)
+    return {'status': 'ok'}
+
+
+@router.get("/ready", tags=["health"])
+async def ready(request: Request):
+    """
+    Check that this worker is ready to take traffic.
+
+    It is ready once its database connection pool is warm and the indexes are in place.
+
+    **returns** - `{"status": "ready"}` with how long the warm up took, or a 503 with
+    `{"status": "starting"}` while warming up or `{"status": "failed"}` if warming up failed.
+    """
+    state = request.app.state
+    if getattr(state, 'warm_up_error', None):
+        return JSONResponse({'status': 'failed'}, status_code=503)
+    if not getattr(state, 'ready', False):
+        return JSONResponse({'status': 'starting'}, status_code=503)
+    return {'status': 'ready', 'warm_up_seconds': state.warm_up_seconds}
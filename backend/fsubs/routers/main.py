@@ -1,11 +1,34 @@
 """Setup FastAPI."""
+import asyncio
+import itertools
 import logging
+import os
+import signal
+import time
 
 from fastapi import FastAPI, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from pymongo.errors import ConnectionFailure, ExecutionTimeout
 
-from fsubs.routers import authenticate, movies, tvshows, users
+from fsubs.config.config import RESOLVED_CONFIG_VAR, Config
+from fsubs.crud.db import get_client, get_engine
+from fsubs.crud.memory import save_snapshots
+from fsubs.crud.mirror import MirrorSnapshot
+from fsubs.routers import authenticate, debug, health, metrics, mirror, movies, tvshows, users
 from fsubs.routers.authenticate import get_token_header
+from fsubs.utils import logs
+from fsubs.utils import metrics as metrics_utils
+from fsubs.utils.admission import AdmissionMiddleware, admissions_from_config
+from fsubs.utils.auth import KEYS
+from fsubs.utils.breaker import BREAKER, CircuitOpen, unavailable_handler
+from fsubs.utils.deadlines import DeadlineExceeded, DeadlineMiddleware
+from fsubs.utils.rate_limit import RateLimitMiddleware, rate_limits_from_config
+from fsubs.utils.revocation import REVOCATIONS, refresh_revocations
+from fsubs.utils.slow_queries import SLOW_QUERIES
+from fsubs.utils.stale_cache import StaleCacheMiddleware
+from fsubs.utils.watchdog import WATCHDOG
+from fsubs.utils.timing import ServerTimingMiddleware
+from fsubs.utils.token_cache import TOKEN_CACHE
 
 LOGGER = logging.getLogger(__name__)
 
@@ -15,21 +38,259 @@ origins = [
 
 openapi_prefix = ''  # Set me to run swagger ot a base url
 
-LOGGER.info(f'Building FastAPI app with base url: <{openapi_prefix}>.')
-app = FastAPI(openapi_prefix=openapi_prefix)
-
-LOGGER.info('Setting up FastAPI middleware.')
-LOGGER.debug(f'Using origins: <{origins}>.')
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-LOGGER.info('Loading routers.')
-app.include_router(authenticate.router, prefix="/authenticate")
-app.include_router(movies.router, prefix="/movies")
-app.include_router(tvshows.router, prefix="/tv_shows")
-app.include_router(users.router, prefix="/users")
+# How long to wait between attempts at warming up when the database is unreachable.
+WARM_UP_RETRY_SECONDS = (0.5, 1, 2, 5)
+# The errors of a database that isn't reachable yet. ``ServerSelectionTimeoutError`` is a
+# ``ConnectionFailure``.
+WARM_UP_RETRY_ERRORS = (ConnectionFailure, CircuitOpen)
+
+
+async def warm_up(app: FastAPI, config: Config):
+    """
+    Warm up the worker, then mark the app ready.
+
+    This builds the storage engine, opens the database connection pool, makes sure the indexes
+    exist and loads the revoked tokens, which are then refreshed in the background.
+
+    Retries until it succeeds while the database can't be reached, so a worker started before
+    the database becomes ready on its own. Any other error (e.g. an ``OperationFailure`` for bad
+    credentials) won't go away by retrying, so it is raised instead.
+
+    :param app: The app to mark ready.
+    :param config: The ``Config``.
+    :raises PyMongoError: If warming up failed for another reason than the database being
+    unreachable.
+    """
+    start = time.perf_counter()
+    engine = get_engine()
+    loop = asyncio.get_event_loop()
+    connections = max(1, config["db"].getint("min_pool_size"))
+    # Building the engine may load a snapshot, keep that off the event loop.
+    await loop.run_in_executor(None, engine.resolve)
+    for attempt in itertools.count(1):
+        try:
+            # Concurrent pings each check out a connection, so the pool holds this many after.
+            await asyncio.gather(*(
+                loop.run_in_executor(None, engine.ping) for _ in range(connections)))
+            LOGGER.info('Ensuring database indexes.')
+            await movies.MOVIE_DAO.ensure_indexes()
+            await tvshows.TV_SHOW_DAO.ensure_indexes()
+            await users.USER_DAO.ensure_indexes()
+            await app.state.rate_limit_backend.ensure_indexes()
+            await authenticate.REVOCATION_DAO.ensure_indexes()
+            # Until then, ``get_token_claims`` rejects every token with a 503.
+            await REVOCATIONS.refresh(authenticate.REVOCATION_DAO)
+            break
+        except WARM_UP_RETRY_ERRORS as e:
+            delay = WARM_UP_RETRY_SECONDS[min(attempt, len(WARM_UP_RETRY_SECONDS)) - 1]
+            LOGGER.warning('Warm up attempt %s failed, retrying in %ss: %s', attempt, delay, e)
+            await asyncio.sleep(delay)
+    app.state.warm_up_seconds = time.perf_counter() - start
+    app.state.ready = True
+    LOGGER.info('Ready after warming up for %.3fs.', app.state.warm_up_seconds)
+    asyncio.ensure_future(refresh_revocations(
+        REVOCATIONS, authenticate.REVOCATION_DAO,
+        interval=config["app"].getfloat("revocation_refresh_seconds")))
+
+
+def stop_on_warm_up_failure(app: FastAPI, warm_up_task: asyncio.Future):
+    """
+    Stop the worker if warming up failed, rather than leaving it up but never ready.
+
+    ``/health`` and ``/ready`` report the failure until the worker is stopped.
+
+    :param app: The app that was warming up.
+    :param warm_up_task: The finished warm up.
+    """
+    if warm_up_task.cancelled() or warm_up_task.exception() is None:
+        return
+    app.state.warm_up_error = warm_up_task.exception()
+    LOGGER.critical('Warm up failed, stopping the worker: %s', app.state.warm_up_error,
+                    exc_info=app.state.warm_up_error)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+def create_app(config: Config = None) -> FastAPI:
+    """
+    Build the FastAPI app.
+
+    Importing fsubs does no I/O: the config is read here and the database is only connected to by
+    the startup handlers, which warm up in the background while ``/ready`` reports 503.
+
+    :param config: The config to build the app with. Defaults to the ``Config`` singleton.
+    :returns: The app, or the mirror app if ``read_only_snapshot`` is set.
+    """
+    config = config or Config()
+
+    if RESOLVED_CONFIG_VAR in os.environ and not logging.getLogger().handlers:
+        # Worker processes started by the CLI don't inherit its logging setup.
+        logs.setup_logging_from_config(config)
+    if config["app"]["read_only_snapshot"]:
+        return create_mirror_app(config)
+
+    LOGGER.info('Building FastAPI app with base url: <%s>.', openapi_prefix)
+    app = FastAPI(openapi_prefix=openapi_prefix)
+    app.state.ready = False
+
+    LOGGER.info('Setting up FastAPI middleware.')
+    LOGGER.debug('Using origins: <%s>.', origins)
+    # Inside the stale cache, so it can answer the requests that were shed.
+    app.add_middleware(AdmissionMiddleware, admissions=admissions_from_config(config))
+    # Inside CORS, so cached responses don't carry the CORS headers of another origin.
+    app.add_middleware(
+        StaleCacheMiddleware,
+        max_entries=config["app"].getint("stale_cache_size"),
+        max_age_seconds=config["app"].getfloat("stale_cache_max_age_seconds"),
+    )
+    # Outside the stale cache, so a rate limited client gets a 429 rather than a cached page.
+    rate_limits = rate_limits_from_config(
+        config, client=get_client() if config["db"]["engine"] == 'mongo' else None)
+    app.add_middleware(RateLimitMiddleware, **rate_limits)
+    app.state.rate_limit_backend = rate_limits['backend']
+    app.add_middleware(
+        DeadlineMiddleware,
+        timeout_ms=config["app"].getfloat("request_timeout_ms"),
+        max_time_ms=config["db"].getint("max_time_ms"),
+    )
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=origins,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    app.add_middleware(metrics_utils.MetricsMiddleware)
+    app.add_middleware(
+        ServerTimingMiddleware,
+        max_queries=config["app"].getint("max_queries_per_request"),
+        max_db_ms=config["app"].getfloat("max_db_ms_per_request"),
+    )
+    SLOW_QUERIES.configure_from_config(config)
+    BREAKER.configure_from_config(config)
+    # Parse the jwt keys once, failing at startup rather than on the first login.
+    KEYS.configure_from_config(config)
+    TOKEN_CACHE.configure_from_config(config)
+    for error in (CircuitOpen, DeadlineExceeded, ConnectionFailure, ExecutionTimeout):
+        app.add_exception_handler(error, unavailable_handler)
+
+    LOGGER.info('Loading routers.')
+    authenticate.set_token_url(config["app"]["base_url"])
+    app.include_router(health.router)
+    app.include_router(authenticate.router, prefix="/authenticate")
+    app.include_router(debug.router, prefix="/debug")
+    app.include_router(metrics.router, prefix="/metrics")
+    app.include_router(movies.router, prefix="/movies")
+    app.include_router(tvshows.router, prefix="/tv_shows")
+    app.include_router(users.router, prefix="/users")
+
+    @app.on_event('startup')
+    async def start_warm_up():
+        """Warm up in the background, so the worker answers ``/health`` straight away."""
+        app.state.warm_up = asyncio.ensure_future(warm_up(app, config))
+        app.state.warm_up.add_done_callback(
+            lambda warm_up_task: stop_on_warm_up_failure(app, warm_up_task))
+
+    @app.on_event('startup')
+    async def start_snapshots():
+        """Start saving snapshots of the memory engine in the background, if enabled."""
+        interval = config["db"].getfloat("snapshot_interval_seconds")
+        if config["db"]["engine"] == 'memory' and config["db"]["snapshot_file"] and interval > 0:
+            asyncio.ensure_future(save_snapshots(get_engine().resolve(), interval))
+
+    @app.on_event('shutdown')
+    async def save_snapshot():
+        """Save a last snapshot of the memory engine, if it has a snapshot file."""
+        if config["db"]["engine"] == 'memory' and config["db"]["snapshot_file"]:
+            get_engine().save_snapshot()
+
+    @app.on_event('startup')
+    async def start_event_loop_monitor():
+        """Start measuring event loop lag in the background."""
+        asyncio.ensure_future(metrics_utils.monitor_event_loop_lag())
+
+    @app.on_event('startup')
+    async def start_watchdog():
+        """Start watching for blocking calls on the event loop, if enabled."""
+        threshold_ms = config["debug"].getfloat("blocking_threshold_ms")
+        if threshold_ms > 0:
+            WATCHDOG.start(
+                threshold_ms=threshold_ms,
+                sample_rate=config["debug"].getfloat("blocking_sample_rate"))
+
+    return app
+
+
+def create_mirror_app(config: Config) -> FastAPI:
+    """
+    Build the FastAPI app of a read-only mirror.
+
+    It serves the catalog ``GET`` routes from the snapshot at ``read_only_snapshot``, built with
+    ``fsubs snapshot build``, and never connects to a database. Other routes answer 404 or 405.
+
+    :param config: The config to build the app with.
+    :returns: The app.
+    """
+    start = time.perf_counter()
+    snapshot = MirrorSnapshot(config["app"]["read_only_snapshot"])
+    LOGGER.info('Serving snapshot %s built at %s: %s.', snapshot.path,
+                snapshot.built_at.isoformat(), snapshot.counts())
+    app = FastAPI(openapi_prefix=openapi_prefix)
+    app.state.snapshot = snapshot
+    # Mapping the file is all there is to warm up.
+    app.state.ready = True
+    app.state.warm_up_seconds = time.perf_counter() - start
+
+    rate_limits = rate_limits_from_config(config, client=None)
+    app.add_middleware(RateLimitMiddleware, **rate_limits)
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=origins,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    app.add_middleware(metrics_utils.MetricsMiddleware)
+    app.add_middleware(
+        ServerTimingMiddleware,
+        max_queries=config["app"].getint("max_queries_per_request"),
+        max_db_ms=config["app"].getfloat("max_db_ms_per_request"),
+    )
+    app.include_router(health.router)
+    app.include_router(metrics.router, prefix="/metrics")
+    app.include_router(mirror.router)
+
+    @app.on_event('startup')
+    async def start_event_loop_monitor():
+        """Start measuring event loop lag in the background."""
+        asyncio.ensure_future(metrics_utils.monitor_event_loop_lag())
+
+    return app
+
+
+class LazyApp():
+    """
+    An ASGI app that builds the real app with ``create_app`` when it is first called.
+
+    Lets uvicorn import ``fsubs.routers.main:app`` without building anything at import time.
+    """
+
+    def __init__(self):
+        """Initialize a ``LazyApp``."""
+        self._app = None
+
+    def get(self) -> FastAPI:
+        """
+        Get the real app, building it if needed.
+
+        :returns: The app.
+        """
+        if self._app is None:
+            self._app = create_app()
+        return self._app
+
+    async def __call__(self, scope, receive, send):
+        """Handle an ASGI call with the real app."""
+        await self.get()(scope, receive, send)
+
+
+app = LazyApp()
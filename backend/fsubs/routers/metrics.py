@@ -0,0 +1,25 @@
+"""Defines logic used for endpoints at ``/metrics``."""
+
+import logging
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from fsubs.utils.metrics import REGISTRY
+from fsubs.utils.timing import TimedRoute
+
+router = APIRouter(route_class=TimedRoute)
+
+LOGGER = logging.getLogger(__name__)
+
+
+@router.get("", tags=["metrics"], response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    Get the metrics of this worker in the Prometheus text format.
+
+    Includes per handler request counts and latency, per DAO method call counts and latency, Mongo
+    connection pool checkouts and event loop lag.
+    """
+    return PlainTextResponse(
+        REGISTRY.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
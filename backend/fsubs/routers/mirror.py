@@ -0,0 +1,401 @@
+"""REST API of a read-only mirror, serving the catalog from a snapshot."""
+import json
+import logging
+from typing import Any, Callable, Dict, List, Optional
+
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, Response
+
+from fsubs.config.config import Config
+from fsubs.crud.mirror import MirrorSnapshot
+from fsubs.models.misc import ObjectIdStr, SortBy, SortOrder
+from fsubs.models.tvshow import TVShowEpisodeInDB, TVShowInDB
+from fsubs.models.video import (
+    BluRegion,
+    DiscType,
+    DVDRegion,
+    SubType,
+    VideoBaseInDB,
+    VideoInstanceInDB,
+)
+from fsubs.utils.fields import parse_fields
+from fsubs.utils.timing import TimedRoute
+
+LOGGER = logging.getLogger(__name__)
+router = APIRouter(route_class=TimedRoute)
+config = Config()
+
+REGIONS = {region.value for region in (*DVDRegion, *BluRegion)}
+
+
+class SnapshotResponse(Response):
+    """A JSON response sending slices of the snapshot as they are, without copying them."""
+
+    media_type = 'application/json'
+
+    def render(self, content: Any) -> Any:
+        """Use the content as the body."""
+        return content
+
+
+def _snapshot(request: Request) -> MirrorSnapshot:
+    """Get the snapshot of the app."""
+    return request.app.state.snapshot
+
+
+def _check_ids(ids: List[str]):
+    """Reject batches over ``batch_max_ids``, like the API does."""
+    max_ids = config["app"].getint("batch_max_ids")
+    if len(ids) > max_ids:
+        raise HTTPException(status_code=422, detail=f'Cannot get more than {max_ids} ids at once.')
+
+
+def _check_explain(explain: bool):
+    """Reject ``explain``, there is no query plan to return."""
+    if explain:
+        raise HTTPException(status_code=422, detail='explain is not available on a mirror.')
+
+
+def _respond(document: Optional[memoryview], projection: Optional[Dict[str, bool]],
+             not_found: str) -> Response:
+    """Respond with a document, or with the projected fields of it."""
+    if document is None:
+        raise HTTPException(status_code=404, detail=not_found)
+    if projection:
+        return JSONResponse(content=_project(document, projection))
+    return SnapshotResponse(document)
+
+
+def _respond_list(documents: List[Optional[memoryview]],
+                  projection: Optional[Dict[str, bool]]) -> Response:
+    """Respond with a JSON array of documents, ``None`` being ``null``."""
+    if projection:
+        return JSONResponse(content=[
+            _project(document, projection) if document is not None else None
+            for document in documents])
+    if not documents:
+        return SnapshotResponse(b'[]')
+    parts = []
+    for document in documents:
+        parts.append(document if document is not None else b'null')
+        parts.append(b',')
+    parts[-1] = b']'
+    # A single copy of each document, into the body.
+    return SnapshotResponse(b''.join([b'[', *parts]))
+
+
+def _respond_children(children: Optional[memoryview],
+                      projection: Optional[Dict[str, bool]]) -> Response:
+    """Respond with the JSON array of the children of a title."""
+    if children is None:
+        return SnapshotResponse(b'[]')
+    if projection:
+        include = {'id', *projection}
+        return JSONResponse(content=[
+            {key: value for key, value in child.items() if key in include}
+            for child in json.loads(bytes(children))])
+    return SnapshotResponse(children)
+
+
+def _project(document: memoryview, projection: Dict[str, bool]) -> Dict[str, Any]:
+    """Decode a document, keeping ``id`` and the fields of the projection."""
+    include = {'id', *projection}
+    return {key: value for key, value in json.loads(bytes(document)).items() if key in include}
+
+
+def _title_filter(snapshot: MirrorSnapshot, collection: str, search: Dict[str, Any],
+                  child_search: Dict[str, Any]) -> Optional[Callable[[memoryview], bool]]:
+    """
+    Build the filter of a page of titles.
+
+    :param snapshot: The snapshot.
+    :param collection: The title collection.
+    :param search: The values the fields of the titles must equal, by dotted path.
+    :param child_search: The values the fields of at least one child of a title must equal.
+    :returns: The filter, or ``None`` to keep every title.
+    """
+    if not search and not child_search:
+        return None
+
+    def matches(document: Dict[str, Any], values: Dict[str, Any]) -> bool:
+        for field, value in values.items():
+            found = document
+            for part in field.split('.'):
+                found = found.get(part) if isinstance(found, dict) else None
+            if found != value:
+                return False
+        return True
+
+    def keep(record: memoryview) -> bool:
+        title = json.loads(bytes(record))
+        if not matches(title, search):
+            return False
+        if not child_search:
+            return True
+        children = snapshot.children(collection, title['id'])
+        return children is not None and any(
+            matches(child, child_search) for child in json.loads(bytes(children)))
+    return keep
+
+
+# /movies endpoints
+
+# Declared before "/movies/{uri}" so that "versions" isn't matched as a movie uri.
+@router.get(
+    "/movies/versions",
+    response_model=List[Optional[VideoInstanceInDB]],
+    tags=['movie versions'])
+async def get_movie_versions_by_ids(
+        request: Request,
+        ids: List[ObjectIdStr] = Query(...),
+        fields: str = None):
+    """
+    Get several movie versions at once.
+
+    **ids** - The uris of the movie versions to get.
+
+    **fields** - A comma separated list of fields to return. Defaults to all fields.
+
+    **returns** - The movie versions in the same order as `ids`, with `null` for movie versions
+    that were not found.
+    """
+    _check_ids(ids)
+    projection = parse_fields(fields, VideoInstanceInDB)
+    snapshot = _snapshot(request)
+    return _respond_list(
+        [snapshot.get('movie_versions', movie_version_id) for movie_version_id in ids],
+        projection)
+
+
+@router.get(
+    "/movies/versions/{uri}",
+    response_model=VideoInstanceInDB,
+    tags=['movie versions'])
+async def get_movie_version(request: Request, uri: ObjectIdStr, fields: str = None):
+    """
+    Get a movie version.
+
+    **uri** - The uri of the version of the movie to get.
+
+    **fields** - A comma separated list of fields to return. Defaults to all fields.
+
+    **returns** - The movie version data.
+    """
+    projection = parse_fields(fields, VideoInstanceInDB)
+    return _respond(
+        _snapshot(request).get('movie_versions', uri), projection, 'Movie version not found.')
+
+
+@router.get(
+    "/movies/{uri}/versions",
+    response_model=List[VideoInstanceInDB],
+    tags=['movie versions'])
+async def get_movie_versions(request: Request, uri: ObjectIdStr, fields: str = None):
+    """
+    Get **all** of the versions for a movie.
+
+    **uri** - The uri of movie to get all versions.
+
+    **fields** - A comma separated list of fields to return. Defaults to all fields.
+
+    **returns** - A list of movie versions.
+    """
+    projection = parse_fields(fields, VideoInstanceInDB)
+    return _respond_children(_snapshot(request).children('movies', uri), projection)
+
+
+@router.get(
+    "/movies/{uri}",
+    response_model=VideoBaseInDB,
+    tags=['movies'])
+async def get_movie(request: Request, uri: ObjectIdStr, fields: str = None):
+    """
+    Get a movie.
+
+    **param uri** - The uri of the movie to get.
+
+    **param fields** - A comma separated list of fields to return. Defaults to all fields.
+
+    **returns** - The movie data.
+    """
+    projection = parse_fields(fields, VideoBaseInDB)
+    return _respond(_snapshot(request).get('movies', uri), projection, 'Movie not found.')
+
+
+@router.get(
+    "/movies",
+    response_model=List[Optional[VideoBaseInDB]],
+    tags=['movies'])
+async def get_movies(
+        request: Request,
+        ids: List[ObjectIdStr] = Query(None),
+        fields: str = None,
+        start: int = Query(0, ge=0),
+        page_length: int = Query(100, ge=1),
+        no_subs: bool = None,
+        disc_type: DiscType = None,
+        region: str = None,
+        sub_type: SubType = None,
+        created_by: str = None,
+        sort: SortBy = None,
+        order: SortOrder = SortOrder.asc,
+        explain: bool = False):
+    """
+    Get movies, with the same parameters as the API.
+
+    Filtered pages go through the movies in order until the page is full, the others only read
+    the movies of the page. `explain` is not available.
+
+    **returns** - A list of movies.
+    """
+    projection = parse_fields(fields, VideoBaseInDB)
+    snapshot = _snapshot(request)
+    if ids:
+        _check_ids(ids)
+        return _respond_list([snapshot.get('movies', movie_id) for movie_id in ids], projection)
+    _check_explain(explain)
+    if region is not None and region not in REGIONS:
+        raise HTTPException(status_code=422, detail=f'Invalid region: {region}.')
+    search = {}
+    if no_subs is not None:
+        search['no_subs'] = no_subs
+    if created_by is not None:
+        search['metadata.created_by'] = created_by
+    version_search = {}
+    if disc_type is not None:
+        version_search['disc_type'] = disc_type.value
+    if region is not None:
+        version_search['region'] = region
+    if sub_type is not None:
+        version_search['sub_type'] = sub_type.value
+    movies = snapshot.titles(
+        'movies',
+        skip=start,
+        limit=page_length,
+        sort_by=sort.value if sort else None,
+        descending=order == SortOrder.desc,
+        keep=_title_filter(snapshot, 'movies', search, version_search))
+    return _respond_list(movies, projection)
+
+
+# /tv_shows endpoints
+
+# Declared before "/tv_shows/{uri}" so that "episodes" isn't matched as a tv show uri.
+@router.get(
+    "/tv_shows/episodes",
+    response_model=List[Optional[TVShowEpisodeInDB]],
+    tags=['tv show episodes'])
+async def get_tv_show_episodes_by_ids(
+        request: Request,
+        ids: List[ObjectIdStr] = Query(...),
+        fields: str = None):
+    """
+    Get several tv show episodes at once.
+
+    **ids** - The uris of the tv show episodes to get.
+
+    **fields** - A comma separated list of fields to return. Defaults to all fields.
+
+    **returns** - The tv show episodes in the same order as `ids`, with `null` for tv show
+    episodes that were not found.
+    """
+    _check_ids(ids)
+    projection = parse_fields(fields, TVShowEpisodeInDB)
+    snapshot = _snapshot(request)
+    return _respond_list(
+        [snapshot.get('tv_show_episodes', episode_id) for episode_id in ids], projection)
+
+
+@router.get(
+    "/tv_shows/episodes/{uri}",
+    response_model=TVShowEpisodeInDB,
+    tags=['tv show episodes'])
+async def get_tv_show_episode(request: Request, uri: ObjectIdStr, fields: str = None):
+    """
+    Get a tv show episode.
+
+    **param uri** - The uri of the tv show episode to get.
+
+    **param fields** - A comma separated list of fields to return. Defaults to all fields.
+
+    **returns** - The tv show episode data.
+    """
+    projection = parse_fields(fields, TVShowEpisodeInDB)
+    return _respond(
+        _snapshot(request).get('tv_show_episodes', uri), projection, 'tv episode not found.')
+
+
+@router.get(
+    "/tv_shows/{uri}/episodes",
+    response_model=List[TVShowEpisodeInDB],
+    tags=['tv show episodes'])
+async def get_tv_show_episodes(request: Request, uri: ObjectIdStr, fields: str = None):
+    """
+    Get **all** tv show episodes.
+
+    **param uri** - The uri of the tv show to get the episodes of.
+
+    **param fields** - A comma separated list of fields to return. Defaults to all fields.
+
+    **returns** - A list of tv show episodes.
+    """
+    projection = parse_fields(fields, TVShowEpisodeInDB)
+    return _respond_children(_snapshot(request).children('tv_shows', uri), projection)
+
+
+@router.get(
+    "/tv_shows/{uri}",
+    response_model=TVShowInDB,
+    tags=['tv shows'])
+async def get_tv_show(request: Request, uri: ObjectIdStr, fields: str = None):
+    """
+    Get a tv show.
+
+    **param uri** - The uri of the tv show to get.
+
+    **param fields** - A comma separated list of fields to return. Defaults to all fields.
+
+    **returns** - The tv show data.
+    """
+    projection = parse_fields(fields, TVShowInDB)
+    return _respond(_snapshot(request).get('tv_shows', uri), projection, 'TV show not found.')
+
+
+@router.get(
+    "/tv_shows",
+    response_model=List[TVShowInDB],
+    tags=['tv shows'])
+async def get_tv_shows(
+        request: Request,
+        fields: str = None,
+        start: int = Query(0, ge=0),
+        page_length: int = Query(100, ge=1),
+        no_subs: bool = None,
+        created_by: str = None,
+        sort: SortBy = None,
+        order: SortOrder = SortOrder.asc,
+        explain: bool = False):
+    """
+    Get tv shows, with the same parameters as the API.
+
+    Filtered pages go through the tv shows in order until the page is full, the others only read
+    the tv shows of the page. `explain` is not available.
+
+    **returns** - A list of tv shows.
+    """
+    _check_explain(explain)
+    projection = parse_fields(fields, TVShowInDB)
+    snapshot = _snapshot(request)
+    search = {}
+    if no_subs is not None:
+        search['no_subs'] = no_subs
+    if created_by is not None:
+        search['metadata.created_by'] = created_by
+    tv_shows = snapshot.titles(
+        'tv_shows',
+        skip=start,
+        limit=page_length,
+        sort_by=sort.value if sort else None,
+        descending=order == SortOrder.desc,
+        keep=_title_filter(snapshot, 'tv_shows', search, {}))
+    return _respond_list(tv_shows, projection)
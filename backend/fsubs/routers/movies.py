@@ -1,35 +1,46 @@
 """REST API movie functions."""
 import logging
 from datetime import datetime, timezone
-from typing import List
+from typing import List, Optional
 
 
 import addict as ad
 from fastapi import APIRouter, Depends, Query, HTTPException
-from pymongo import MongoClient
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
 
 from fsubs.config.config import Config
+from fsubs.crud.db import get_engine
 from fsubs.crud.movie import MovieDAO
+from fsubs.crud.stats import VERSION_STATS
 from fsubs.crud.user import UserDAO
-from fsubs.models.misc import ObjectIdStr
-from fsubs.models.video import VideoBase, VideoBaseInDB, VideoInstance, VideoInstanceInDB
+from fsubs.models.misc import ObjectIdStr, SortBy, SortOrder
+from fsubs.models.video import (
+    BluRegion,
+    DiscType,
+    DVDRegion,
+    SubType,
+    VideoBase,
+    VideoBaseInDB,
+    VideoInstance,
+    VideoInstanceInDB,
+)
 from fsubs.models.user import Access
-from fsubs.routers.authenticate import get_token_header
+from fsubs.routers.authenticate import get_explain, get_token_header
+from fsubs.utils.fields import parse_fields, partial_response
+from fsubs.utils.timing import TimedRoute
 from fsubs.utils.users import check_access
 
 LOGGER = logging.getLogger(__name__)
-router = APIRouter()
+router = APIRouter(route_class=TimedRoute)
 config = Config()
 
-client = MongoClient(
-    host=config["db"]["hostname"],
-    port=config["db"].getint("port"),
-    username='root',
-    password='example',
-)
+engine = get_engine()
+
+MOVIE_DAO = MovieDAO(engine=engine)
+USER_DAO = UserDAO(engine=engine)
 
-MOVIE_DAO = MovieDAO(client=client)
-USER_DAO = UserDAO(client=client)
+REGIONS = {region.value for region in (*DVDRegion, *BluRegion)}
 
 # /movies endpoints
 
@@ -49,7 +60,7 @@ async def create_movie(
 
     **returns** - The id of the newly created movie.
     """
-    LOGGER.info(f'Creating movie: <{movie}> as user: <{username}>.')
+    LOGGER.info('Creating movie: <%s> as user: <%s>.', movie, username)
     movie_to_store = ad.Dict(movie.dict())
 
     # Set metadata
@@ -60,44 +71,157 @@ async def create_movie(
     return str(await MOVIE_DAO.create(movie=movie_to_store.to_dict()))
 
 
+# Declared before "/{uri}" so that "versions" isn't matched as a movie uri.
+@router.get(
+    "/versions",
+    response_model=List[Optional[VideoInstanceInDB]],
+    tags=['movie versions'],
+    status_code=200)
+async def get_movie_versions_by_ids(
+        ids: List[ObjectIdStr] = Query(...),
+        fields: str = None):
+    """
+    Get several movie versions at once.
+
+    **ids** - The uris of the movie versions to get.
+
+    **fields** - A comma separated list of fields to return (e.g. `id,timestamps`). Defaults to
+    all fields.
+
+    **returns** - The movie versions in the same order as `ids`, with `null` for movie versions
+    that were not found.
+    """
+    LOGGER.info('Getting movie versions: %s.', ids)
+    max_ids = config["app"].getint("batch_max_ids")
+    if len(ids) > max_ids:
+        raise HTTPException(status_code=422, detail=f'Cannot get more than {max_ids} ids at once.')
+    projection = parse_fields(fields, VideoInstanceInDB)
+    movie_versions = await MOVIE_DAO.read_versions(movie_version_ids=ids, projection=projection)
+    if projection:
+        return partial_response(VideoInstanceInDB, movie_versions, projection)
+    return movie_versions
+
+
 @router.get(
     "/{uri}",
     response_model=VideoBaseInDB,
     tags=['movies'])
 async def get_movie(
-        uri: ObjectIdStr):
+        uri: ObjectIdStr,
+        fields: str = None):
     """
     Get a movie.
 
     **param uri** - The uri of the movie to get.
 
+    **param fields** - A comma separated list of fields to return (e.g. `id,title`). Defaults to
+    all fields.
+
     **returns** - The movie data.
     """
-    LOGGER.info(f'Getting movie: {uri}.')
-    movie = await MOVIE_DAO.read(movie_id=uri)
+    LOGGER.info('Getting movie: %s.', uri)
+    projection = parse_fields(fields, VideoBaseInDB)
+    if projection:
+        movie = await MOVIE_DAO.read(movie_id=uri, projection=projection)
+    else:
+        movie = await MOVIE_DAO.load(movie_id=uri)
     if not movie:
         raise HTTPException(status_code=404, detail="Movie not found.")
+    if projection:
+        return partial_response(VideoBaseInDB, movie, projection)
     return movie
 
 
 @router.get(
     "",
-    response_model=List[VideoBaseInDB],
+    response_model=List[Optional[VideoBaseInDB]],
     tags=['movies'])
 async def get_movies(
+        ids: List[ObjectIdStr] = Query(None),
+        fields: str = None,
         start: int = Query(0, ge=0),
-        page_length: int = Query(100, ge=1)):
+        page_length: int = Query(100, ge=1),
+        no_subs: bool = None,
+        disc_type: DiscType = None,
+        region: str = None,
+        sub_type: SubType = None,
+        created_by: str = None,
+        sort: SortBy = None,
+        order: SortOrder = SortOrder.asc,
+        explain: bool = Depends(get_explain)):
     """
     Get movies.
 
+    **param ids** - Get the movies with the given uris instead of a page of movies. The other
+    parameters (except `fields`) are ignored. Movies that were not found are returned as `null`.
+
+    **param fields** - A comma separated list of fields to return (e.g. `id,title`). Defaults to
+    all fields.
+
     **param start** - The starting position to start getting movies at.
 
     **param page_length** - The number of movies to get.
 
+    **param no_subs** - Only get movies with the given `no_subs` value.
+
+    **param disc_type** - Only get movies with a version of the given disc type.
+
+    **param region** - Only get movies with a version of the given region.
+
+    **param sub_type** - Only get movies with a version of the given subtitle type.
+
+    **param created_by** - Only get movies created by the given user.
+
+    **param sort** - The field to sort by. Titles are sorted case-insensitively. Defaults to the
+    natural order.
+
+    **param order** - The order to sort in.
+
+    **param explain** - Return the query plan (including the indexes used) instead of the movies.
+    Requires `admin` level access.
+
     **returns** - A list of movies.
     """
-    LOGGER.info(f'Getting movies with start: <{start}> and page_length: <{page_length}>.')
-    return await MOVIE_DAO.read_multi(limit=page_length, skip=start)
+    projection = parse_fields(fields, VideoBaseInDB)
+    if ids:
+        LOGGER.info('Getting movies: %s.', ids)
+        max_ids = config["app"].getint("batch_max_ids")
+        if len(ids) > max_ids:
+            raise HTTPException(
+                status_code=422, detail=f'Cannot get more than {max_ids} ids at once.')
+        movies = await MOVIE_DAO.read_many(movie_ids=ids, projection=projection)
+        if projection:
+            return partial_response(VideoBaseInDB, movies, projection)
+        return movies
+    LOGGER.info('Getting movies with start: <%s> and page_length: <%s>.', start, page_length)
+    if region is not None and region not in REGIONS:
+        raise HTTPException(status_code=422, detail=f'Invalid region: {region}.')
+    search = {}
+    if no_subs is not None:
+        search['no_subs'] = no_subs
+    if created_by is not None:
+        search['metadata.created_by'] = created_by
+    version_search = {}
+    if disc_type is not None:
+        version_search['disc_type'] = disc_type.value
+    if region is not None:
+        version_search['region'] = region
+    if sub_type is not None:
+        version_search['sub_type'] = sub_type.value
+    movies = await MOVIE_DAO.read_multi(
+        limit=page_length,
+        skip=start,
+        search=search,
+        version_search=version_search,
+        sort_by=sort.value if sort else None,
+        descending=order == SortOrder.desc,
+        explain=explain,
+        projection=projection)
+    if explain:
+        return JSONResponse(content=jsonable_encoder(movies))
+    if projection:
+        return partial_response(VideoBaseInDB, movies, projection)
+    return movies
 
 
 @router.put(
@@ -120,7 +244,7 @@ async def update_movie(
 
     **returns** - The new movie data.
     """
-    LOGGER.info(f'Updating movie: <{uri}> with data: <{movie}> and user: <{username}>.')
+    LOGGER.info('Updating movie: <%s> with data: <%s> and user: <%s>.', uri, movie, username)
     acting_user = ad.Dict(await USER_DAO.read_by_username(username=username))
     if not acting_user:
         raise HTTPException(status_code=401, detail=f'User {username} unauthorized, were '
@@ -132,7 +256,7 @@ async def update_movie(
         level=Access.power)
     old_movie = ad.Dict(await MOVIE_DAO.read(movie_id=uri))
     if not old_movie:
-        LOGGER.debug(f'Movie not found for: {uri}.')
+        LOGGER.debug('Movie not found for: %s.', uri)
         raise HTTPException(status_code=404, detail="Movie not found.")
 
     # Set metadata
@@ -143,6 +267,8 @@ async def update_movie(
 
     await MOVIE_DAO.update(movie_id=uri, movie=movie_to_store.to_dict())
 
+    movie_to_store.update(
+        {field: old_movie[field] for field in VERSION_STATS if field in old_movie})
     movie_to_store.id = uri
     return movie_to_store
 
@@ -165,7 +291,7 @@ async def delete_movie(
 
     **returns** - No content.
     """
-    LOGGER.info(f'Deleting movie: <{uri}> as user <{username}>.')
+    LOGGER.info('Deleting movie: <%s> as user <%s>.', uri, username)
     acting_user = ad.Dict(await USER_DAO.read_by_username(username=username))
     if not acting_user:
         raise HTTPException(status_code=401, detail=f'User {username} unauthorized, were '
@@ -202,8 +328,8 @@ async def create_movie_version(
     movie = await MOVIE_DAO.read(movie_id=uri)
     if not movie:
         raise HTTPException(status_code=422, detail='uri must be valid movie id.')
-    LOGGER.info(f'Creating movie version for movie: <{uri}> with data: <{movie_version}> and '
-                f'user: <{username}>.')
+    LOGGER.info('Creating movie version for movie: <%s> with data: <%s> and user: <%s>.',
+                uri, movie_version, username)
     movie_version_to_store = ad.Dict(movie_version.dict())
 
     # Set metadata
@@ -222,18 +348,25 @@ async def create_movie_version(
     tags=['movie versions'],
     status_code=200)
 async def get_movie_version(
-        uri: ObjectIdStr):
+        uri: ObjectIdStr,
+        fields: str = None):
     """
     Get a movie version.
 
     **uri** - The uri of the version of the movie to get.
 
+    **fields** - A comma separated list of fields to return (e.g. `id,timestamps`). Defaults to
+    all fields.
+
     **returns** - The movie version data.
     """
-    LOGGER.info(f'Getting movie version: <{uri}>.')
-    movie_version = await MOVIE_DAO.read_version(movie_version_id=uri)
+    LOGGER.info('Getting movie version: <%s>.', uri)
+    projection = parse_fields(fields, VideoInstanceInDB)
+    movie_version = await MOVIE_DAO.read_version(movie_version_id=uri, projection=projection)
     if not movie_version:
         raise HTTPException(status_code=404, detail="Movie version not found.")
+    if projection:
+        return partial_response(VideoInstanceInDB, movie_version, projection)
     return movie_version
 
 
@@ -243,16 +376,23 @@ async def get_movie_version(
     tags=['movie versions'],
     status_code=200)
 async def get_movie_versions(
-        uri: ObjectIdStr):
+        uri: ObjectIdStr,
+        fields: str = None):
     """
     Get **all** of the versions for a movie.
 
     **uri** - The uri of movie to get all versions.
 
+    **fields** - A comma separated list of fields to return (e.g. `id,timestamps`). Defaults to
+    all fields.
+
     **returns** - A list of movie versions.
     """
-    LOGGER.info(f'Getting movie versions for movie: {uri}.')
-    movie_versions = await MOVIE_DAO.read_movie_versions(movie_id=uri)
+    LOGGER.info('Getting movie versions for movie: %s.', uri)
+    projection = parse_fields(fields, VideoInstanceInDB)
+    movie_versions = await MOVIE_DAO.read_movie_versions(movie_id=uri, projection=projection)
+    if projection:
+        return partial_response(VideoInstanceInDB, movie_versions, projection)
     return movie_versions
 
 
@@ -272,7 +412,7 @@ async def delete_movie_versions(
 
     **returns** - No content.
     """
-    LOGGER.info(f'Deleting movie versions for movie: <{uri}> as user <{username}>.')
+    LOGGER.info('Deleting movie versions for movie: <%s> as user <%s>.', uri, username)
     acting_user = ad.Dict(await USER_DAO.read_by_username(username=username))
     if not acting_user:
         raise HTTPException(status_code=401, detail=f'User {username} unauthorized, were '
@@ -304,8 +444,8 @@ async def update_movie_version(
 
     **returns** - The new movie version data.
     """
-    LOGGER.info(f'Updating movie version uri: <{uri}> with movie_version: <{movie_version}> and '
-                f'user: <{username}>.')
+    LOGGER.info('Updating movie version uri: <%s> with movie_version: <%s> and user: <%s>.',
+                uri, movie_version, username)
     acting_user = ad.Dict(await USER_DAO.read_by_username(username=username))
     if not acting_user:
         raise HTTPException(status_code=401, detail=f'User {username} unauthorized, were '
@@ -326,11 +466,9 @@ async def update_movie_version(
     movie_version_to_store.metadata.last_modified = datetime.now(timezone.utc)
     movie_version_to_store.metadata.modified_by = username
 
-    await MOVIE_DAO.update_version(
+    updated_movie = await MOVIE_DAO.update_version(
         movie_version_id=uri,
         movie_version=movie_version_to_store.to_dict())
-
-    updated_movie = await MOVIE_DAO.read_version(movie_version_id=uri)
     if not updated_movie:
         msg = "Something went wrong while trying to update the movie version: {uri}."
         LOGGER.error(msg)
@@ -356,7 +494,7 @@ async def delete_movie_version(
 
     **returns** - No content.
     """
-    LOGGER.info(f'Deleting movie version: <{uri}> as user <{username}>.')
+    LOGGER.info('Deleting movie version: <%s> as user <%s>.', uri, username)
     acting_user = ad.Dict(await USER_DAO.read_by_username(username=username))
     if not acting_user:
         raise HTTPException(status_code=401, detail=f'User {username} unauthorized, were '
@@ -2,35 +2,35 @@
 
 import logging
 from datetime import datetime, timezone
-from typing import List
+from typing import List, Optional
 
 import addict as ad
 from fastapi import APIRouter, Depends, HTTPException, Query
-from pymongo import MongoClient
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
 
 from fsubs.config.config import Config
+from fsubs.crud.db import get_engine
+from fsubs.crud.stats import TV_SHOW_STATS
 from fsubs.crud.tvshow import TVShowDAO
 from fsubs.crud.user import UserDAO
-from fsubs.models.misc import ObjectIdStr
+from fsubs.models.misc import ObjectIdStr, SortBy, SortOrder
 from fsubs.models.tvshow import TVShowEpisode, TVShowEpisodeInDB, TVShowInDB
-from fsubs.models.video import VideoBase, VideoBaseInDB, VideoInstanceInDB
+from fsubs.models.video import VideoBase, VideoInstanceInDB
 from fsubs.models.user import Access
-from fsubs.routers.authenticate import get_token_header
+from fsubs.routers.authenticate import get_explain, get_token_header
+from fsubs.utils.fields import parse_fields, partial_response
+from fsubs.utils.timing import TimedRoute
 from fsubs.utils.users import check_access
 
 LOGGER = logging.getLogger(__name__)
-router = APIRouter()
+router = APIRouter(route_class=TimedRoute)
 config = Config()
 
-client = MongoClient(
-    host=config["db"]["hostname"],
-    port=config["db"].getint("port"),
-    username='root',
-    password='example',
-)
+engine = get_engine()
 
-TV_SHOW_DAO = TVShowDAO(client=client)
-USER_DAO = UserDAO(client=client)
+TV_SHOW_DAO = TVShowDAO(engine=engine)
+USER_DAO = UserDAO(engine=engine)
 
 # /tv_shows endpoints
 
@@ -52,7 +52,7 @@ async def create_tv_show(
 
     **returns** - The id of the newly created tv show.
     """
-    LOGGER.info(f'Creating tv show: <{tv_show}> as user: <{username}>.')
+    LOGGER.info('Creating tv show: <%s> as user: <%s>.', tv_show, username)
     tv_show_to_store = ad.Dict(tv_show.dict())
 
     # Set metadata
@@ -63,44 +63,123 @@ async def create_tv_show(
     return str(await TV_SHOW_DAO.create(tv_show=tv_show_to_store.to_dict()))
 
 
+# Declared before "/{uri}" so that "episodes" isn't matched as a tv show uri.
+@router.get(
+    "/episodes",
+    response_model=List[Optional[TVShowEpisodeInDB]],
+    tags=['tv show episodes'])
+async def get_tv_show_episodes_by_ids(
+        ids: List[ObjectIdStr] = Query(...),
+        fields: str = None):
+    """
+    Get several tv show episodes at once.
+
+    **ids** - The uris of the tv show episodes to get.
+
+    **fields** - A comma separated list of fields to return (e.g. `id,title,season,episode`).
+    Defaults to all fields.
+
+    **returns** - The tv show episodes in the same order as `ids`, with `null` for tv show
+    episodes that were not found.
+    """
+    LOGGER.info('Getting tv show episodes: %s.', ids)
+    max_ids = config["app"].getint("batch_max_ids")
+    if len(ids) > max_ids:
+        raise HTTPException(status_code=422, detail=f'Cannot get more than {max_ids} ids at once.')
+    projection = parse_fields(fields, TVShowEpisodeInDB)
+    tv_episodes = await TV_SHOW_DAO.read_episodes(episode_ids=ids, projection=projection)
+    if projection:
+        return partial_response(TVShowEpisodeInDB, tv_episodes, projection)
+    return tv_episodes
+
+
 @router.get(
     "/{uri}",
-    response_model=VideoBaseInDB,
+    response_model=TVShowInDB,
     tags=['tv shows'])
 async def get_tv_show(
-        uri: ObjectIdStr):
+        uri: ObjectIdStr,
+        fields: str = None):
     """
     Get a tv show.
 
     **param uri** - The uri of the tv show to get.
 
+    **param fields** - A comma separated list of fields to return (e.g. `id,title`). Defaults to
+    all fields.
+
     **returns** - The tv show data.
     """
-    LOGGER.info(f'Getting tv show: {uri}.')
-    tv_show = await TV_SHOW_DAO.read(tv_show_id=uri)
+    LOGGER.info('Getting tv show: %s.', uri)
+    projection = parse_fields(fields, TVShowInDB)
+    if projection:
+        tv_show = await TV_SHOW_DAO.read(tv_show_id=uri, projection=projection)
+    else:
+        tv_show = await TV_SHOW_DAO.load(tv_show_id=uri)
     if not tv_show:
         raise HTTPException(status_code=404, detail="TV show not found.")
+    if projection:
+        return partial_response(TVShowInDB, tv_show, projection)
     return tv_show
 
 
 @router.get(
     "",
-    response_model=List[VideoBaseInDB],
+    response_model=List[TVShowInDB],
     tags=['tv shows'])
 async def get_tv_shows(
+        fields: str = None,
         start: int = Query(0, ge=0),
-        page_length: int = Query(100, ge=1)):
+        page_length: int = Query(100, ge=1),
+        no_subs: bool = None,
+        created_by: str = None,
+        sort: SortBy = None,
+        order: SortOrder = SortOrder.asc,
+        explain: bool = Depends(get_explain)):
     """
     Get tv shows.
 
+    **param fields** - A comma separated list of fields to return (e.g. `id,title`). Defaults to
+    all fields.
+
     **param start** - The starting position to start getting tv shows at.
 
     **param page_length** - The number of tv shows to get.
 
+    **param no_subs** - Only get tv shows with the given `no_subs` value.
+
+    **param created_by** - Only get tv shows created by the given user.
+
+    **param sort** - The field to sort by. Titles are sorted case-insensitively. Defaults to the
+    natural order.
+
+    **param order** - The order to sort in.
+
+    **param explain** - Return the query plan (including the indexes used) instead of the tv
+    shows. Requires `admin` level access.
+
     **returns** A list of tv shows.
     """
-    LOGGER.info(f'Getting tv shows with start: <{start}> and page_length: <{page_length}>.')
-    return await TV_SHOW_DAO.read_multi(limit=page_length, skip=start)
+    LOGGER.info('Getting tv shows with start: <%s> and page_length: <%s>.', start, page_length)
+    projection = parse_fields(fields, TVShowInDB)
+    search = {}
+    if no_subs is not None:
+        search['no_subs'] = no_subs
+    if created_by is not None:
+        search['metadata.created_by'] = created_by
+    tv_shows = await TV_SHOW_DAO.read_multi(
+        limit=page_length,
+        skip=start,
+        search=search,
+        sort_by=sort.value if sort else None,
+        descending=order == SortOrder.desc,
+        explain=explain,
+        projection=projection)
+    if explain:
+        return JSONResponse(content=jsonable_encoder(tv_shows))
+    if projection:
+        return partial_response(TVShowInDB, tv_shows, projection)
+    return tv_shows
 
 
 @router.put(
@@ -125,7 +204,7 @@ async def update_tv_show(
     
     **returns** - The new tv show data.
     """
-    LOGGER.info(f'Updating tv_show: <{uri}> with data: <{tv_show}> and user: <{username}>.')
+    LOGGER.info('Updating tv_show: <%s> with data: <%s> and user: <%s>.', uri, tv_show, username)
     acting_user = ad.Dict(await USER_DAO.read_by_username(username=username))
     if not acting_user:
         raise HTTPException(status_code=401, detail=f'User {username} unauthorized, were '
@@ -139,7 +218,7 @@ async def update_tv_show(
     # Set metadata
     old_tv_show = ad.Dict(await TV_SHOW_DAO.read(tv_show_id=uri))
     if not old_tv_show:
-        LOGGER.debug(f'TV show not found for: {uri}.')
+        LOGGER.debug('TV show not found for: %s.', uri)
         raise HTTPException(status_code=404, detail="TV show not found.")
 
     tv_show_to_store.metadata.date_created = old_tv_show.metadata.date_created
@@ -149,6 +228,8 @@ async def update_tv_show(
 
     await TV_SHOW_DAO.update(tv_show_id=uri, tv_show=tv_show_to_store.to_dict())
 
+    tv_show_to_store.update(
+        {field: old_tv_show[field] for field in TV_SHOW_STATS if field in old_tv_show})
     tv_show_to_store.id = uri
     return tv_show_to_store
 
@@ -173,7 +254,7 @@ async def delete_tv_show(
 
     **returns** - No content.
     """
-    LOGGER.info(f'Deleting tv show: <{uri}> as user {username}. ')
+    LOGGER.info('Deleting tv show: <%s> as user %s. ', uri, username)
     acting_user = ad.Dict(await USER_DAO.read_by_username(username=username))
     if not acting_user:
         raise HTTPException(status_code=401, detail=f'User {username} unauthorized, were '
@@ -212,8 +293,8 @@ async def create_tv_show_episode(
     tv_show = await TV_SHOW_DAO.read(tv_show_id=uri)
     if not tv_show:
         raise HTTPException(status_code=422, detail='uri must be a valid tv show id.')
-    LOGGER.info(f'Creating tv episode for tv show: <{uri}> with data: <{episode}> and '
-                f'user: <{username}>.')
+    LOGGER.info('Creating tv episode for tv show: <%s> with data: <%s> and user: <%s>.',
+                uri, episode, username)
     episode_to_store = ad.Dict(episode.dict())
 
     # Set metadata
@@ -231,38 +312,51 @@ async def create_tv_show_episode(
     response_model=TVShowEpisodeInDB,
     tags=['tv show episodes'])
 async def get_tv_show_episode(
-        uri: ObjectIdStr):
+        uri: ObjectIdStr,
+        fields: str = None):
     """
     Get a tv show episode.
 
     **param uri** - The uri of the tv show episode to get.
 
+    **param fields** - A comma separated list of fields to return (e.g. `id,title`). Defaults
+    to all fields.
+
     **returns** - The tv show episode data.
     """
-    LOGGER.info(f'Getting tv show episode: {uri}.')
-    tv_episode = await TV_SHOW_DAO.read_episode(episode_id=uri)
+    LOGGER.info('Getting tv show episode: %s.', uri)
+    projection = parse_fields(fields, TVShowEpisodeInDB)
+    tv_episode = await TV_SHOW_DAO.read_episode(episode_id=uri, projection=projection)
     if not tv_episode:
         raise HTTPException(status_code=404, detail="tv episode not found.")
+    if projection:
+        return partial_response(TVShowEpisodeInDB, tv_episode, projection)
     return tv_episode
 
 
 @router.get("/{uri}/episodes", response_model=List[TVShowEpisodeInDB], tags=['tv show episodes'])
-async def get_tv_show_episodes(uri: ObjectIdStr):
+async def get_tv_show_episodes(uri: ObjectIdStr, fields: str = None):
     """
     Get **all** tv show episodes.
 
     **uri** - The uri of the tv show to get episodes for.
 
+    **fields** - A comma separated list of fields to return (e.g. `id,season,episode`). Defaults
+    to all fields.
+
     **returns** - A list of tv show episodes.
     """
-    LOGGER.info(f'Getting all TV episodes for TV show: {uri}.')
+    LOGGER.info('Getting all TV episodes for TV show: %s.', uri)
+    projection = parse_fields(fields, TVShowEpisodeInDB)
     # Make sure tv show exists
-    tv_show = await TV_SHOW_DAO.read(tv_show_id=uri)
+    tv_show = await TV_SHOW_DAO.read(tv_show_id=uri, projection={'_id': True})
     if not tv_show:
         raise HTTPException(status_code=422, detail='uri must be a valid tv show id.')
-    tv_episodes = await TV_SHOW_DAO.read_tv_show_episodes(tv_show_id=uri)
+    tv_episodes = await TV_SHOW_DAO.read_tv_show_episodes(tv_show_id=uri, projection=projection)
     if not tv_episodes:
         raise HTTPException(status_code=404, detail="No TV episodes found.")
+    if projection:
+        return partial_response(TVShowEpisodeInDB, tv_episodes, projection)
     return tv_episodes
 
 
@@ -288,7 +382,8 @@ async def update_tv_show_episode(
 
     **returns** - The new tv show episode data.
     """
-    LOGGER.info(f'Updating tv episode: <{uri}> with data: <{episode}> and user: <{username}>.')
+    LOGGER.info('Updating tv episode: <%s> with data: <%s> and user: <%s>.',
+                uri, episode, username)
     acting_user = ad.Dict(await USER_DAO.read_by_username(username=username))
     if not acting_user:
         raise HTTPException(status_code=401, detail=f'User {username} unauthorized, were '
@@ -300,7 +395,7 @@ async def update_tv_show_episode(
     episode_to_store = ad.Dict(episode.dict())
     old_episode = ad.Dict(await TV_SHOW_DAO.read_episode(episode_id=uri))
     if not old_episode:
-        LOGGER.debug(f'Tv episode not found for: {uri}.')
+        LOGGER.debug('Tv episode not found for: %s.', uri)
         raise HTTPException(status_code=404, detail='Tv episode not found.')
 
     # Set metadata
@@ -332,7 +427,7 @@ async def delete_tv_show_episode(
 
     **returns** - No content.
     """
-    LOGGER.info(f'Deleting tv episode: <{uri}> as user {username}. ')
+    LOGGER.info('Deleting tv episode: <%s> as user %s. ', uri, username)
     acting_user = ad.Dict(await USER_DAO.read_by_username(username=username))
     if not acting_user:
         raise HTTPException(status_code=401, detail=f'User {username} unauthorized, were '
@@ -6,28 +6,26 @@ from typing import List
 import addict as ad
 from fastapi import APIRouter, Depends, Query, HTTPException
 from fastapi.responses import Response
-from pymongo import MongoClient
 
 from fsubs.config.config import Config
-from fsubs.crud.user import UserDAO
+from fsubs.crud.db import get_engine
+from fsubs.crud.user import DuplicateUserError, UserDAO
 from fsubs.models.misc import ObjectIdStr
 from fsubs.models.user import Access, UserRead, UserCreate, UserCreateToDAO, UserPatch, UserUpdate
 from fsubs.routers.authenticate import get_token_header
 from fsubs.utils import users as user_utils
+from fsubs.utils.fields import parse_fields, partial_response
+from fsubs.utils.singleflight import run_in_executor
+from fsubs.utils.timing import TimedRoute
 from fsubs.utils.users import check_access
 
 LOGGER = logging.getLogger(__name__)
-router = APIRouter()
+router = APIRouter(route_class=TimedRoute)
 config = Config()
 
-client = MongoClient(
-    host=config["db"]["hostname"],
-    port=config["db"].getint("port"),
-    username='root',
-    password='example',
-)
+engine = get_engine()
 
-USER_DAO = UserDAO(client=client)
+USER_DAO = UserDAO(engine=engine)
 
 
 # / user endpoints
@@ -41,6 +39,7 @@ USER_DAO = UserDAO(client=client)
 async def read_users(
         start: int = Query(0, ge=0),
         page_length: int = Query(100, ge=1),
+        fields: str = None,
         username: str = Depends(get_token_header)):
     """
     Get users.
@@ -51,9 +50,12 @@ async def read_users(
 
     **param page_length** - The number of users to get.
 
+    **param fields** - A comma separated list of fields to return (e.g. `id,username`). Defaults
+    to all fields.
+
     **returns** - A list of users.
     """
-    LOGGER.info(f'Getting users with start: <{start}> and page_length: <{page_length}.')
+    LOGGER.info('Getting users with start: <%s> and page_length: <%s.', start, page_length)
     user = ad.Dict(await USER_DAO.read_by_username(username=username))
     if not user:
         raise HTTPException(status_code=401, detail=f'User {username} unauthorized, were '
@@ -62,7 +64,11 @@ async def read_users(
         user=user,
         username=username,
         level=Access.admin)
-    return await USER_DAO.read_multi(limit=page_length, skip=start)
+    projection = parse_fields(fields, UserRead)
+    users = await USER_DAO.read_multi(limit=page_length, skip=start, projection=projection)
+    if projection:
+        return partial_response(UserRead, users, projection)
+    return users
 
 
 @router.get(
@@ -70,17 +76,23 @@ async def read_users(
     tags=['users'],
     response_model=UserRead,
     status_code=200)
-async def read_self(username: str = Depends(get_token_header)):
+async def read_self(fields: str = None, username: str = Depends(get_token_header)):
     """
     Get the currently logged in user.
 
+    **fields** - A comma separated list of fields to return (e.g. `id,username`). Defaults to all
+    fields.
+
     **returns** - The user data.
     """
-    LOGGER.info(f'Getting user: {username}.')
-    user = await USER_DAO.read_by_username(username=username)
+    LOGGER.info('Getting user: %s.', username)
+    projection = parse_fields(fields, UserRead)
+    user = await USER_DAO.read_by_username(username=username, projection=projection)
     if not user:
         raise HTTPException(status_code=401, detail=f'User {username} unauthorized, were '
                                                     'you deleted?')
+    if projection:
+        return partial_response(UserRead, user, projection)
     return user
 
 
@@ -89,7 +101,10 @@ async def read_self(username: str = Depends(get_token_header)):
     tags=['users'],
     response_model=UserRead,
     status_code=200)
-async def read_user(username: str, acting_username: str = Depends(get_token_header)):
+async def read_user(
+        username: str,
+        fields: str = None,
+        acting_username: str = Depends(get_token_header)):
     """
     Get the given user.
 
@@ -97,9 +112,13 @@ async def read_user(username: str, acting_username: str = Depends(get_token_head
 
     **username** - The username of the user to read.
 
+    **fields** - A comma separated list of fields to return (e.g. `id,username`). Defaults to all
+    fields.
+
     **returns** - The user data.
     """
-    LOGGER.info(f'Getting user: {username}.')
+    LOGGER.info('Getting user: %s.', username)
+    projection = parse_fields(fields, UserRead)
     acting_user = ad.Dict(await USER_DAO.read_by_username(username=acting_username))
     if not acting_user:
         raise HTTPException(status_code=401, detail=f'User {acting_username} unauthorized, were '
@@ -111,9 +130,11 @@ async def read_user(username: str, acting_username: str = Depends(get_token_head
             user=acting_user,
             username=username,
             level=Access.admin)
-        user = ad.Dict(await USER_DAO.read_by_username(username=username))
+        user = ad.Dict(await USER_DAO.read_by_username(username=username, projection=projection))
     if not user:
         raise HTTPException(status_code=404, detail=f'Unable to find user {username}.')
+    if projection:
+        return partial_response(UserRead, user, projection)
     return user
 
 
@@ -122,7 +143,10 @@ async def read_user(username: str, acting_username: str = Depends(get_token_head
     tags=['users'],
     response_model=UserRead,
     status_code=200)
-async def read_user_id(user_id: ObjectIdStr, acting_username: str = Depends(get_token_header)):
+async def read_user_id(
+        user_id: ObjectIdStr,
+        fields: str = None,
+        acting_username: str = Depends(get_token_header)):
     """
     Get the given user.
 
@@ -130,22 +154,27 @@ async def read_user_id(user_id: ObjectIdStr, acting_username: str = Depends(get_
 
     **user_id** - The id of the user to read.
 
+    **fields** - A comma separated list of fields to return (e.g. `id,username`). Defaults to all
+    fields.
+
     **returns** - The user data.
     """
-    LOGGER.info(f'Getting user id: {user_id}.')
+    LOGGER.info('Getting user id: %s.', user_id)
+    projection = parse_fields(fields, UserRead)
     acting_user = ad.Dict(await USER_DAO.read_by_username(username=acting_username))
     if not acting_user:
         raise HTTPException(status_code=401, detail=f'User {acting_username} unauthorized, were '
                                                     'you deleted?')
-    user = ad.Dict(await USER_DAO.read(user_id=user_id))
-    if acting_user and user and acting_user.id == user.id:
-        return user
-    await check_access(
-        user=acting_user,
-        username=acting_username,
-        level=Access.admin)
+    user = ad.Dict(await USER_DAO.read(user_id=user_id, projection=projection))
+    if not (acting_user and user and acting_user.id == user.id):
+        await check_access(
+            user=acting_user,
+            username=acting_username,
+            level=Access.admin)
     if not user:
         raise HTTPException(status_code=404, detail=f'Unable to find user {user_id}.')
+    if projection:
+        return partial_response(UserRead, user, projection)
     return user
 
 
@@ -163,13 +192,7 @@ async def create_user(user_to_create: UserCreate):
     **returns** - The id of the newly created user.
     """
     user = ad.Dict(user_to_create.dict())
-    LOGGER.info(f'Creating user with username: {user.username}, email: {user.email}.')
-
-    # Check if username or email is in use
-    if await USER_DAO.read_by_username(username=user.username):
-        raise HTTPException(status_code=409, detail='That username is already in use.')
-    if await USER_DAO.read_by_email(email=user.email):
-        raise HTTPException(status_code=409, detail='That email is already in use.')
+    LOGGER.info('Creating user with username: %s, email: %s.', user.username, user.email)
 
     # set metadata
     LOGGER.debug('Setting metadata.')
@@ -179,12 +202,15 @@ async def create_user(user_to_create: UserCreate):
     user.metadata.modified_by = user.username
 
     # hash password
-    salt, key = user_utils.hash_password(password=user.password)
-    user.salt = salt
-    user.hashed_password = key
+    user.salt = None
+    user.hashed_password = await run_in_executor(user_utils.hash_password, user.password)
     user_to_store = UserCreateToDAO(**user)
-    LOGGER.debug(f'User to store is: {user_to_store}')
-    return str(await USER_DAO.create(user=user_to_store))
+    LOGGER.debug('User to store is: %s', user_to_store)
+    # The unique indexes on username and email reject duplicates, even from concurrent signups.
+    try:
+        return str(await USER_DAO.create(user=user_to_store))
+    except DuplicateUserError as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
 
 @router.put(
@@ -205,7 +231,7 @@ async def update_user(
 
     **returns** - The user data.
     """
-    LOGGER.info(f'Updating user id: {user_id}.')
+    LOGGER.info('Updating user id: %s.', user_id)
     acting_user = ad.Dict(await USER_DAO.read_by_username(username=acting_username))
     if not acting_user:
         raise HTTPException(status_code=401, detail=f'User {acting_username} unauthorized, were '
@@ -220,14 +246,6 @@ async def update_user(
     if not old_user:
         raise HTTPException(status_code=404, detail=f'Unable to find user {user_id}.')
 
-    # Check if new email is in use.
-    users = await USER_DAO.read_multi(search={'email': user_to_update.email})
-    if len(users) > 0 and users[0]['id'] != user_id:
-        raise HTTPException(
-            status_code=422,
-            detail=f'Unable to update user {old_user.username} {user_id} to email: '
-                   f'{user_to_update.email} because that email is already in use.')
-
     user = ad.Dict(user_to_update.dict())
     # set info that cannot be changed from user
     LOGGER.debug('Setting metadata and unchangable data.')
@@ -240,14 +258,21 @@ async def update_user(
     user.access = old_user.access
 
     # hash new password
-    salt, key = user_utils.hash_password(password=user_to_update.password)
-    user.salt = salt
-    user.hashed_password = key
+    user.salt = None
+    user.hashed_password = await run_in_executor(user_utils.hash_password, user_to_update.password)
     user_to_store = UserCreateToDAO(**user)
-    LOGGER.debug(f'User to store is: {user_to_store}')
+    LOGGER.debug('User to store is: %s', user_to_store)
 
-    await USER_DAO.update(user_id=user_id, user=user_to_store.dict())
-    return await USER_DAO.read(user_id=user_id)
+    try:
+        updated = await USER_DAO.update(user_id=user_id, user=user_to_store.dict())
+    except DuplicateUserError:
+        raise HTTPException(
+            status_code=422,
+            detail=f'Unable to update user {old_user.username} {user_id} to email: '
+                   f'{user_to_update.email} because that email is already in use.')
+    if not updated:
+        raise HTTPException(status_code=404, detail=f'Unable to find user {user_id}.')
+    return updated
 
 
 @router.patch(
@@ -268,7 +293,7 @@ async def patch_user(
 
     **returns** - The user data.
     """
-    LOGGER.info(f'Patching user id: {user_id}.')
+    LOGGER.info('Patching user id: %s.', user_id)
     acting_user = ad.Dict(await USER_DAO.read_by_username(username=acting_username))
     if not acting_user:
         raise HTTPException(status_code=401, detail=f'User {acting_username} unauthorized, were '
@@ -283,15 +308,6 @@ async def patch_user(
     if not old_user:
         raise HTTPException(status_code=404, detail=f'Unable to find user {user_id}.')
 
-    # Check if new email is in use.
-    if user_to_patch.email:
-        users = await USER_DAO.read_multi(search={'email': user_to_patch.email})
-        if len(users) > 0 and users[0]['id'] != user_id:
-            raise HTTPException(
-                status_code=422,
-                detail=f'Unable to patch user {old_user.username} {user_id} to email: '
-                       f'{user_to_patch.email} because that email is already in use.')
-
     user = ad.Dict(user_to_patch.dict())
     # set info that cannot be changed from user
     LOGGER.debug('Setting metadata and non changed data.')
@@ -309,17 +325,25 @@ async def patch_user(
 
     # hash new password
     if user_to_patch.password:
-        salt, key = user_utils.hash_password(password=user_to_patch.password)
-        user.salt = salt
-        user.hashed_password = key
+        user.salt = None
+        user.hashed_password = await run_in_executor(
+            user_utils.hash_password, user_to_patch.password)
     else:
         user.salt = old_user.salt
         user.hashed_password = old_user.hashed_password
     user_to_store = UserCreateToDAO(**user)
-    LOGGER.debug(f'User to store is: {user_to_store}')
+    LOGGER.debug('User to store is: %s', user_to_store)
 
-    await USER_DAO.update(user_id=user_id, user=user_to_store.dict())
-    return await USER_DAO.read(user_id=user_id)
+    try:
+        updated = await USER_DAO.update(user_id=user_id, user=user_to_store.dict())
+    except DuplicateUserError:
+        raise HTTPException(
+            status_code=422,
+            detail=f'Unable to patch user {old_user.username} {user_id} to email: '
+                   f'{user.email} because that email is already in use.')
+    if not updated:
+        raise HTTPException(status_code=404, detail=f'Unable to find user {user_id}.')
+    return updated
 
 
 @router.delete(
@@ -338,7 +362,7 @@ async def delete_user(
 
     **returns** - No content.
     """
-    LOGGER.info(f'Deleting user: <{user_id}>.')
+    LOGGER.info('Deleting user: <%s>.', user_id)
     acting_user = ad.Dict(await USER_DAO.read_by_username(username=acting_username))
     if not acting_user:
         raise HTTPException(status_code=401, detail=f'User {acting_username} unauthorized, were '
@@ -0,0 +1,189 @@
+"""Per route class concurrency limits, shedding load once their queues are full."""
+import asyncio
+import json
+import logging
+import time
+from typing import Dict, Optional
+
+from fsubs.utils.metrics import REGISTRY
+
+LOGGER = logging.getLogger(__name__)
+
+ROUTE_CLASSES = ('auth', 'list', 'read', 'write')
+
+# Paths that are never limited, so probes, metrics and debugging keep working under load.
+EXEMPT_PREFIXES = ('/health', '/ready', '/metrics', '/debug', '/docs', '/redoc', '/openapi.json')
+# Endpoints hashing a password.
+AUTH_PATHS = ('/authenticate', '/users')
+# Endpoints listing a whole collection, a page at a time.
+LIST_PATHS = ('/movies', '/tv_shows', '/users')
+
+IN_FLIGHT = REGISTRY.gauge(
+    'fsubs_admission_in_flight', 'Requests being handled, by route class.', ('route_class',))
+QUEUE_DEPTH = REGISTRY.gauge(
+    'fsubs_admission_queue_depth', 'Requests waiting to be handled, by route class.',
+    ('route_class',))
+QUEUE_WAIT = REGISTRY.histogram(
+    'fsubs_admission_queue_wait_seconds', 'Time requests waited to be handled, by route class.',
+    ('route_class',))
+SHED = REGISTRY.counter(
+    'fsubs_admission_shed_total', 'Requests rejected because their queue was full or too slow.',
+    ('route_class', 'reason'))
+
+
+class Shed(Exception):
+    """The request was not admitted."""
+
+    def __init__(self, reason: str):
+        """
+        Initialize a ``Shed``.
+
+        :param reason: Why the request was not admitted (``queue_full`` or ``queue_timeout``).
+        """
+        super().__init__(reason)
+        self.reason = reason
+
+
+class Admission():
+    """A concurrency limit with a bounded, time limited queue."""
+
+    def __init__(self, name: str, limit: int, queue: int, queue_timeout_ms: float):
+        """
+        Initialize an ``Admission``.
+
+        :param name: The name of the route class.
+        :param limit: The number of requests handled at once. ``0`` disables the limit.
+        :param queue: The number of requests that may wait for their turn.
+        :param queue_timeout_ms: How long a request may wait for its turn, in milliseconds.
+        """
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.queue_timeout = queue_timeout_ms / 1000
+        self.waiting = 0
+        # Created on first use, so it belongs to the event loop serving requests.
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def acquire(self):
+        """
+        Wait for a turn to handle a request.
+
+        :raises Shed: If the queue is full or the turn didn't come in time.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        if self._semaphore.locked():
+            if self.waiting >= self.queue:
+                raise Shed('queue_full')
+            start = time.perf_counter()
+            self.waiting += 1
+            QUEUE_DEPTH.inc(route_class=self.name)
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                raise Shed('queue_timeout')
+            finally:
+                self.waiting -= 1
+                QUEUE_DEPTH.dec(route_class=self.name)
+                QUEUE_WAIT.observe(time.perf_counter() - start, route_class=self.name)
+        else:
+            await self._semaphore.acquire()
+        IN_FLIGHT.inc(route_class=self.name)
+
+    def release(self):
+        """Give the turn to the next request."""
+        IN_FLIGHT.dec(route_class=self.name)
+        self._semaphore.release()
+
+
+def route_class(method: str, path: str) -> Optional[str]:
+    """
+    Get the route class of a request.
+
+    :param method: The HTTP method of the request.
+    :param path: The path of the request.
+    :returns: ``auth``, ``list``, ``read`` or ``write``, or ``None`` if the request isn't limited.
+    """
+    if method == 'OPTIONS' or path.startswith(EXEMPT_PREFIXES):
+        return None
+    path = path.rstrip('/')
+    if method == 'POST' and path in AUTH_PATHS:
+        return 'auth'
+    if method in ('GET', 'HEAD'):
+        return 'list' if path in LIST_PATHS else 'read'
+    return 'write'
+
+
+def admissions_from_config(config) -> Dict[str, Admission]:
+    """
+    Build the admission of every route class from the ``[admission]`` section of the config.
+
+    :param config: The ``Config``.
+    :returns: The admissions keyed by route class, without the unlimited ones.
+    """
+    section = config["admission"]
+    admissions = {}
+    for name in ROUTE_CLASSES:
+        admission = Admission(
+            name=name,
+            limit=section.getint(f"{name}_limit"),
+            queue=section.getint(f"{name}_queue"),
+            queue_timeout_ms=section.getfloat(f"{name}_queue_timeout_ms"),
+        )
+        if admission.limit > 0:
+            admissions[name] = admission
+    return admissions
+
+
+class AdmissionMiddleware():
+    """
+    ASGI middleware limiting how many requests of each route class are handled at once.
+
+    Requests over the limit wait in a queue. Once the queue is full, or if a request waits too
+    long, it is shed with a 503 so that cheap requests aren't starved by a burst of expensive ones.
+    """
+
+    def __init__(self, app, admissions: Dict[str, Admission]):
+        """
+        Initialize an ``AdmissionMiddleware``.
+
+        :param app: The ASGI app to wrap.
+        :param admissions: The admission of each limited route class.
+        """
+        self.app = app
+        self.admissions = admissions
+
+    async def __call__(self, scope, receive, send):
+        """Handle an ASGI call."""
+        admission = None
+        if scope['type'] == 'http':
+            admission = self.admissions.get(route_class(scope['method'], scope['path']))
+        if admission is None:
+            await self.app(scope, receive, send)
+            return
+        try:
+            await admission.acquire()
+        except Shed as e:
+            SHED.inc(route_class=admission.name, reason=e.reason)
+            LOGGER.debug('Shed <%s %s> (%s).', scope['method'], scope['path'], e.reason)
+            await self._send_shed(send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            admission.release()
+
+    @staticmethod
+    async def _send_shed(send):
+        """Send a 503 asking the client to retry later."""
+        body = json.dumps({'detail': 'The server is overloaded, try again later.'}).encode()
+        await send({
+            'type': 'http.response.start',
+            'status': 503,
+            'headers': [
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(body)).encode('latin-1')),
+                (b'retry-after', b'1'),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': body})
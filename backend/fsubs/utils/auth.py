@@ -1,24 +1,185 @@
 """Utility functions for authentication."""
 
 import logging
+import pathlib
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Union
 
 import jwt
-from datetime import datetime, timedelta
+from jwt.algorithms import get_default_algorithms
 
 from fsubs.config.config import Config
+from fsubs.utils.token_cache import TOKEN_CACHE, token_digest
 
 LOGGER = logging.getLogger(__name__)
 CONFIG = Config()
 
+HMAC_ALGORITHMS = ('HS256', 'HS384', 'HS512')
+
+
+class KeyRing():
+    """
+    The keys access tokens are signed and verified with, parsed once.
+
+    Tokens are signed with a single key and carry its id in their ``kid`` header. They are verified
+    with the key of that id, so tokens signed with an older key stay valid while rotating keys.
+    Tokens without a ``kid`` are verified with the default key. A ring without a signing key can
+    only verify tokens, e.g. on a node only given the public key.
+    """
+
+    def __init__(self):
+        """Initialize a ``KeyRing``, configured from the config on first use."""
+        self.algorithm: Optional[str] = None
+        self.kid: Optional[str] = None
+        self._signing_key = None
+        self._verification_keys: Dict[Optional[str], object] = {}
+        self._only_key = None
+
+    def configure(self, algorithm: str, signing_key: Union[str, bytes, None] = None,
+                  kid: Optional[str] = None,
+                  verification_keys: Dict[Optional[str], Union[str, bytes]] = None):
+        """
+        Parse the keys to sign and verify tokens with.
+
+        :param algorithm: The jwt algorithm, e.g. ``HS256`` or ``RS256``.
+        :param signing_key: The HMAC secret or PEM private key to sign tokens with. Its public key
+        verifies the tokens with its ``kid`` and the tokens without one.
+        :param kid: The id of the signing key, put in the ``kid`` header of the tokens.
+        :param verification_keys: Other PEM public keys to verify tokens with, by ``kid``. The key
+        of ``None`` verifies the tokens without a ``kid``.
+        :raises ValueError: If the algorithm is not available or there is no key to verify with.
+        """
+        algorithms = get_default_algorithms()
+        if algorithm not in algorithms:
+            raise ValueError(f'The {algorithm} jwt algorithm is not available, asymmetric '
+                             f'algorithms need the cryptography package (fsubs[crypto]).')
+        prepare_key = algorithms[algorithm].prepare_key
+        keys = {key_id: prepare_key(key) for key_id, key in (verification_keys or {}).items()}
+        parsed_signing_key = prepare_key(signing_key) if signing_key else None
+        if parsed_signing_key is not None:
+            # HMAC keys are plain bytes, asymmetric ones verify with their public half.
+            public_key = getattr(parsed_signing_key, 'public_key', lambda: parsed_signing_key)()
+            keys.setdefault(kid, public_key)
+            keys.setdefault(None, public_key)
+        if not keys:
+            raise ValueError('There is no key to verify jwt tokens with.')
+        if None not in keys and len(keys) == 1:
+            keys[None] = next(iter(keys.values()))
+        self.algorithm = algorithm
+        self.kid = kid
+        self._signing_key = parsed_signing_key
+        self._verification_keys = keys
+        # With a single key there's no need to parse the header to pick one.
+        distinct_keys = {id(key): key for key in keys.values()}
+        self._only_key = next(iter(distinct_keys.values())) if len(distinct_keys) == 1 else None
+        # Tokens verified with the previous keys may not be valid anymore.
+        TOKEN_CACHE.clear()
+        LOGGER.debug('Loaded %s jwt verification keys for %s.', len(keys), algorithm)
+
+    def configure_from_config(self, config):
+        """
+        Load the keys from the ``[app]`` section of the config.
+
+        HMAC algorithms use ``jwt_secret``. The others sign with the PEM private key in
+        ``jwt_private_key_file`` and also verify with the PEM public keys in
+        ``jwt_public_key_files``, a comma separated list of ``<kid>=<path>`` (or just ``<path>``
+        for tokens without a ``kid``).
+
+        :param config: The ``Config``.
+        """
+        section = config["app"]
+        algorithm = section["jwt_algorithm"]
+        kid = section.get("jwt_key_id") or None
+        if algorithm in HMAC_ALGORITHMS:
+            self.configure(algorithm, signing_key=section["jwt_secret"], kid=kid)
+            return
+        private_key_file = section.get("jwt_private_key_file")
+        signing_key = pathlib.Path(private_key_file).read_bytes() if private_key_file else None
+        verification_keys = {}
+        for entry in (section.get("jwt_public_key_files") or '').split(','):
+            if not entry.strip():
+                continue
+            key_id, _, path = entry.strip().rpartition('=')
+            verification_keys[key_id.strip() or None] = pathlib.Path(path.strip()).read_bytes()
+        self.configure(algorithm, signing_key=signing_key, kid=kid,
+                       verification_keys=verification_keys)
+
+    def can_sign(self) -> bool:
+        """
+        Check whether tokens can be issued.
+
+        :returns: ``True`` if there is a signing key.
+        """
+        self._ensure_configured()
+        return self._signing_key is not None
+
+    def encode(self, claims: dict) -> bytes:
+        """
+        Sign a token.
+
+        :param claims: The claims of the token.
+        :returns: The encoded token.
+        :raises RuntimeError: If there is no signing key.
+        """
+        self._ensure_configured()
+        if self._signing_key is None:
+            raise RuntimeError('There is no key to sign jwt tokens with.')
+        headers = {'kid': self.kid} if self.kid else None
+        return jwt.encode(claims, self._signing_key, algorithm=self.algorithm, headers=headers)
+
+    def decode(self, token: Union[str, bytes]) -> dict:
+        """
+        Decode a token, checking its signature and expiry.
+
+        :param token: The encoded token.
+        :returns: The claims of the token.
+        :raises PyJWTError: If the token is invalid, expired or signed with an unknown key.
+        """
+        self._ensure_configured()
+        key = self._only_key
+        if key is None:
+            kid = jwt.get_unverified_header(token).get('kid')
+            key = self._verification_keys.get(kid) if isinstance(kid, (str, type(None))) else None
+        if key is None:
+            raise jwt.InvalidTokenError(f'Unknown jwt key id {kid!r}.')
+        return jwt.decode(token, key, algorithms=[self.algorithm])
+
+    def _ensure_configured(self):
+        """Load the keys from the config if they weren't configured yet."""
+        if self.algorithm is None:
+            self.configure_from_config(CONFIG)
+
+
+KEYS = KeyRing()
+
 
 def create_access_token(*, data: dict, expires_delta: timedelta = None) -> bytes:
-    """Create an access token for bearer authentication."""
+    """Create an access token for bearer authentication, with a unique ``jti`` to revoke it by."""
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, CONFIG['app']['jwt_secret'],
-                             algorithm=CONFIG['app']['jwt_algorithm'])
+    to_encode.update({"exp": expire, "jti": uuid.uuid4().hex})
+    encoded_jwt = KEYS.encode(to_encode)
     return encoded_jwt
+
+
+def decode_access_token(token: str) -> dict:
+    """
+    Decode an access token, checking its signature and expiry.
+
+    The signature of a token is only checked the first time it is seen, its claims are then kept in
+    ``TOKEN_CACHE`` until it expires.
+
+    :param token: The encoded access token.
+    :returns: The claims of the token.
+    :raises PyJWTError: If the token is invalid or expired.
+    """
+    digest = token_digest(token)
+    claims = TOKEN_CACHE.get(digest)
+    if claims is None:
+        claims = KEYS.decode(token)
+        TOKEN_CACHE.put(digest, claims)
+    return claims
@@ -0,0 +1,161 @@
+"""A circuit breaker failing DAO calls fast while Mongo is down or too slow."""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from fastapi.responses import JSONResponse
+from pymongo.errors import ConnectionFailure, ExecutionTimeout
+
+from fsubs.utils.deadlines import DeadlineExceeded
+
+LOGGER = logging.getLogger(__name__)
+
+# The errors meaning that Mongo is unreachable or too slow.
+FAILURES = (ConnectionFailure, ExecutionTimeout)
+
+# How deeply guarded calls are nested in the current task.
+_DEPTH: ContextVar[int] = ContextVar('breaker_depth', default=0)
+
+
+class CircuitOpen(Exception):
+    """The circuit is open, the call was rejected without reaching Mongo."""
+
+
+class CircuitBreaker():
+    """
+    Reject calls for a while after too many consecutive failures.
+
+    After ``failure_threshold`` consecutive failures the circuit opens and calls are rejected with
+    ``CircuitOpen``. After ``reset_seconds`` a single trial call is let through: the circuit closes
+    if it succeeds and opens again if it fails. Errors other than ``FAILURES`` mean that Mongo
+    answered, so they count as successes.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 10):
+        """
+        Initialize a ``CircuitBreaker``.
+
+        :param failure_threshold: The number of consecutive failures opening the circuit. ``0``
+        disables the breaker.
+        :param reset_seconds: How long the circuit stays open before a trial call.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def configure_from_config(self, config):
+        """
+        Set the thresholds from the ``[db]`` section of the config.
+
+        :param config: The ``Config``.
+        """
+        self.failure_threshold = config["db"].getint("breaker_failures")
+        self.reset_seconds = config["db"].getfloat("breaker_reset_seconds")
+
+    def is_open(self) -> bool:
+        """
+        Check whether calls are being rejected.
+
+        :returns: ``True`` if the circuit is open (or half open, waiting on a trial call).
+        """
+        return self._opened_at is not None
+
+    def retry_after(self) -> int:
+        """
+        Get how long until the next trial call.
+
+        :returns: The number of seconds, at least 1.
+        """
+        opened_at = self._opened_at
+        if opened_at is None:
+            return 1
+        return max(1, int(self.reset_seconds - (time.monotonic() - opened_at) + 0.999))
+
+    @contextmanager
+    def guard(self):
+        """
+        Guard a call, rejecting it if the circuit is open and recording how it went otherwise.
+
+        Guarded calls nested in another one are not checked nor recorded.
+
+        :raises CircuitOpen: If the circuit is open.
+        """
+        if _DEPTH.get() or not self.failure_threshold:
+            yield
+            return
+        self._before_call()
+        token = _DEPTH.set(1)
+        try:
+            yield
+        except FAILURES:
+            self._record(failed=True)
+            raise
+        except DeadlineExceeded:
+            # Mongo wasn't reached, so this says nothing about its health.
+            self._end_trial()
+            raise
+        except Exception:
+            self._record(failed=False)
+            raise
+        except BaseException:
+            self._end_trial()
+            raise
+        else:
+            self._record(failed=False)
+        finally:
+            _DEPTH.reset(token)
+
+    def _before_call(self):
+        """Reject the call if the circuit is open, unless it's time for a trial call."""
+        if self._opened_at is None:
+            return
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if self._trial or time.monotonic() - self._opened_at < self.reset_seconds:
+                raise CircuitOpen('Database circuit breaker is open.')
+            self._trial = True
+        LOGGER.info('Trying a call through the open database circuit breaker.')
+
+    def _record(self, failed: bool):
+        """Record the outcome of a call, opening or closing the circuit."""
+        with self._lock:
+            trial, self._trial = self._trial, False
+            if not failed:
+                self._failures = 0
+                if self._opened_at is not None:
+                    self._opened_at = None
+                    LOGGER.info('Database circuit breaker closed.')
+                return
+            self._failures += 1
+            if trial or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    LOGGER.error('Database circuit breaker opened after %s consecutive failures.',
+                                 self._failures)
+                self._opened_at = time.monotonic()
+
+    def _end_trial(self):
+        """Let another call be the trial call."""
+        with self._lock:
+            self._trial = False
+
+
+async def unavailable_handler(request, exc: Exception) -> JSONResponse:
+    """Answer a 503 when a request fails because Mongo is unavailable or too slow."""
+    # Rejections are logged quietly, the breaker already logged why it opened.
+    level = logging.DEBUG if isinstance(exc, CircuitOpen) else logging.WARNING
+    LOGGER.log(level, 'Database unavailable for <%s %s>: %s',
+               request.method, request.url.path, exc)
+    return JSONResponse(
+        {'detail': 'The database is unavailable, try again later.'},
+        status_code=503,
+        headers={'Retry-After': str(BREAKER.retry_after())},
+    )
+
+
+BREAKER = CircuitBreaker()
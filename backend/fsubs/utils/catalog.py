@@ -0,0 +1,515 @@
+"""Generate a synthetic catalog of movies, tv shows and users, for load and scale testing."""
+import json
+import logging
+import multiprocessing
+import pathlib
+import random
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from bson.objectid import ObjectId
+
+from fsubs.crud.db import create_client
+from fsubs.crud.engine import MongoEngine
+from fsubs.crud.stats import TV_SHOW_STATS
+from fsubs.models.video import BluRegion, DiscType, DVDRegion, SubType
+from fsubs.utils.users import hash_password
+
+LOGGER = logging.getLogger(__name__)
+
+WORDS = (
+    'silent', 'broken', 'golden', 'last', 'hidden', 'red', 'long', 'cold', 'lost', 'dark',
+    'river', 'night', 'city', 'garden', 'empire', 'winter', 'voyage', 'mirror', 'storm', 'house',
+)
+DISC_TYPES = [disc_type.value for disc_type in DiscType]
+REGIONS = {
+    'DVD': [region.value for region in DVDRegion],
+    'BD': [region.value for region in BluRegion],
+    'BD3D': [region.value for region in BluRegion],
+    'UHD': [region.value for region in BluRegion],
+}
+SUB_TYPES = [sub_type.value for sub_type in SubType]
+# Generated documents are dated within the year before this.
+EPOCH = datetime(2020, 1, 1, tzinfo=timezone.utc)
+PASSWORD = 'password123'
+# Users, movies and tv shows are generated in chunks of this many, each from its own seed, so a
+# catalog is the same however many processes generate it.
+CHUNK_SIZE = 1000
+# The collections of a catalog, as written by ``write_ndjson`` and ``insert_catalog``.
+COLLECTIONS = ('users', 'movies', 'movie_versions', 'tv_shows', 'tv_show_episodes')
+
+
+class Distribution(NamedTuple):
+    """
+    A distribution of counts, written as ``kind:parameters``.
+
+    * ``fixed:N``: always ``N``.
+    * ``uniform:LOW-HIGH``: any count from ``LOW`` to ``HIGH``, equally likely.
+    * ``exp:MEAN``: exponentially distributed with the given mean, most titles having few and a
+      few having many. A bare number is read as this.
+    * ``pareto:MIN:ALPHA``: at least ``MIN``, with a heavy tail that gets longer as ``ALPHA``
+      gets closer to 1, e.g. a few shows with thousands of episodes.
+    """
+
+    kind: str
+    low: float
+    high: float = 0
+
+    def draw(self, rng: random.Random) -> int:
+        """
+        Draw a count.
+
+        :param rng: The random generator to draw with.
+        :returns: The count.
+        """
+        if self.kind == 'fixed':
+            return int(self.low)
+        if self.kind == 'uniform':
+            return rng.randint(int(self.low), int(self.high))
+        if self.kind == 'pareto':
+            return int(self.low * rng.paretovariate(self.high))
+        return int(round(rng.expovariate(1 / self.low))) if self.low > 0 else 0
+
+    def __str__(self) -> str:
+        """Write the distribution as it is parsed."""
+        if self.kind == 'uniform':
+            return f'uniform:{self.low:g}-{self.high:g}'
+        if self.kind == 'pareto':
+            return f'pareto:{self.low:g}:{self.high:g}'
+        return f'{self.kind}:{self.low:g}'
+
+
+def parse_distribution(text: str) -> Distribution:
+    """
+    Parse a distribution of counts, e.g. ``exp:2`` or ``uniform:1-4``.
+
+    :param text: The distribution, see ``Distribution``.
+    :returns: The distribution.
+    :raises ValueError: If the distribution is invalid.
+    """
+    kind, _, parameters = text.strip().partition(':')
+    if not parameters:
+        kind, parameters = 'exp', kind
+    try:
+        if kind == 'uniform':
+            low, _, high = parameters.partition('-')
+            distribution = Distribution(kind, float(low), float(high))
+            valid = 0 <= distribution.low <= distribution.high
+        elif kind == 'pareto':
+            low, _, alpha = parameters.partition(':')
+            distribution = Distribution(kind, float(low), float(alpha))
+            valid = distribution.low >= 0 and distribution.high > 0
+        elif kind in ('fixed', 'exp'):
+            distribution = Distribution(kind, float(parameters))
+            valid = distribution.low >= 0
+        else:
+            valid = False
+    except ValueError:
+        valid = False
+    if not valid:
+        raise ValueError(
+            f'Invalid distribution {text}, expected fixed:N, uniform:LOW-HIGH, exp:MEAN or '
+            'pareto:MIN:ALPHA.')
+    return distribution
+
+
+class CatalogSpec(NamedTuple):
+    """The size and shape of a synthetic catalog."""
+
+    movies: int = 1000
+    versions_per_title: Distribution = Distribution('exp', 2)
+    timestamps_per_version: Distribution = Distribution('exp', 20)
+    tv_shows: int = 100
+    seasons_per_show: Distribution = Distribution('exp', 3)
+    episodes_per_season: Distribution = Distribution('exp', 10)
+    users: int = 100
+    seed: int = 0
+
+
+class CatalogIds(NamedTuple):
+    """The ids of a generated catalog, to pick requests from."""
+
+    movie_ids: List[str]
+    movie_version_ids: List[str]
+    tv_show_ids: List[str]
+    usernames: List[str]
+
+
+def _metadata(rng: random.Random, username: str) -> Dict[str, Any]:
+    """Generate the metadata of a document."""
+    created = EPOCH - timedelta(seconds=int(rng.random() * 365 * 24 * 3600))
+    return {
+        'date_created': created,
+        'created_by': username,
+        'last_modified': created + timedelta(seconds=int(rng.random() * 30 * 24 * 3600)),
+        'modified_by': username,
+    }
+
+
+def _object_id(rng: random.Random) -> ObjectId:
+    """Generate an ``ObjectId`` that only depends on the random generator."""
+    return ObjectId(rng.getrandbits(96).to_bytes(12, 'big'))
+
+
+def _video_base(rng: random.Random, index: int, kind: str, username: str) -> Dict[str, Any]:
+    """Generate the fields of a ``VideoBase``."""
+    title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 3))).title()
+    return {
+        '_id': _object_id(rng),
+        'title': f'{title} {index}',
+        'imdb_id': f'tt{index:07d}',
+        'description': f'A synthetic {kind} about {rng.choice(WORDS)} and {rng.choice(WORDS)}.',
+        'no_subs': rng.random() < 0.1,
+        'metadata': _metadata(rng, username),
+    }
+
+
+@lru_cache(maxsize=None)
+def _clock(seconds: int) -> str:
+    """Format whole seconds as ``HH:MM:SS``, cached since cues fall within a few hours."""
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours:02d}:{minutes:02d}:{seconds:02d}'
+
+
+def _format_time(milliseconds: int) -> str:
+    """Format milliseconds as ``HH:MM:SS.mmm``."""
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f'{_clock(seconds)}.{milliseconds:03d}'
+
+
+def _timestamps(rng: random.Random, count: int) -> Tuple[List[str], int]:
+    """Generate subtitle cues in order, with their total duration in milliseconds."""
+    timestamps = []
+    position = duration = 0
+    random_ = rng.random
+    for _ in range(count):
+        # Cues 5s to 5min apart, lasting 1 to 6s. ``random`` is much cheaper than ``randint``.
+        position += 5000 + int(random_() * 295000)
+        length = 1000 + int(random_() * 5000)
+        timestamps.append(f'{_format_time(position)} - {_format_time(position + length)}')
+        position += length
+        duration += length
+    return timestamps, duration
+
+
+def _version(rng: random.Random, video_base_id: str, spec: CatalogSpec,
+             username: str) -> Dict[str, Any]:
+    """Generate a ``VideoInstance`` of a title, with its statistics."""
+    disc_type = rng.choice(DISC_TYPES)
+    # The statistics are what ``version_stats`` computes, without parsing the cues back.
+    timestamps, duration = _timestamps(rng, spec.timestamps_per_version.draw(rng))
+    return {
+        '_id': _object_id(rng),
+        'video_base_id': video_base_id,
+        'disc_type': disc_type,
+        'region': rng.choice(REGIONS.get(disc_type, ['UNKNOWN'])),
+        'timestamps': timestamps,
+        'sub_type': rng.choice(SUB_TYPES),
+        'description': f'{disc_type} release',
+        'track': rng.randint(1, 4),
+        'metadata': _metadata(rng, username),
+        'cue_count': len(timestamps),
+        'subs_duration': duration / 1000,
+    }
+
+
+def _with_stats(title: Dict[str, Any], versions: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Set the version statistics of a title from its versions."""
+    foreign = sum(version['cue_count'] > 0 for version in versions)
+    title.update(
+        version_count=len(versions),
+        foreign_subs_version_count=foreign,
+        has_foreign_subs=foreign > 0,
+        cue_count=sum(version['cue_count'] for version in versions),
+        subs_duration=round(sum(version['subs_duration'] for version in versions), 3),
+    )
+    return title
+
+
+def _chunk(spec: CatalogSpec, kind: str, chunk: int) -> Tuple[random.Random, range]:
+    """Get the random generator and the indexes of a chunk of users, movies or tv shows."""
+    total = getattr(spec, kind)
+    return (random.Random(f'{spec.seed}:{kind}:{chunk}'),
+            range(chunk * CHUNK_SIZE, min(total, (chunk + 1) * CHUNK_SIZE)))
+
+
+def generate_users(spec: CatalogSpec, chunk: int,
+                   hashed_password: str = None) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Generate a chunk of the users of a catalog, shaped like ``UserCreateToDAO``.
+
+    All users have the password ``password123``. The first user is an admin, the next tenth have
+    power access.
+
+    :param spec: The catalog to generate.
+    :param chunk: The chunk to generate.
+    :param hashed_password: The hash of the password. Defaults to hashing it with the configured
+    KDF, which is slow enough to be worth doing once per catalog.
+    :returns: Pairs of collection name and document.
+    """
+    rng, indexes = _chunk(spec, 'users', chunk)
+    if hashed_password is None and indexes:
+        hashed_password = hash_password(PASSWORD)
+    for index in indexes:
+        username = f'user{index}'
+        access = '3' if index == 0 else '2' if index <= spec.users // 10 else '1'
+        yield 'users', {
+            '_id': _object_id(rng),
+            'username': username,
+            'email': f'{username}@example.com',
+            'access': access,
+            'verified': True,
+            'metadata': _metadata(rng, username),
+            'salt': None,
+            'hashed_password': hashed_password,
+        }
+
+
+def generate_movies(spec: CatalogSpec, chunk: int) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Generate a chunk of the movies of a catalog and their versions.
+
+    :param spec: The catalog to generate.
+    :param chunk: The chunk to generate.
+    :returns: Pairs of collection name and document, each movie after its versions.
+    """
+    rng, indexes = _chunk(spec, 'movies', chunk)
+    for index in indexes:
+        username = f'user{rng.randrange(max(1, spec.users))}'
+        movie = _video_base(rng, index, 'movie', username)
+        versions = [
+            _version(rng, str(movie['_id']), spec, username)
+            for _ in range(spec.versions_per_title.draw(rng))]
+        for version in versions:
+            yield 'movie_versions', version
+        yield 'movies', _with_stats(movie, versions)
+
+
+def generate_tv_shows(spec: CatalogSpec, chunk: int) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Generate a chunk of the tv shows of a catalog and their episodes.
+
+    Every show has at least one season, and every season at least one episode.
+
+    :param spec: The catalog to generate.
+    :param chunk: The chunk to generate.
+    :returns: Pairs of collection name and document, each tv show after its episodes.
+    """
+    rng, indexes = _chunk(spec, 'tv_shows', chunk)
+    for index in indexes:
+        username = f'user{rng.randrange(max(1, spec.users))}'
+        tv_show = _video_base(rng, index, 'tv show', username)
+        tv_show.update(TV_SHOW_STATS)
+        for season in range(1, max(1, spec.seasons_per_show.draw(rng)) + 1):
+            for number in range(1, max(1, spec.episodes_per_season.draw(rng)) + 1):
+                episode = _video_base(rng, index, 'episode', username)
+                episode.update(video_base_id=str(tv_show['_id']), season=season, episode=number)
+                tv_show['episode_count'] += 1
+                yield 'tv_show_episodes', episode
+        yield 'tv_shows', tv_show
+
+
+GENERATORS = {
+    'users': generate_users,
+    'movies': generate_movies,
+    'tv_shows': generate_tv_shows,
+}
+
+
+def catalog_chunks(spec: CatalogSpec) -> List[Tuple[str, int]]:
+    """
+    List the chunks of a catalog.
+
+    :param spec: The catalog to generate.
+    :returns: Pairs of kind (``users``, ``movies`` or ``tv_shows``) and chunk number.
+    """
+    return [
+        (kind, chunk) for kind in GENERATORS
+        for chunk in range(-(-getattr(spec, kind) // CHUNK_SIZE))]
+
+
+def generate_chunk(spec: CatalogSpec, kind: str, chunk: int,
+                   hashed_password: str = None) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Generate a chunk of a catalog.
+
+    :param spec: The catalog to generate.
+    :param kind: The kind of chunk, ``users``, ``movies`` or ``tv_shows``.
+    :param chunk: The chunk to generate.
+    :param hashed_password: The hash of the password of the users.
+    :returns: Pairs of collection name and document.
+    """
+    if kind == 'users':
+        return generate_users(spec, chunk, hashed_password)
+    return GENERATORS[kind](spec, chunk)
+
+
+def generate_catalog(spec: CatalogSpec,
+                     hashed_password: str = None) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Generate a whole catalog, the same one for the same spec.
+
+    :param spec: The catalog to generate.
+    :param hashed_password: The hash of the password of the users. Defaults to hashing it once.
+    :returns: Pairs of collection name and document.
+    """
+    if hashed_password is None and spec.users:
+        hashed_password = hash_password(PASSWORD)
+    for kind, chunk in catalog_chunks(spec):
+        yield from generate_chunk(spec, kind, chunk, hashed_password)
+
+
+def _insert(engine, documents: Iterable[Tuple[str, Dict[str, Any]]], batch_size: int,
+            on_document: Callable[[str, Dict[str, Any]], None] = None) -> Counter:
+    """Insert documents in batches, per collection, returning how many went to each."""
+    counts = Counter()
+    batches: Dict[str, List[Dict[str, Any]]] = {}
+    for collection, document in documents:
+        if on_document is not None:
+            on_document(collection, document)
+        batch = batches.setdefault(collection, [])
+        batch.append(document)
+        if len(batch) >= batch_size:
+            engine.insert_many(collection, batch)
+            counts[collection] += len(batch)
+            batch.clear()
+    for collection, batch in batches.items():
+        if batch:
+            engine.insert_many(collection, batch)
+            counts[collection] += len(batch)
+    return counts
+
+
+def insert_catalog(engine, spec: CatalogSpec, batch_size: int = 1000) -> CatalogIds:
+    """
+    Insert a generated catalog into a storage engine, from this process.
+
+    :param engine: The storage engine to insert into (see ``fsubs.crud.db.get_engine``).
+    :param spec: The catalog to generate.
+    :param batch_size: The number of documents per insert.
+    :returns: The ids of the catalog.
+    """
+    ids = CatalogIds(movie_ids=[], movie_version_ids=[], tv_show_ids=[], usernames=[])
+    id_lists = {
+        'movies': ids.movie_ids,
+        'movie_versions': ids.movie_version_ids,
+        'tv_shows': ids.tv_show_ids,
+    }
+
+    def collect_id(collection: str, document: Dict[str, Any]):
+        if collection == 'users':
+            ids.usernames.append(document['username'])
+        elif collection in id_lists:
+            id_lists[collection].append(str(document['_id']))
+
+    _insert(engine, generate_catalog(spec), batch_size, collect_id)
+    LOGGER.info('Inserted %s movies, %s movie versions, %s tv shows and %s users.',
+                len(ids.movie_ids), len(ids.movie_version_ids), len(ids.tv_show_ids),
+                len(ids.usernames))
+    return ids
+
+
+_WORKER_ENGINE = None
+
+
+def _insert_chunk(task: Tuple[CatalogSpec, str, int, str, int]) -> Counter:
+    """Insert a chunk of a catalog from a worker process, with the client of the process."""
+    global _WORKER_ENGINE
+    spec, kind, chunk, hashed_password, batch_size = task
+    if _WORKER_ENGINE is None:
+        _WORKER_ENGINE = MongoEngine(create_client())
+    return _insert(_WORKER_ENGINE, generate_chunk(spec, kind, chunk, hashed_password), batch_size)
+
+
+def _extended_json(value: Any) -> Dict[str, str]:
+    """
+    Encode the values JSON lacks as relaxed extended JSON, which ``mongoimport`` reads.
+
+    This is what ``bson.json_util`` does for these types, without it walking every document.
+    """
+    if isinstance(value, ObjectId):
+        return {'$oid': str(value)}
+    if isinstance(value, datetime):
+        return {'$date': value.strftime('%Y-%m-%dT%H:%M:%SZ')}
+    raise TypeError(f'Cannot encode {type(value).__name__} as JSON.')
+
+
+def _encode_chunk(task: Tuple[CatalogSpec, str, int, str]) -> Dict[str, Tuple[int, bytes]]:
+    """Encode a chunk of a catalog as NDJSON from a worker process, by collection."""
+    spec, kind, chunk, hashed_password = task
+    encode = json.JSONEncoder(default=_extended_json).encode
+    lines: Dict[str, List[str]] = {}
+    for collection, document in generate_chunk(spec, kind, chunk, hashed_password):
+        lines.setdefault(collection, []).append(encode(document))
+    return {
+        collection: (len(documents), ('\n'.join(documents) + '\n').encode())
+        for collection, documents in lines.items()}
+
+
+def _map(function: Callable, tasks: List[tuple], workers: int, ordered: bool) -> Iterator:
+    """Map a function over tasks in worker processes, or in this one for a single worker."""
+    if workers <= 1:
+        yield from map(function, tasks)
+        return
+    with multiprocessing.Pool(workers) as pool:
+        if ordered:
+            yield from pool.imap(function, tasks)
+        else:
+            yield from pool.imap_unordered(function, tasks)
+
+
+def write_ndjson(spec: CatalogSpec, directory: pathlib.Path,
+                 workers: Optional[int] = None) -> Dict[str, int]:
+    """
+    Write a generated catalog as one NDJSON file per collection, e.g. ``movies.ndjson``.
+
+    Documents are written as relaxed extended JSON, which ``mongoimport`` reads. The files are the
+    same for the same spec however many workers generate them, but for the password hash of the
+    users, which is salted.
+
+    :param spec: The catalog to generate.
+    :param directory: The directory to write the files to, created if needed.
+    :param workers: The number of processes generating documents. Defaults to the number of CPUs.
+    :returns: The number of documents written, by collection.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    hashed_password = hash_password(PASSWORD) if spec.users else None
+    tasks = [(spec, kind, chunk, hashed_password) for kind, chunk in catalog_chunks(spec)]
+    counts = Counter()
+    files = {
+        collection: (directory / f'{collection}.ndjson').open('wb')
+        for collection in COLLECTIONS}
+    try:
+        for chunk in _map(_encode_chunk, tasks, workers or multiprocessing.cpu_count(), True):
+            for collection, (count, data) in chunk.items():
+                files[collection].write(data)
+                counts[collection] += count
+    finally:
+        for file in files.values():
+            file.close()
+    return dict(counts)
+
+
+def insert_catalog_parallel(spec: CatalogSpec, workers: Optional[int] = None,
+                            batch_size: int = 1000) -> Dict[str, int]:
+    """
+    Insert a generated catalog into the configured Mongo, from worker processes.
+
+    Each worker generates chunks of the catalog and inserts them with its own client, in unordered
+    batches, so the inserts of the workers run in parallel.
+
+    :param spec: The catalog to generate.
+    :param workers: The number of processes inserting documents. Defaults to the number of CPUs.
+    :param batch_size: The number of documents per insert.
+    :returns: The number of documents inserted, by collection.
+    """
+    hashed_password = hash_password(PASSWORD) if spec.users else None
+    tasks = [
+        (spec, kind, chunk, hashed_password, batch_size) for kind, chunk in catalog_chunks(spec)]
+    counts = Counter()
+    for chunk in _map(_insert_chunk, tasks, workers or multiprocessing.cpu_count(), False):
+        counts.update(chunk)
+    return dict(counts)
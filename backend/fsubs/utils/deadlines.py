@@ -0,0 +1,81 @@
+"""Per-request time budgets, turned into ``maxTimeMS`` on the Mongo queries made for a request."""
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, Optional, Tuple
+
+# The deadline of the request being handled (on the ``time.monotonic`` clock) and the longest a
+# single query may take, in milliseconds.
+_DEADLINE: ContextVar[Optional[Tuple[float, int]]] = ContextVar('deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    """The request ran out of time before making a query."""
+
+
+def remaining_ms() -> Optional[float]:
+    """
+    Get the time left to handle the current request.
+
+    :returns: The time left in milliseconds, or ``None`` outside of a request.
+    """
+    deadline = _DEADLINE.get()
+    if deadline is None:
+        return None
+    return (deadline[0] - time.monotonic()) * 1000
+
+
+def max_time_ms() -> Optional[int]:
+    """
+    Get the ``maxTimeMS`` of the next query.
+
+    This is the time left to handle the request, capped at the per query limit.
+
+    :returns: The ``maxTimeMS``, or ``None`` outside of a request.
+    :raises DeadlineExceeded: If the request has no time left.
+    """
+    deadline = _DEADLINE.get()
+    if deadline is None:
+        return None
+    remaining = int((deadline[0] - time.monotonic()) * 1000)
+    if remaining <= 0:
+        raise DeadlineExceeded('Request deadline exceeded.')
+    return min(remaining, deadline[1]) if deadline[1] else remaining
+
+
+def command_options() -> Dict[str, Any]:
+    """
+    Get the ``maxTimeMS`` of the next query as options of a raw command (e.g. ``distinct``).
+
+    :returns: The options, empty outside of a request.
+    :raises DeadlineExceeded: If the request has no time left.
+    """
+    ms = max_time_ms()
+    return {'maxTimeMS': ms} if ms is not None else {}
+
+
+class DeadlineMiddleware():
+    """ASGI middleware giving every request a time budget for its queries."""
+
+    def __init__(self, app, timeout_ms: float, max_time_ms: int = 0):
+        """
+        Initialize a ``DeadlineMiddleware``.
+
+        :param app: The ASGI app to wrap.
+        :param timeout_ms: The time budget of a request in milliseconds. ``0`` disables deadlines.
+        :param max_time_ms: The longest a single query may take in milliseconds. ``0`` only limits
+        queries to the time left in the request.
+        """
+        self.app = app
+        self.timeout_ms = timeout_ms
+        self.max_time_ms = max_time_ms
+
+    async def __call__(self, scope, receive, send):
+        """Handle an ASGI call."""
+        if scope['type'] != 'http' or not self.timeout_ms:
+            await self.app(scope, receive, send)
+            return
+        token = _DEADLINE.set((time.monotonic() + self.timeout_ms / 1000, self.max_time_ms))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _DEADLINE.reset(token)
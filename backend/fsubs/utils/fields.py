@@ -0,0 +1,75 @@
+"""Utility functions for partial (field projected) responses."""
+import logging
+from functools import lru_cache
+from typing import Any, Dict, Optional, Type
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, create_model
+
+LOGGER = logging.getLogger(__name__)
+
+
+def parse_fields(fields: Optional[str], model: Type[BaseModel]) -> Optional[Dict[str, bool]]:
+    """
+    Turn a comma separated list of fields into a pymongo projection.
+
+    Only the fields of the given response model can be requested. ``id`` is always returned.
+
+    :param fields: The comma separated list of fields (e.g. ``id,title``).
+    :param model: The response model the fields are validated against.
+    :returns: The pymongo projection, or ``None`` if no fields were requested.
+    :raises HTTPException: If any of the fields is not a field of the model.
+    """
+    if not fields:
+        return None
+    requested = {field.strip() for field in fields.split(',') if field.strip()}
+    unknown = requested - set(model.__fields__)
+    if unknown:
+        raise HTTPException(
+            status_code=422,
+            detail=f'Unknown fields: {", ".join(sorted(unknown))}. Allowed fields are: '
+                   f'{", ".join(model.__fields__)}.')
+    projection = {'_id': True}
+    projection.update({field: True for field in requested if field != 'id'})
+    LOGGER.debug('Using projection: <%s>.', projection)
+    return projection
+
+
+@lru_cache(maxsize=None)
+def partial_model(model: Type[BaseModel]) -> Type[BaseModel]:
+    """
+    Build a copy of a model where every field is optional.
+
+    :param model: The model to copy.
+    :returns: The partial model.
+    """
+    return create_model(
+        f'Partial{model.__name__}',
+        **{name: (Optional[field.outer_type_], None) for name, field in model.__fields__.items()})
+
+
+def partial_response(model: Type[BaseModel], content: Any,
+                     projection: Dict[str, bool]) -> JSONResponse:
+    """
+    Build a response containing only the projected fields.
+
+    :param model: The response model of the endpoint.
+    :param content: A document, a list of documents or ``None``.
+    :param projection: The projection returned by ``parse_fields``.
+    :returns: The response with every document validated against the partial model.
+    """
+    partial = partial_model(model)
+    include = {'id', *projection}
+
+    def encode(document):
+        if document is None:
+            return None
+        return partial(**document).dict(include=include, exclude_unset=True)
+
+    if isinstance(content, list):
+        content = [encode(document) for document in content]
+    else:
+        content = encode(content)
+    return JSONResponse(content=jsonable_encoder(content))
@@ -0,0 +1,139 @@
+"""Non blocking logging with JSON output, redaction and sampling."""
+import atexit
+import json
+import logging
+import queue
+import random
+import re
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+TEXT_FORMAT = "%(asctime)s - %(name)s:%(funcName)s:%(lineno)s - %(levelname)s - %(message)s"
+
+# Matches ``password='x'``, ``'salt': 'x'``, ``"hashed_password": "x"``, ``access_token: x`` and
+# ``salt: x`` in a formatted message.
+SECRET = re.compile(
+    r'''(?P<key>['"]?(?:hashed_password|password|salt|access_token)['"]?\s*[:=]\s*)'''
+    r'''(?P<value>'[^']*'|"[^"]*"|b'[^']*'|[^\s,)}]+)''')
+# Matches the token of ``Bearer <token>``, e.g. in an ``Authorization`` header.
+BEARER = re.compile(r'''(?<=Bearer )[^\s'",)}]+''')
+
+
+class RedactingFilter(logging.Filter):
+    """Replace passwords, password hashes, salts and access tokens in log messages with ``***``."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        """Redact the message of the record."""
+        record.msg = BEARER.sub('***', SECRET.sub(r"\g<key>'***'", record.getMessage()))
+        record.args = None
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Only let through a fraction of the info and debug records of some loggers."""
+
+    def __init__(self, rates: Dict[str, float]):
+        """
+        Initialize a ``SamplingFilter``.
+
+        :param rates: The fraction of records to keep, keyed by logger name. A logger name also
+        applies to its children.
+        """
+        super().__init__()
+        self.rates = rates
+        self._cache: Dict[str, Optional[float]] = {}
+
+    def _rate(self, name: str) -> Optional[float]:
+        """Get the sample rate of a logger, from the closest configured ancestor."""
+        if name not in self._cache:
+            rate, parts = None, name.split('.')
+            for i in range(len(parts), 0, -1):
+                rate = self.rates.get('.'.join(parts[:i]))
+                if rate is not None:
+                    break
+            self._cache[name] = rate
+        return self._cache[name]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        """Drop sampled out info and debug records."""
+        if record.levelno > logging.INFO:
+            return True
+        rate = self._rate(record.name)
+        return rate is None or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        """Format a record as JSON."""
+        document = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'function': record.funcName,
+            'line': record.lineno,
+            'message': record.getMessage(),
+        }
+        return json.dumps(document, default=str)
+
+
+def parse_sample_rates(value: str) -> Dict[str, float]:
+    """
+    Parse a comma separated list of logger sample rates.
+
+    :param value: The sample rates (e.g. ``uvicorn.access=0.1,fsubs.routers=0.5``).
+    :returns: The sample rates keyed by logger name.
+    """
+    rates = {}
+    for item in filter(None, (item.strip() for item in (value or '').split(','))):
+        name, rate = item.split('=', 1)
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+def setup_logging(level: str, json_format: bool = False,
+                  sample_rates: Dict[str, float] = None) -> QueueListener:
+    """
+    Send every log record through a queue to a background thread writing to stderr.
+
+    Records are sampled in the logging thread, then redacted, formatted and written in the
+    background so a slow stderr never blocks a request. The queue handler merges the arguments
+    into the message before queueing, so later changes to the arguments don't leak into the log.
+
+    :param level: The log level.
+    :param json_format: Whether to write JSON lines instead of text.
+    :param sample_rates: The fraction of info and debug records to keep, keyed by logger name.
+    :returns: The started listener writing the records.
+    """
+    root = logging.getLogger()
+    root.setLevel(level.upper())
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+    stream_handler.addFilter(RedactingFilter())
+
+    queue_handler = QueueHandler(queue.SimpleQueue())
+    if sample_rates:
+        queue_handler.addFilter(SamplingFilter(sample_rates))
+    root.addHandler(queue_handler)
+
+    listener = QueueListener(queue_handler.queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def setup_logging_from_config(config) -> QueueListener:
+    """
+    Set up logging from the ``[app]`` section of the config.
+
+    :param config: The ``Config``.
+    :returns: The started listener writing the records.
+    """
+    return setup_logging(
+        level=config["app"]["log_level"],
+        json_format=config["app"]["log_format"] == 'json',
+        sample_rates=parse_sample_rates(config["app"]["log_sample_rates"]),
+    )
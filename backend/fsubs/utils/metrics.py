@@ -0,0 +1,372 @@
+"""In-process metrics with Prometheus text exposition."""
+import asyncio
+import functools
+import inspect
+import logging
+import threading
+import time
+from bisect import bisect_left
+from typing import Any, Dict, Iterable, List, Tuple
+
+from pymongo import monitoring
+
+from fsubs.utils.breaker import BREAKER, CircuitOpen
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    """Format label names and values the way Prometheus expects them."""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric():
+    """Base class for a metric with optional labels."""
+
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        """
+        Initialize a ``Metric``.
+
+        :param name: The name of the metric.
+        :param documentation: The help text of the metric.
+        :param labels: The names of the labels of the metric.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        """Get the key of a set of label values."""
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def render(self) -> List[str]:
+        """Render the metric in the Prometheus text format."""
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labels, key)} {value}')
+        return lines
+
+    def snapshot(self) -> Dict[Tuple[str, ...], Any]:
+        """Get a copy of the current values keyed by label values."""
+        with self._lock:
+            return dict(self._values)
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        """Increment the counter."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that can go up and down."""
+
+    type = 'gauge'
+
+    def set(self, value: float, **labels):
+        """Set the gauge."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        """Increment the gauge."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        """Decrement the gauge."""
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """Observations counted in buckets, along with their count and sum."""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        """
+        Initialize a ``Histogram``.
+
+        :param name: The name of the metric.
+        :param documentation: The help text of the metric.
+        :param labels: The names of the labels of the metric.
+        :param buckets: The upper bounds of the buckets.
+        """
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        """Record an observation."""
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket, plus +Inf, the total count and the sum.
+                counts = self._values[key] = [0] * (len(self.buckets) + 2) + [0.0]
+            counts[index] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def render(self) -> List[str]:
+        """Render the histogram in the Prometheus text format."""
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        label_names = (*self.labels, 'le')
+        for key, counts in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                labels = _format_labels(label_names, (*key, bound))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labels, key)
+            lines.append(f'{self.name}_count{labels} {counts[-2]}')
+            lines.append(f'{self.name}_sum{labels} {counts[-1]}')
+        return lines
+
+    def snapshot(self) -> Dict[Tuple[str, ...], Any]:
+        """Get the count and sum of every set of label values."""
+        with self._lock:
+            return {key: list(counts) for key, counts in self._values.items()}
+
+
+class Registry():
+    """A collection of metrics."""
+
+    def __init__(self):
+        """Initialize a ``Registry``."""
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        """
+        Add a metric to the registry.
+
+        :param metric: The metric to add.
+        :returns: The metric.
+        """
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, *args, **kwargs) -> Counter:
+        """Create and register a ``Counter``."""
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs) -> Gauge:
+        """Create and register a ``Gauge``."""
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        """Create and register a ``Histogram``."""
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text format."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> Dict[str, Dict[Tuple[str, ...], Any]]:
+        """
+        Get the current values of every metric.
+
+        Histograms are reported as ``{'count': ..., 'sum': ...}``.
+
+        :returns: The values of each metric keyed by metric name, then by label values.
+        """
+        snapshot = {}
+        for name, metric in self._metrics.items():
+            values = metric.snapshot()
+            if isinstance(metric, Histogram):
+                values = {key: {'count': counts[-2], 'sum': counts[-1]}
+                          for key, counts in values.items()}
+            snapshot[name] = values
+        return snapshot
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.counter(
+    'fsubs_http_requests_total', 'HTTP requests handled.', ('method', 'handler', 'status'))
+HTTP_LATENCY = REGISTRY.histogram(
+    'fsubs_http_request_duration_seconds', 'HTTP request latency.', ('method', 'handler'))
+DAO_CALLS = REGISTRY.counter('fsubs_dao_calls_total', 'DAO method calls.', ('method',))
+DAO_ERRORS = REGISTRY.counter(
+    'fsubs_dao_errors_total', 'DAO method calls that raised.', ('method',))
+DAO_LATENCY = REGISTRY.histogram(
+    'fsubs_dao_call_duration_seconds', 'DAO method call latency.', ('method',))
+POOL_CHECKOUTS = REGISTRY.counter(
+    'fsubs_mongo_pool_checkouts_total', 'Mongo connection pool checkouts.', ('result',))
+POOL_WAIT = REGISTRY.histogram(
+    'fsubs_mongo_pool_checkout_wait_seconds', 'Time spent waiting to check out a connection.')
+POOL_CONNECTIONS = REGISTRY.gauge(
+    'fsubs_mongo_pool_connections', 'Open Mongo connections.')
+POOL_IN_USE = REGISTRY.gauge(
+    'fsubs_mongo_pool_connections_in_use', 'Mongo connections currently checked out.')
+DB_CIRCUIT_OPEN = REGISTRY.gauge(
+    'fsubs_db_circuit_open', 'Whether the database circuit breaker is rejecting calls.')
+DAO_REJECTED = REGISTRY.counter(
+    'fsubs_dao_rejected_total', 'DAO method calls rejected by the open circuit breaker.',
+    ('method',))
+LOOP_LAG = REGISTRY.histogram(
+    'fsubs_event_loop_lag_seconds', 'How late the event loop ran a scheduled wake up.')
+
+
+def instrument(cls):
+    """
+    Class decorator recording the call count and latency of every public DAO coroutine method.
+
+    Calls are also guarded by the database circuit breaker (see ``fsubs.utils.breaker``). The
+    queries they make are counted against the request being handled by the storage engine (see
+    ``fsubs.utils.timing.timed_queries``).
+    Metrics are labelled ``<ClassName>.<method>`` (e.g. ``MovieDAO.read_multi``).
+    """
+    for name, method in list(vars(cls).items()):
+        if name.startswith('_') or not inspect.iscoroutinefunction(method):
+            continue
+        setattr(cls, name, _timed(f'{cls.__name__}.{name}', method))
+    return cls
+
+
+def _timed(label: str, method):
+    """Wrap a coroutine method to record its call count and latency."""
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            with BREAKER.guard():
+                return await method(*args, **kwargs)
+        except CircuitOpen:
+            DAO_REJECTED.inc(method=label)
+            raise
+        except Exception:
+            DAO_ERRORS.inc(method=label)
+            raise
+        finally:
+            DAO_CALLS.inc(method=label)
+            DAO_LATENCY.observe(time.perf_counter() - start, method=label)
+            DB_CIRCUIT_OPEN.set(int(BREAKER.is_open()))
+    return wrapper
+
+
+class MetricsMiddleware():
+    """ASGI middleware recording the count and latency of requests per handler."""
+
+    def __init__(self, app):
+        """
+        Initialize a ``MetricsMiddleware``.
+
+        :param app: The ASGI app to wrap.
+        """
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        """Handle an ASGI call."""
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # The router stores the matched endpoint in the scope.
+            endpoint = scope.get('endpoint')
+            handler = getattr(endpoint, '__name__', 'unmatched')
+            HTTP_REQUESTS.inc(method=scope['method'], handler=handler, status=status)
+            HTTP_LATENCY.observe(
+                time.perf_counter() - start, method=scope['method'], handler=handler)
+
+
+class PoolListener(monitoring.ConnectionPoolListener):
+    """Record Mongo connection pool checkouts and how long they wait."""
+
+    def __init__(self):
+        """Initialize a ``PoolListener``."""
+        self._local = threading.local()
+
+    def connection_check_out_started(self, event):
+        """Remember when the checkout started."""
+        self._local.start = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        """Record a successful checkout."""
+        POOL_CHECKOUTS.inc(result='success')
+        POOL_IN_USE.inc()
+        start = getattr(self._local, 'start', None)
+        if start is not None:
+            POOL_WAIT.observe(time.perf_counter() - start)
+
+    def connection_check_out_failed(self, event):
+        """Record a failed checkout."""
+        POOL_CHECKOUTS.inc(result=event.reason)
+
+    def connection_checked_in(self, event):
+        """Record a connection being returned."""
+        POOL_IN_USE.dec()
+
+    def connection_created(self, event):
+        """Record a new connection."""
+        POOL_CONNECTIONS.inc()
+
+    def connection_closed(self, event):
+        """Record a closed connection."""
+        POOL_CONNECTIONS.dec()
+
+    def connection_ready(self, event):
+        """Ignore connections becoming ready."""
+
+    def pool_created(self, event):
+        """Ignore pools being created."""
+
+    def pool_cleared(self, event):
+        """Ignore pools being cleared."""
+
+    def pool_closed(self, event):
+        """Ignore pools being closed."""
+
+
+# Passed to the clients of ``fsubs.crud.db``, not registered for every client of the process.
+POOL_LISTENER = PoolListener()
+
+
+async def monitor_event_loop_lag(interval: float = 0.5):
+    """
+    Record how late the event loop wakes up from a sleep, forever.
+
+    A large lag means something is blocking the event loop.
+
+    :param interval: How often to measure, in seconds.
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(loop.time() - start - interval, 0))
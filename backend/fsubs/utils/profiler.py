@@ -0,0 +1,122 @@
+"""A low overhead statistical profiler sampling the stacks of every thread of the worker."""
+import logging
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, Tuple
+
+LOGGER = logging.getLogger(__name__)
+
+# A frame is identified by its function name, file and first line.
+Frame = Tuple[str, str, int]
+
+
+class ProfilerBusy(Exception):
+    """Raised when a profile is requested while another one is running."""
+
+
+class Sampler():
+    """
+    Sample the stacks of every thread of the process at a fixed interval.
+
+    Only one profile can run at a time per process.
+    """
+
+    _running = threading.Lock()
+
+    def __init__(self, interval: float = 0.005):
+        """
+        Initialize a ``Sampler``.
+
+        :param interval: The time between samples in seconds.
+        """
+        self.interval = interval
+        self.duration = 0.0
+        self.samples: Dict[str, Counter] = {}
+
+    def run(self, seconds: float) -> 'Sampler':
+        """
+        Sample for the given time. Blocks, so run it in an executor from async code.
+
+        :param seconds: How long to sample for.
+        :returns: The sampler, holding the samples.
+        :raises ProfilerBusy: If another profile is already running.
+        """
+        if not Sampler._running.acquire(blocking=False):
+            raise ProfilerBusy()
+        try:
+            LOGGER.info('Profiling for %ss every %sms.', seconds, self.interval * 1000)
+            own_thread = threading.get_ident()
+            start = time.perf_counter()
+            deadline = start + seconds
+            while time.perf_counter() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own_thread:
+                        continue
+                    thread = names.get(thread_id, str(thread_id))
+                    self.samples.setdefault(thread, Counter())[self._stack(frame)] += 1
+                time.sleep(self.interval)
+            self.duration = time.perf_counter() - start
+        finally:
+            Sampler._running.release()
+        return self
+
+    @staticmethod
+    def _stack(frame) -> Tuple[Frame, ...]:
+        """Get a stack from the outermost to the innermost frame."""
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+        return tuple(reversed(stack))
+
+    def collapsed(self) -> str:
+        """
+        Get the samples in the collapsed stack format used by ``flamegraph.pl`` and speedscope.
+
+        :returns: One ``thread;outer;...;inner count`` line per unique stack.
+        """
+        lines = []
+        for thread, stacks in self.samples.items():
+            for stack, count in stacks.most_common():
+                frames = ';'.join(f'{name} ({filename}:{line})' for name, filename, line in stack)
+                lines.append(f'{thread};{frames} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def speedscope(self) -> Dict[str, Any]:
+        """
+        Get the samples in the speedscope file format, with one profile per thread.
+
+        :returns: The speedscope document.
+        """
+        frames: Dict[Frame, int] = {}
+        profiles = []
+        for thread, stacks in self.samples.items():
+            samples, weights = [], []
+            for stack, count in stacks.most_common():
+                samples.append([frames.setdefault(frame, len(frames)) for frame in stack])
+                weights.append(count * self.interval)
+            profiles.append({
+                'type': 'sampled',
+                'name': thread,
+                'unit': 'seconds',
+                'startValue': 0,
+                'endValue': self.duration,
+                'samples': samples,
+                'weights': weights,
+            })
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'shared': {
+                'frames': [
+                    {'name': name, 'file': filename, 'line': line}
+                    for name, filename, line in frames
+                ],
+            },
+            'profiles': profiles,
+            'name': 'fsubs profile',
+            'exporter': 'fsubs',
+        }
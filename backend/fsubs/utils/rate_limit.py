@@ -0,0 +1,278 @@
+"""Token bucket rate limits per user (or per client IP when anonymous) and route class."""
+import json
+import logging
+import math
+import time
+from typing import Dict, NamedTuple, Optional
+from urllib.parse import parse_qs
+
+from jwt import PyJWTError
+from pymongo.errors import PyMongoError
+
+from fsubs.crud.rate_limit import RateLimitDAO
+from fsubs.utils.admission import ROUTE_CLASSES, route_class
+from fsubs.utils.auth import decode_access_token
+from fsubs.utils.breaker import CircuitOpen
+from fsubs.utils.metrics import REGISTRY
+
+LOGGER = logging.getLogger(__name__)
+
+RATE_LIMITED = REGISTRY.counter(
+    'fsubs_rate_limited_total', 'Requests rejected by a rate limit, by route class.',
+    ('route_class',))
+
+
+class Limit(NamedTuple):
+    """The budget of a route class: ``rate`` tokens added per second, up to ``burst`` tokens."""
+
+    rate: float
+    burst: float
+
+
+class Decision(NamedTuple):
+    """Whether tokens could be taken from a bucket, and the tokens ``remaining`` in it."""
+
+    allowed: bool
+    remaining: float
+    limit: Limit
+
+    def reset_seconds(self) -> int:
+        """Get how long until the bucket is full again."""
+        return math.ceil((self.limit.burst - self.remaining) / self.limit.rate)
+
+    def retry_after(self, cost: float) -> int:
+        """Get how long until the bucket has enough tokens for a request of the given cost."""
+        return max(1, math.ceil((cost - self.remaining) / self.limit.rate))
+
+
+class MemoryBackend():
+    """
+    Token buckets in a dict of this process.
+
+    Buckets are only touched from the event loop and never across an ``await``, so no lock is
+    needed. Each worker has its own buckets, so a client may get up to the number of workers times
+    its budget.
+    """
+
+    def __init__(self, max_keys: int = 100000):
+        """
+        Initialize a ``MemoryBackend``.
+
+        :param max_keys: The number of buckets above which idle ones are dropped.
+        """
+        self.max_keys = max_keys
+        # The tokens left in each bucket, when they were counted and when the bucket will be full.
+        self._buckets: Dict[str, list] = {}
+
+    async def ensure_indexes(self):
+        """Nothing to prepare for in memory buckets."""
+
+    async def take(self, key: str, limit: Limit, cost: float) -> Decision:
+        """
+        Refill a bucket and take tokens from it if it has enough.
+
+        :param key: The key of the bucket.
+        :param limit: The budget of the bucket.
+        :param cost: The number of tokens to take.
+        :returns: The decision.
+        """
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_keys:
+                self._prune(now)
+            bucket = self._buckets[key] = [limit.burst, now, now]
+        tokens = min(limit.burst, bucket[0] + (now - bucket[1]) * limit.rate)
+        allowed = tokens >= cost
+        if allowed:
+            tokens -= cost
+        bucket[:] = tokens, now, now + (limit.burst - tokens) / limit.rate
+        return Decision(allowed=allowed, remaining=tokens, limit=limit)
+
+    def _prune(self, now: float):
+        """Drop the buckets that are full again, which is the same as not having one."""
+        for key in [key for key, bucket in self._buckets.items() if bucket[2] <= now]:
+            del self._buckets[key]
+        if len(self._buckets) >= self.max_keys:
+            # Everyone is active, drop the least recently used half.
+            by_age = sorted(self._buckets, key=lambda key: self._buckets[key][1])
+            for key in by_age[:len(by_age) // 2]:
+                del self._buckets[key]
+
+
+class MongoBackend():
+    """
+    Token buckets in Mongo, shared by every worker.
+
+    Each take is a single atomic update. If Mongo is unavailable requests are let through rather
+    than failing because of the rate limiter.
+    """
+
+    def __init__(self, dao):
+        """
+        Initialize a ``MongoBackend``.
+
+        :param dao: The ``RateLimitDAO`` to store the buckets with.
+        """
+        self.dao = dao
+
+    async def ensure_indexes(self):
+        """Create the index expiring idle buckets."""
+        await self.dao.ensure_indexes()
+
+    async def take(self, key: str, limit: Limit, cost: float) -> Decision:
+        """
+        Refill a bucket and take tokens from it if it has enough.
+
+        :param key: The key of the bucket.
+        :param limit: The budget of the bucket.
+        :param cost: The number of tokens to take.
+        :returns: The decision.
+        """
+        try:
+            bucket = await self.dao.take(key, limit.rate, limit.burst, cost, time.time())
+        except (PyMongoError, CircuitOpen) as e:
+            LOGGER.warning('Unable to check rate limit, letting the request through: %s', e)
+            return Decision(allowed=True, remaining=limit.burst, limit=limit)
+        return Decision(allowed=bucket['allowed'], remaining=bucket['tokens'], limit=limit)
+
+
+def client_key(scope) -> str:
+    """
+    Get the key a request is rate limited by.
+
+    :param scope: The ASGI scope of the request.
+    :returns: ``user:<identity>`` for requests with a valid token, ``ip:<address>`` otherwise.
+    """
+    for name, value in scope['headers']:
+        if name == b'authorization':
+            scheme, _, token = value.decode('latin-1').partition(' ')
+            if scheme.lower() == 'bearer' and token:
+                try:
+                    identity = decode_access_token(token).get('identity')
+                except PyJWTError:
+                    identity = None
+                if identity:
+                    return f'user:{identity}'
+            break
+    client = scope.get('client')
+    return f'ip:{client[0] if client else "unknown"}'
+
+
+def request_cost(scope, route: str, list_page_size: int) -> float:
+    """
+    Get the number of tokens a request costs.
+
+    List requests cost one token per ``list_page_size`` titles asked for, every other request
+    costs one.
+
+    :param scope: The ASGI scope of the request.
+    :param route: The route class of the request.
+    :param list_page_size: The number of titles a token pays for.
+    :returns: The cost.
+    """
+    if route != 'list' or not list_page_size:
+        return 1
+    query = parse_qs(scope['query_string'].decode('latin-1'))
+    try:
+        page_length = int(query.get('page_length', ['100'])[0])
+    except ValueError:
+        return 1
+    return max(1, math.ceil(page_length / list_page_size))
+
+
+class RateLimitMiddleware():
+    """
+    ASGI middleware limiting the rate of requests of every user, or client IP when anonymous.
+
+    Each route class has its own budget. Limited responses have ``RateLimit-Limit``,
+    ``RateLimit-Remaining`` and ``RateLimit-Reset`` headers, and rejected requests get a 429 with a
+    ``Retry-After`` header.
+    """
+
+    def __init__(self, app, backend, limits: Dict[str, Limit], list_page_size: int = 100):
+        """
+        Initialize a ``RateLimitMiddleware``.
+
+        :param app: The ASGI app to wrap.
+        :param backend: Where the buckets are kept (a ``MemoryBackend`` or ``MongoBackend``).
+        :param limits: The budget of each limited route class.
+        :param list_page_size: The number of titles a token pays for on list requests.
+        """
+        self.app = app
+        self.backend = backend
+        self.limits = limits
+        self.list_page_size = list_page_size
+
+    async def __call__(self, scope, receive, send):
+        """Handle an ASGI call."""
+        route: Optional[str] = None
+        if scope['type'] == 'http':
+            route = route_class(scope['method'], scope['path'])
+        limit = self.limits.get(route)
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+        # A request costing more than the capacity could never pass, charge it all instead.
+        cost = min(request_cost(scope, route, self.list_page_size), limit.burst)
+        decision = await self.backend.take(f'{route}:{client_key(scope)}', limit, cost)
+        headers = [
+            (b'ratelimit-limit', str(int(limit.burst)).encode('latin-1')),
+            (b'ratelimit-remaining', str(int(decision.remaining)).encode('latin-1')),
+            (b'ratelimit-reset', str(decision.reset_seconds()).encode('latin-1')),
+        ]
+        if not decision.allowed:
+            RATE_LIMITED.inc(route_class=route)
+            await self._send_rejected(send, headers, decision.retry_after(cost))
+            return
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                message = {**message, 'headers': list(message.get('headers', [])) + headers}
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+    @staticmethod
+    async def _send_rejected(send, headers, retry_after: int):
+        """Send a 429 asking the client to slow down."""
+        body = json.dumps({'detail': 'Too many requests, slow down.'}).encode()
+        await send({
+            'type': 'http.response.start',
+            'status': 429,
+            'headers': headers + [
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(body)).encode('latin-1')),
+                (b'retry-after', str(retry_after).encode('latin-1')),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+
+def rate_limits_from_config(config, client) -> Dict:
+    """
+    Build the rate limiter settings from the ``[ratelimit]`` section of the config.
+
+    :param config: The ``Config``.
+    :param client: The client to keep shared buckets with, when the backend is ``mongo``. ``None``
+     when there is no Mongo (e.g. with the memory engine), buckets are then kept in memory.
+    :returns: The keyword arguments of ``RateLimitMiddleware``.
+    """
+    section = config["ratelimit"]
+    if section["backend"] == 'mongo' and client is not None:
+        backend = MongoBackend(RateLimitDAO(client=client))
+    else:
+        if section["backend"] == 'mongo':
+            LOGGER.warning(
+                'Keeping rate limits in memory, there is no Mongo to share them through.')
+        backend = MemoryBackend(max_keys=section.getint("max_keys"))
+    limits = {}
+    for name in ROUTE_CLASSES:
+        rate = section.getfloat(f"{name}_rate")
+        if rate > 0:
+            limits[name] = Limit(rate=rate, burst=max(1.0, section.getfloat(f"{name}_burst")))
+    return {
+        'backend': backend,
+        'limits': limits,
+        'list_page_size': section.getint("list_page_size"),
+    }
@@ -0,0 +1,129 @@
+"""An in memory replica of the revoked access tokens, so checking a token needs no query."""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, Optional, Set
+
+from pymongo.errors import PyMongoError
+
+from fsubs.utils.breaker import CircuitOpen
+from fsubs.utils.metrics import REGISTRY
+from fsubs.utils.token_cache import TOKEN_CACHE
+
+LOGGER = logging.getLogger(__name__)
+
+# Revocations made on other workers within this long of the last refresh are read again, in case
+# their clocks are behind.
+REFRESH_OVERLAP = timedelta(seconds=30)
+# How long clients are told to wait when the revocations aren't loaded yet.
+NOT_LOADED_RETRY_SECONDS = 5
+
+REVOKED_TOKENS = REGISTRY.gauge(
+    'fsubs_revoked_tokens', 'Revocations held in memory, by kind (jti or user).', ('kind',))
+REVOKED_REJECTED = REGISTRY.counter(
+    'fsubs_revoked_rejected_total', 'Requests rejected because their token was revoked.')
+
+
+class RevocationList():
+    """
+    The revoked tokens, by ``jti``, and the first token version still valid, by user.
+
+    Checking a token is a set and a dict lookup. The replica is refreshed incrementally from the
+    ``revocations`` collection, so a token revoked on another worker is rejected here after at most
+    the refresh interval. Until the first refresh succeeded, ``loaded`` is ``False`` and no token
+    can be trusted.
+    """
+
+    def __init__(self):
+        """Initialize an empty ``RevocationList``."""
+        self._jtis: Set[str] = set()
+        self._token_versions: Dict[str, int] = {}
+        self._expires: Dict[str, datetime] = {}
+        self._refreshed: Optional[datetime] = None
+        self.loaded = False
+
+    def is_revoked(self, claims: Dict[str, Any]) -> bool:
+        """
+        Check whether a token was revoked.
+
+        :param claims: The claims of the token.
+        :returns: ``True`` if the token, or every token of its user up to its version, was revoked.
+        """
+        if claims.get('jti') in self._jtis:
+            return True
+        min_version = self._token_versions.get(claims.get('identity'))
+        return min_version is not None and claims.get('tv', 0) < min_version
+
+    def apply(self, revocations: Iterable[Dict[str, Any]]):
+        """
+        Add revocations to the replica, dropping the tokens they revoke from ``TOKEN_CACHE``.
+
+        :param revocations: The revocations, as stored by ``RevocationDAO``.
+        """
+        jtis, versions = set(), {}
+        for revocation in revocations:
+            if revocation.get('jti'):
+                jtis.add(revocation['jti'])
+            elif revocation.get('identity') is not None:
+                identity = revocation['identity']
+                versions[identity] = max(
+                    revocation['token_version'], versions.get(identity, 0),
+                    self._token_versions.get(identity, 0))
+            self._expires[revocation['_id']] = revocation['expires']
+        jtis -= self._jtis
+        versions = {
+            identity: version for identity, version in versions.items()
+            if version != self._token_versions.get(identity)}
+        if not jtis and not versions:
+            return
+        self._jtis |= jtis
+        self._token_versions.update(versions)
+        TOKEN_CACHE.invalidate(self.is_revoked)
+        self._prune()
+        LOGGER.info('Applied %s token and %s user revocations.', len(jtis), len(versions))
+
+    async def refresh(self, dao):
+        """
+        Read the revocations made since the last refresh.
+
+        :param dao: The ``RevocationDAO`` to read them with.
+        """
+        now = datetime.utcnow()
+        since = self._refreshed - REFRESH_OVERLAP if self._refreshed is not None else None
+        self.apply(await dao.read_since(since))
+        self._refreshed = now
+        self.loaded = True
+        self._prune()
+
+    def _prune(self):
+        """Forget the revocations of tokens that have expired anyway."""
+        now = datetime.utcnow()
+        expired = [key for key, expires in self._expires.items() if expires <= now]
+        for key in expired:
+            del self._expires[key]
+            kind, _, value = key.partition(':')
+            if kind == 'jti':
+                self._jtis.discard(value)
+            else:
+                self._token_versions.pop(value, None)
+        REVOKED_TOKENS.set(len(self._jtis), kind='jti')
+        REVOKED_TOKENS.set(len(self._token_versions), kind='user')
+
+
+async def refresh_revocations(revocations: RevocationList, dao, interval: float):
+    """
+    Keep refreshing the revocations, forever.
+
+    :param revocations: The ``RevocationList`` to refresh.
+    :param dao: The ``RevocationDAO`` to read them with.
+    :param interval: How long to wait between refreshes, in seconds.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await revocations.refresh(dao)
+        except (PyMongoError, CircuitOpen) as e:
+            LOGGER.warning('Unable to refresh revoked tokens: %s', e)
+
+
+REVOCATIONS = RevocationList()
@@ -0,0 +1,129 @@
+"""Utilities for coalescing concurrent identical reads."""
+import asyncio
+import contextvars
+import copy
+import functools
+import logging
+from typing import Any, Callable, Dict, Hashable, Iterable, List
+
+LOGGER = logging.getLogger(__name__)
+
+
+def run_in_executor(func: Callable, *args) -> asyncio.Future:
+    """
+    Run a blocking function in the default executor, within a copy of the current context.
+
+    Unlike ``loop.run_in_executor``, the function sees the context variables of the caller (e.g.
+    the deadline of the request being handled).
+
+    :param func: The blocking function to call.
+    :param args: The arguments to call the function with.
+    :returns: The future of the result.
+    """
+    loop = asyncio.get_event_loop()
+    context = contextvars.copy_context()
+    return loop.run_in_executor(None, functools.partial(context.run, func, *args))
+
+
+class SingleFlight():
+    """
+    Merge concurrent identical calls into a single call.
+
+    The first caller for a key runs the blocking function in the default executor. Callers that
+    arrive while it is still in flight wait for the same result instead of issuing their own call.
+    Nothing is cached once the call completes.
+    """
+
+    def __init__(self):
+        """Initialize a ``SingleFlight``."""
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, func: Callable, *args) -> Any:
+        """
+        Run ``func(*args)`` unless a call with the same key is already in flight.
+
+        :param key: The key identifying identical calls.
+        :param func: The blocking function to call.
+        :param args: The arguments to call the function with.
+        :returns: The result of the call. Callers that joined an in flight call get a deep copy
+        so they can safely mutate it.
+        """
+        task = self._calls.get(key)
+        shared = task is not None
+        if not shared:
+            task = asyncio.ensure_future(run_in_executor(func, *args))
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            LOGGER.debug('Joining in flight call for: <%s>.', key)
+        # Shield the shared call so a cancelled caller doesn't cancel it for everyone else.
+        result = await asyncio.shield(task)
+        return copy.deepcopy(result) if shared else result
+
+    def _forget(self, key: Hashable, task: asyncio.Future):
+        """Remove a completed call if it is still the one registered for the key."""
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+
+class BatchLoader():
+    """
+    Collect the keys loaded within one event loop tick into a single batch call.
+
+    ``batch_func`` is a blocking function taking a list of unique keys and returning a dict of key
+    to value. It runs in the default executor. Keys missing from the dict load as ``None``.
+    """
+
+    def __init__(self, batch_func: Callable[[List[Hashable]], Dict[Hashable, Any]]):
+        """
+        Initialize a ``BatchLoader``.
+
+        :param batch_func: The blocking function loading a batch of keys.
+        """
+        self._batch_func = batch_func
+        self._pending: Dict[Hashable, List[asyncio.Future]] = {}
+
+    async def load(self, key: Hashable) -> Any:
+        """
+        Load a single key as part of the current batch.
+
+        :param key: The key to load.
+        :returns: The value for the key, or ``None`` if it was not found.
+        """
+        loop = asyncio.get_event_loop()
+        if not self._pending:
+            loop.call_soon(self._dispatch)
+        future = loop.create_future()
+        self._pending.setdefault(key, []).append(future)
+        return await future
+
+    async def load_many(self, keys: Iterable[Hashable]) -> List[Any]:
+        """
+        Load several keys as part of the current batch.
+
+        :param keys: The keys to load.
+        :returns: The values in the same order as the keys.
+        """
+        return await asyncio.gather(*(self.load(key) for key in keys))
+
+    def _dispatch(self):
+        """Start the batch call for every key collected so far."""
+        pending, self._pending = self._pending, {}
+        asyncio.ensure_future(self._run(pending))
+
+    async def _run(self, pending: Dict[Hashable, List[asyncio.Future]]):
+        """Run a batch call and resolve every waiting future."""
+        LOGGER.debug('Loading batch of %s keys.', len(pending))
+        try:
+            results = await run_in_executor(self._batch_func, list(pending))
+        except Exception as e:
+            for futures in pending.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        for key, futures in pending.items():
+            value = results.get(key)
+            for i, future in enumerate(futures):
+                if not future.done():
+                    future.set_result(value if i == 0 else copy.deepcopy(value))
@@ -0,0 +1,229 @@
+"""Record slow Mongo queries with their (redacted) shape, for the ``/debug`` endpoints."""
+import copy
+import itertools
+import logging
+import queue
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from pymongo import monitoring
+from pymongo.errors import CollectionInvalid, PyMongoError
+
+LOGGER = logging.getLogger(__name__)
+
+# The commands worth recording, mapped to where their filter lives in the command document.
+FILTER_KEYS = {
+    'find': 'filter',
+    'aggregate': 'pipeline',
+    'count': 'query',
+    'distinct': 'query',
+    'findAndModify': 'query',
+    'update': 'updates',
+    'delete': 'deletes',
+}
+
+# Fields of a command that are added by the driver and can't be passed back to ``explain``.
+DRIVER_FIELDS = ('lsid', 'txnNumber', 'autocommit', 'startTransaction')
+
+
+def redact(value: Any) -> Any:
+    """
+    Replace every value in a filter with ``'?'``, keeping field names and operators.
+
+    :param value: The filter (or part of it) to redact.
+    :returns: The shape of the filter.
+    """
+    if isinstance(value, dict):
+        return {key: redact(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        # Lists of documents (pipelines, update statements) keep their shape, lists of values
+        # (e.g. for $in) are collapsed so their length isn't leaked either.
+        if value and all(isinstance(item, dict) for item in value):
+            return [redact(item) for item in value]
+        return ['?']
+    return '?'
+
+
+def _filter_shape(name: str, command: Dict[str, Any]) -> Any:
+    """Get the redacted filter of a command."""
+    value = command.get(FILTER_KEYS[name])
+    if name in ('update', 'delete'):
+        value = [statement.get('q') for statement in value or []]
+    return redact(value)
+
+
+def _returned(name: str, reply: Dict[str, Any]) -> Optional[int]:
+    """Get the number of documents a command returned or affected."""
+    if 'cursor' in reply:
+        return len(reply['cursor'].get('firstBatch', []))
+    if name == 'distinct':
+        return len(reply.get('values', []))
+    if name == 'findAndModify':
+        return reply.get('lastErrorObject', {}).get('n')
+    return reply.get('n')
+
+
+class SlowQueryLog(monitoring.CommandListener):
+    """
+    Keep the most recent Mongo commands slower than a threshold.
+
+    Records are kept in a bounded in-memory ring buffer and, if a collection name is given,
+    written to a capped collection by a background thread. Filter values are redacted from the
+    records. The original command is only kept in memory so it can be explained on demand.
+
+    Nothing is recorded until the log is configured.
+    """
+
+    def __init__(self):
+        """Initialize a ``SlowQueryLog``."""
+        self.threshold_ms: Optional[float] = None
+        self.collection: Optional[str] = None
+        self.collection_size = 1024 * 1024
+        self._records = deque(maxlen=0)
+        self._started: Dict[Any, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._queue = None
+
+    def configure(self, threshold_ms: float, buffer_size: int, collection: Optional[str] = None,
+                  collection_size: int = 1024 * 1024):
+        """
+        Start recording slow commands.
+
+        :param threshold_ms: The duration in milliseconds above which a command is recorded.
+        :param buffer_size: The number of records to keep in memory.
+        :param collection: The name of the capped collection to also write records to.
+        :param collection_size: The maximum size of the capped collection in bytes.
+        """
+        self.collection = collection
+        self.collection_size = collection_size
+        self._records = deque(self._records, maxlen=buffer_size)
+        self.threshold_ms = threshold_ms
+
+    def configure_from_config(self, config):
+        """
+        Start recording slow commands, as set in the ``[debug]`` section of the config.
+
+        :param config: The ``Config``.
+        """
+        self.configure(
+            threshold_ms=config["debug"].getfloat("slow_query_ms"),
+            buffer_size=config["debug"].getint("slow_query_buffer_size"),
+            collection=config["debug"]["slow_query_collection"] or None,
+        )
+
+    def started(self, event):
+        """Remember the command so it can be recorded if it turns out to be slow."""
+        if self.threshold_ms is None or event.command_name not in FILTER_KEYS:
+            return
+        collection = event.command.get(event.command_name)
+        if self.collection and collection == self.collection:
+            return
+        with self._lock:
+            self._started[(event.connection_id, event.request_id)] = {
+                'database': event.database_name,
+                'collection': collection,
+                'command': event.command,
+            }
+
+    def succeeded(self, event):
+        """Record the command if it was slow."""
+        with self._lock:
+            started = self._started.pop((event.connection_id, event.request_id), None)
+        if started is None:
+            return
+        duration_ms = event.duration_micros / 1000
+        if duration_ms < self.threshold_ms:
+            return
+        command = started['command']
+        record = {
+            'id': next(self._ids),
+            'time': datetime.now(timezone.utc),
+            'database': started['database'],
+            'collection': started['collection'],
+            'command': event.command_name,
+            'filter': _filter_shape(event.command_name, command),
+            'sort': command.get('sort'),
+            'duration_ms': duration_ms,
+            'returned': _returned(event.command_name, event.reply),
+        }
+        LOGGER.debug('Slow query: <%s>.', record)
+        self._records.append((record, command))
+        if self.collection:
+            self._write(record)
+
+    def failed(self, event):
+        """Forget the command."""
+        with self._lock:
+            self._started.pop((event.connection_id, event.request_id), None)
+
+    def records(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Get the recorded slow queries.
+
+        :param limit: The number of records to get. Defaults to all of them.
+        :returns: The records, most recent first.
+        """
+        records = [record for record, _ in reversed(self._records)]
+        return records[:limit] if limit is not None else records
+
+    def explain(self, client, record_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Run ``explain`` on the command of a record, with the original filter values.
+
+        :param client: The MongoClient to run the explain with.
+        :param record_id: The id of the record.
+        :returns: The explain output, or ``None`` if the record is no longer in the buffer.
+        """
+        for record, command in list(self._records):
+            if record['id'] == record_id:
+                break
+        else:
+            return None
+        command = {
+            key: value for key, value in copy.deepcopy(command).items()
+            if not key.startswith('$') and key not in DRIVER_FIELDS
+        }
+        return client[record['database']].command(
+            'explain', command, verbosity='executionStats')
+
+    def clear(self):
+        """Drop every record from the buffer."""
+        self._records.clear()
+
+    def _write(self, record: Dict[str, Any]):
+        """Queue a record to be written to the capped collection."""
+        if self._queue is None:
+            with self._lock:
+                if self._queue is None:
+                    self._queue = queue.Queue(maxsize=1000)
+                    threading.Thread(
+                        target=self._writer, name='slow-query-writer', daemon=True).start()
+        try:
+            self._queue.put_nowait(dict(record))
+        except queue.Full:
+            LOGGER.warning('Dropping slow query record, the writer is falling behind.')
+
+    def _writer(self):
+        """Write queued records to the capped collection, forever."""
+        # Imported here to avoid a circular import, the crud package imports this module.
+        from fsubs.crud.db import create_client
+        db = create_client().foreign_subs
+        try:
+            db.create_collection(self.collection, capped=True, size=self.collection_size)
+        except CollectionInvalid:
+            pass
+        except PyMongoError as e:
+            LOGGER.error('Unable to create slow query collection <%s>: %s', self.collection, e)
+        while True:
+            record = self._queue.get()
+            try:
+                db[self.collection].insert_one(record)
+            except PyMongoError as e:
+                LOGGER.error('Unable to write slow query record: %s', e)
+
+
+# Passed to the clients of ``fsubs.crud.db``, not registered for every client of the process.
+SLOW_QUERIES = SlowQueryLog()
@@ -0,0 +1,123 @@
+"""Serve the last good response to anonymous GET requests while the database is unavailable."""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Tuple
+
+from fsubs.utils.breaker import BREAKER
+
+LOGGER = logging.getLogger(__name__)
+
+# The catalog, the only responses worth serving stale. Probes and metrics must always be fresh.
+CACHED_PREFIXES = ('/movies', '/tv_shows')
+
+
+class StaleCacheMiddleware():
+    """
+    ASGI middleware keeping the latest 200 response of anonymous GET requests to the catalog.
+
+    Responses are only served from the cache while the database circuit breaker is open, or when
+    the request fails with a 503 because the database is unavailable. Stale responses have a
+    ``Warning: 110`` header and an ``Age`` header. Requests with an ``Authorization`` header are
+    never cached, since their response may depend on the user.
+    """
+
+    def __init__(self, app, max_entries: int = 1000, max_age_seconds: float = 3600,
+                 max_body_bytes: int = 1024 * 1024, prefixes: Iterable[str] = CACHED_PREFIXES):
+        """
+        Initialize a ``StaleCacheMiddleware``.
+
+        :param app: The ASGI app to wrap.
+        :param max_entries: The number of responses to keep, least recently used first out. ``0``
+        disables the cache.
+        :param max_age_seconds: How old a response may be to still be served.
+        :param max_body_bytes: The largest response body to keep.
+        :param prefixes: The paths whose responses are cached, with everything under them.
+        """
+        self.app = app
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+        self.max_body_bytes = max_body_bytes
+        self.prefixes = tuple(prefixes)
+        self._entries: 'OrderedDict[str, Tuple[float, int, List, bytes]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def __call__(self, scope, receive, send):
+        """Handle an ASGI call."""
+        if (scope['type'] != 'http' or scope['method'] != 'GET' or not self.max_entries
+                or not self._cached(scope['path'])
+                or any(name == b'authorization' for name, _ in scope['headers'])):
+            await self.app(scope, receive, send)
+            return
+        key = scope['path'] + '?' + scope['query_string'].decode('latin-1')
+        stale = self._get(key) if BREAKER.is_open() else None
+        if stale is not None:
+            await self._send_stale(key, stale, send)
+            return
+
+        start: Optional[dict] = None
+        body: Optional[List[bytes]] = []
+        size = 0
+
+        async def send_wrapper(message):
+            nonlocal start, body, size, stale
+            if message['type'] == 'http.response.start':
+                stale = self._get(key) if message['status'] == 503 else None
+                if stale is not None:
+                    # Hold the 503 back, the stale response is sent instead.
+                    return
+                start = message
+                if message['status'] != 200:
+                    body = None
+            elif stale is not None:
+                return
+            elif body is not None:
+                body.append(message.get('body', b''))
+                size += len(body[-1])
+                if size > self.max_body_bytes:
+                    body = None
+                elif not message.get('more_body', False):
+                    self._put(key, start, b''.join(body))
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+        if stale is not None:
+            await self._send_stale(key, stale, send)
+
+    def _cached(self, path: str) -> bool:
+        """Tell whether the responses to a path are cached."""
+        return any(path == prefix or path.startswith(prefix + '/') for prefix in self.prefixes)
+
+    def _get(self, key: str) -> Optional[Tuple[float, int, List, bytes]]:
+        """Get a cached response if it isn't too old."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > self.max_age_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def _put(self, key: str, start: dict, body: bytes):
+        """Cache a response, evicting the least recently used one if full."""
+        with self._lock:
+            self._entries[key] = (time.monotonic(), start['status'], start['headers'], body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    async def _send_stale(self, key: str, entry: Tuple[float, int, List, bytes], send):
+        """Send a cached response."""
+        cached_at, status, headers, body = entry
+        LOGGER.info('Serving stale response for <%s>.', key)
+        headers = [(name, value) for name, value in headers
+                   if name.lower() not in (b'age', b'warning')]
+        headers += [
+            (b'age', str(int(time.monotonic() - cached_at)).encode('latin-1')),
+            (b'warning', b'110 - "Response is Stale"'),
+        ]
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
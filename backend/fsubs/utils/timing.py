@@ -0,0 +1,262 @@
+"""Per-request timing of database calls, authentication and serialization."""
+import functools
+import inspect
+import logging
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterable, Optional
+
+from fastapi.routing import APIRoute
+
+LOGGER = logging.getLogger(__name__)
+
+_REQUEST_STATS: ContextVar[Optional['RequestStats']] = ContextVar('request_stats', default=None)
+# How deeply storage engine calls are nested in the current task.
+_QUERY_DEPTH: ContextVar[int] = ContextVar('query_depth', default=0)
+
+_QUERY_COUNT = re.compile(r'(?:^|,)\s*db;[^,]*desc="(\d+) quer')
+
+
+class RequestStats():
+    """The number of database round trips made while handling a request and where the time went."""
+
+    def __init__(self):
+        """Initialize a ``RequestStats``."""
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.phases: Dict[str, float] = {'db': 0.0, 'auth': 0.0}
+        self.endpoint_done: Optional[float] = None
+
+    @contextmanager
+    def track(self, phase: str):
+        """
+        Add the time spent in the block to a phase.
+
+        :param phase: The name of the phase (e.g. ``auth``).
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[phase] = self.phases.get(phase, 0.0) + time.perf_counter() - start
+
+    def server_timing(self) -> str:
+        """
+        Build the value of the ``Server-Timing`` header.
+
+        :returns: The header value with durations in milliseconds.
+        """
+        now = time.perf_counter()
+        phases = dict(self.phases)
+        if self.endpoint_done is not None:
+            phases['serialize'] = now - self.endpoint_done
+        phases['total'] = now - self.start
+        entries = []
+        for phase, seconds in phases.items():
+            entry = f'{phase};dur={seconds * 1000:.1f}'
+            if phase == 'db':
+                entry += f';desc="{self.queries} queries"'
+            entries.append(entry)
+        return ', '.join(entries)
+
+
+def current() -> Optional[RequestStats]:
+    """
+    Get the stats of the request being handled.
+
+    :returns: The stats, or ``None`` outside of a request.
+    """
+    return _REQUEST_STATS.get()
+
+
+@contextmanager
+def track(phase: str):
+    """
+    Add the time spent in the block to a phase of the current request, if there is one.
+
+    :param phase: The name of the phase (e.g. ``auth``).
+    """
+    stats = current()
+    if stats is None:
+        yield
+        return
+    with stats.track(phase):
+        yield
+
+
+@contextmanager
+def query():
+    """
+    Count and time a database round trip against the current request.
+
+    Storage engine methods calling each other only count once.
+    """
+    stats = current()
+    if stats is None or _QUERY_DEPTH.get():
+        yield
+        return
+    token = _QUERY_DEPTH.set(1)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _QUERY_DEPTH.reset(token)
+        stats.queries += 1
+        stats.phases['db'] += time.perf_counter() - start
+
+
+def timed_queries(exclude: Iterable[str] = ()):
+    """
+    Build a class decorator counting every public method of a storage engine as a round trip.
+
+    Each storage engine method is a single query (or a single bulk write), so this counts the
+    round trips a request makes to the database, whichever DAO methods made them.
+
+    :param exclude: The public methods that don't query the database (e.g. saving a snapshot).
+    :returns: The class decorator.
+    """
+    def decorate(cls):
+        for name, method in list(vars(cls).items()):
+            if name.startswith('_') or name in exclude or not inspect.isfunction(method):
+                continue
+            setattr(cls, name, _timed_query(method))
+        return cls
+    return decorate
+
+
+def _timed_query(method):
+    """Wrap a storage engine method to count and time it as a round trip."""
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        with query():
+            return method(*args, **kwargs)
+    return wrapper
+
+
+class TimedRoute(APIRoute):
+    """An ``APIRoute`` noting when the endpoint returns, so serialization can be timed."""
+
+    def __init__(self, *args, **kwargs):
+        """Initialize a ``TimedRoute``."""
+        super().__init__(*args, **kwargs)
+        call = self.dependant.call
+
+        @functools.wraps(call)
+        async def timed_call(*args, **kwargs):
+            try:
+                return await call(*args, **kwargs)
+            finally:
+                stats = current()
+                if stats is not None:
+                    stats.endpoint_done = time.perf_counter()
+        self.dependant.call = timed_call
+
+
+class ServerTimingMiddleware():
+    """
+    ASGI middleware adding a ``Server-Timing`` header to every response.
+
+    A warning is logged for requests making more database round trips or spending more time in
+    them than the given budgets allow.
+    """
+
+    def __init__(self, app, max_queries: int = 0, max_db_ms: float = 0):
+        """
+        Initialize a ``ServerTimingMiddleware``.
+
+        :param app: The ASGI app to wrap.
+        :param max_queries: The number of database round trips a request may make. ``0`` disables
+        the check.
+        :param max_db_ms: The time a request may spend in database round trips in milliseconds.
+        ``0`` disables the check.
+        """
+        self.app = app
+        self.max_queries = max_queries
+        self.max_db_ms = max_db_ms
+
+    async def __call__(self, scope, receive, send):
+        """Handle an ASGI call."""
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats()
+        token = _REQUEST_STATS.set(stats)
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                headers = list(message.get('headers', []))
+                headers.append((b'server-timing', stats.server_timing().encode('latin-1')))
+                message = {**message, 'headers': headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _REQUEST_STATS.reset(token)
+            self._check_budget(scope, stats)
+
+    def _check_budget(self, scope, stats: RequestStats):
+        """Log a warning if the request went over budget."""
+        db_ms = stats.phases['db'] * 1000
+        over_queries = self.max_queries and stats.queries > self.max_queries
+        over_db_ms = self.max_db_ms and db_ms > self.max_db_ms
+        if over_queries or over_db_ms:
+            LOGGER.warning('Request <%s %s> went over budget with %s queries taking %.1fms '
+                           '(budget: %s queries, %sms).',
+                           scope["method"], scope["path"], stats.queries, db_ms, self.max_queries,
+                           self.max_db_ms)
+
+
+@contextmanager
+def count_queries():
+    """
+    Count the database round trips made in the block, for use in tests.
+
+    Example::
+
+        with count_queries() as stats:
+            await MOVIE_DAO.read(movie_id)
+        assert stats.queries == 1
+
+    :returns: The ``RequestStats`` collecting the round trips.
+    """
+    stats = RequestStats()
+    token = _REQUEST_STATS.set(stats)
+    try:
+        yield stats
+    finally:
+        _REQUEST_STATS.reset(token)
+
+
+def query_count(response) -> int:
+    """
+    Get the number of database round trips a response reported in its ``Server-Timing`` header.
+
+    :param response: The response (e.g. from the FastAPI ``TestClient``).
+    :returns: The number of round trips.
+    :raises AssertionError: If the header has no ``db`` entry.
+    """
+    match = _QUERY_COUNT.search(response.headers.get('server-timing', ''))
+    assert match, 'Response has no db entry in its Server-Timing header.'
+    return int(match.group(1))
+
+
+def assert_query_count(response, expected: int):
+    """
+    Assert that an endpoint made exactly the expected number of database round trips.
+
+    Pinning the exact number catches both N+1 patterns and queries silently going missing.
+
+    Example::
+
+        response = client.put(f'/movies/versions/{uri}', json=version, headers=headers)
+        assert_query_count(response, 4)
+
+    :param response: The response (e.g. from the FastAPI ``TestClient``).
+    :param expected: The number of round trips.
+    :raises AssertionError: If the endpoint made another number of round trips.
+    """
+    count = query_count(response)
+    assert count == expected, f'Expected {expected} queries, got {count}.'
@@ -0,0 +1,123 @@
+"""Remember verified access tokens, so a token's signature is only checked once per worker."""
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple, Union
+
+from fsubs.utils.metrics import REGISTRY
+
+LOGGER = logging.getLogger(__name__)
+
+TOKEN_CACHE_LOOKUPS = REGISTRY.counter(
+    'fsubs_token_cache_lookups_total', 'Verified token cache lookups, by result (hit or miss).',
+    ('result',))
+TOKEN_CACHE_SIZE = REGISTRY.gauge(
+    'fsubs_token_cache_entries', 'Verified tokens kept in the cache.')
+
+
+def token_digest(token: Union[str, bytes]) -> bytes:
+    """
+    Get the key a token is cached by.
+
+    :param token: The encoded token.
+    :returns: A short digest of the token.
+    """
+    if isinstance(token, str):
+        token = token.encode('latin-1', 'replace')
+    return hashlib.blake2b(token, digest_size=16).digest()
+
+
+class VerifiedTokenCache():
+    """
+    A bounded LRU cache of the claims of tokens whose signature was verified.
+
+    Claims are kept until the ``exp`` of their token, so an expired token is verified again (and
+    rejected). Revoking tokens must invalidate them here, see ``invalidate``.
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        """
+        Initialize a ``VerifiedTokenCache``.
+
+        :param max_entries: The number of tokens to keep, least recently used first out. ``0``
+        disables the cache.
+        """
+        self.max_entries = max_entries
+        # The claims of each token and when they stop being valid, by token digest.
+        self._entries: 'OrderedDict[bytes, Tuple[dict, float]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure_from_config(self, config):
+        """
+        Set the size of the cache from the ``[app]`` section of the config.
+
+        :param config: The ``Config``.
+        """
+        self.max_entries = config["app"].getint("token_cache_size")
+        self.clear()
+
+    def get(self, digest: bytes) -> Optional[dict]:
+        """
+        Get the claims of a verified token.
+
+        :param digest: The digest of the token.
+        :returns: A copy of the claims, or ``None`` if the token isn't cached or has expired.
+        """
+        if not self.max_entries:
+            return None
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                if entry[1] > time.time():
+                    self._entries.move_to_end(digest)
+                else:
+                    del self._entries[digest]
+                    entry = None
+        TOKEN_CACHE_LOOKUPS.inc(result='hit' if entry is not None else 'miss')
+        return dict(entry[0]) if entry is not None else None
+
+    def put(self, digest: bytes, claims: dict):
+        """
+        Remember the claims of a verified token.
+
+        :param digest: The digest of the token.
+        :param claims: The claims of the token.
+        """
+        if not self.max_entries:
+            return
+        expires = claims.get('exp')
+        expires = float(expires) if isinstance(expires, (int, float)) else float('inf')
+        with self._lock:
+            self._entries[digest] = (dict(claims), expires)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            TOKEN_CACHE_SIZE.set(len(self._entries))
+
+    def invalidate(self, predicate: Callable[[dict], bool]) -> int:
+        """
+        Forget the tokens whose claims match a predicate, e.g. the revoked ones.
+
+        :param predicate: Called with the claims of each cached token.
+        :returns: The number of tokens forgotten.
+        """
+        with self._lock:
+            digests = [
+                digest for digest, (claims, _) in self._entries.items() if predicate(claims)]
+            for digest in digests:
+                del self._entries[digest]
+            TOKEN_CACHE_SIZE.set(len(self._entries))
+        if digests:
+            LOGGER.debug('Invalidated %s cached tokens.', len(digests))
+        return len(digests)
+
+    def clear(self):
+        """Forget every token, e.g. after the verification keys changed."""
+        with self._lock:
+            self._entries.clear()
+            TOKEN_CACHE_SIZE.set(0)
+
+
+TOKEN_CACHE = VerifiedTokenCache()
@@ -1,53 +1,178 @@
 """Utility functions for users."""
+import base64
 import binascii
 import hashlib
+import hmac
 import logging
 import os
-from typing import Tuple
+import time
+from typing import Dict, Optional, Tuple
 
 from fastapi import HTTPException
 
+from fsubs.config.config import Config
 from fsubs.models.user import Access
 
 LOGGER = logging.getLogger(__name__)
+CONFIG = Config()
 
 
-def hash_password(password: str) -> Tuple[str, str]:
+# PBKDF2 hashes stored before hashes described themselves.
+LEGACY_PBKDF2_ITERATIONS = 100000
+KDF_ALGORITHMS = ('pbkdf2-sha256', 'scrypt')
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+
+def _b64encode(data: bytes) -> str:
+    """Encode bytes in unpadded base64, as in the PHC string format."""
+    return base64.b64encode(data).decode('ascii').rstrip('=')
+
+
+def _b64decode(data: str) -> bytes:
+    """Decode unpadded base64."""
+    return base64.b64decode(data + '=' * (-len(data) % 4))
+
+
+def kdf_params(config=None) -> Tuple[str, Dict[str, int]]:
+    """
+    Get the KDF new password hashes are made with, from the ``[kdf]`` section of the config.
+
+    :param config: The ``Config``, the global one by default.
+    :returns: The algorithm and its cost parameters.
+    """
+    section = (config or CONFIG)["kdf"]
+    algorithm = section["algorithm"]
+    if algorithm == 'scrypt':
+        return algorithm, {
+            'n': section.getint("scrypt_n"),
+            'r': section.getint("scrypt_r"),
+            'p': section.getint("scrypt_p"),
+        }
+    if algorithm == 'pbkdf2-sha256':
+        return algorithm, {'i': section.getint("pbkdf2_iterations")}
+    raise ValueError(f'Unknown kdf algorithm {algorithm}, expected one of {KDF_ALGORITHMS}.')
+
+
+def _derive(algorithm: str, params: Dict[str, int], password: str, salt: bytes) -> bytes:
+    """Derive a key from a password."""
+    if algorithm == 'scrypt':
+        # hashlib refuses to use more than 32MiB by default, allow what the params need.
+        maxmem = 128 * params['r'] * (params['n'] + params['p'] + 2) + 1024 * 1024
+        return hashlib.scrypt(
+            password.encode('utf-8'), salt=salt, n=params['n'], r=params['r'], p=params['p'],
+            maxmem=maxmem, dklen=KEY_BYTES)
+    return hashlib.pbkdf2_hmac(
+        'sha256', password.encode('utf-8'), salt, params['i'], dklen=KEY_BYTES)
+
+
+def hash_password(password: str, algorithm: str = None, params: Dict[str, int] = None) -> str:
     """
     Salt and hash the given password.
 
+    The hash describes itself: ``$<algorithm>$<params>$<salt>$<key>``, e.g.
+    ``$pbkdf2-sha256$i=100000$<salt>$<key>`` or ``$scrypt$n=16384,r=8,p=1$<salt>$<key>``, with the
+    salt and key in base64. It can be verified without a separate salt.
+
     :param password: The password to salt and hash.
-    :returns: A tuple of the salt and hashed password both encoded in ascii.
+    :param algorithm: The KDF to use, the one of the config by default.
+    :param params: The cost parameters of the KDF, the ones of the config by default.
+    :returns: The hash.
     """
     LOGGER.debug('Hashing password with password...ha you wish.')
-    salt = os.urandom(32)
-    salt_ascii = binascii.hexlify(salt).decode().encode('ascii')
-    key = hashlib.pbkdf2_hmac(
-        'sha256',
-        password.encode('utf-8'),
-        salt_ascii,
-        100000,
-    )
-    return salt_ascii.decode(), binascii.hexlify(key).decode()
-
-
-def verify_password(password: str, salt: str, key: str) -> bool:
+    if algorithm is None:
+        algorithm, params = kdf_params()
+    salt = os.urandom(SALT_BYTES)
+    key = _derive(algorithm, params, password, salt)
+    encoded_params = ','.join(f'{name}={value}' for name, value in params.items())
+    return f'${algorithm}${encoded_params}${_b64encode(salt)}${_b64encode(key)}'
+
+
+def _parse_hash(hashed_password: str) -> Tuple[str, Dict[str, int], bytes, bytes]:
     """
-    Verify the given password against the given salt and key.
+    Split a self describing hash into its algorithm, cost parameters, salt and key.
+
+    :raises ValueError: If the hash is malformed or its algorithm unknown.
+    """
+    _, algorithm, encoded_params, salt, key = hashed_password.split('$')
+    if algorithm not in KDF_ALGORITHMS:
+        raise ValueError(f'Unknown kdf algorithm {algorithm}.')
+    params = {
+        name: int(value)
+        for name, value in (param.split('=') for param in encoded_params.split(','))
+    }
+    return algorithm, params, _b64decode(salt), _b64decode(key)
+
+
+def verify_password(password: str, hashed_password: str, salt: str = None) -> Optional[bool]:
+    """
+    Verify the given password against the given hash.
 
     :param password: The password to check.
-    :param salt: The salt to use. Should be encoded in ascii.
-    :param key: The key to use. Should be encoded in ascii.
-    :returns: True if given a valid password, False otherwise.
+    :param hashed_password: The hash to check against, from ``hash_password``. Hashes made before
+    hashes described themselves are hex encoded, and have a separate salt.
+    :param salt: The salt of a hex encoded hash. Should be encoded in ascii.
+    :returns: True if given a valid password, False otherwise, or None if the hash can't be read.
     """
     LOGGER.debug("Verifying password.")
-    new_key = hashlib.pbkdf2_hmac(
-        'sha256',
-        password.encode('utf-8'),
-        salt.encode('ascii'),
-        100000
-    )
-    return binascii.hexlify(new_key).decode() == key
+    try:
+        if not hashed_password.startswith('$'):
+            key = binascii.unhexlify(hashed_password)
+            new_key = hashlib.pbkdf2_hmac(
+                'sha256', password.encode('utf-8'), salt.encode('ascii'),
+                LEGACY_PBKDF2_ITERATIONS)
+        else:
+            algorithm, params, salt_bytes, key = _parse_hash(hashed_password)
+            new_key = _derive(algorithm, params, password, salt_bytes)
+    except (ValueError, TypeError, AttributeError, binascii.Error) as e:
+        LOGGER.error('Unable to read password hash: %s', e)
+        return None
+    return hmac.compare_digest(new_key, key)
+
+
+def needs_rehash(hashed_password: str) -> bool:
+    """
+    Check whether a hash was made with another KDF or cost than the config asks for.
+
+    :param hashed_password: The hash to check.
+    :returns: True if the password should be hashed again.
+    """
+    if not hashed_password.startswith('$'):
+        return True
+    try:
+        algorithm, params, _, _ = _parse_hash(hashed_password)
+    except ValueError:
+        return True
+    return (algorithm, params) != kdf_params()
+
+
+def calibrate_kdf(algorithm: str, target_ms: float) -> Tuple[Dict[str, int], float]:
+    """
+    Find the cost of a KDF taking about the given time to hash a password on this host.
+
+    :param algorithm: The KDF to calibrate.
+    :param target_ms: How long hashing a password should take, in milliseconds.
+    :returns: The cost parameters and how long they took to hash a password, in milliseconds.
+    """
+    def time_ms(params: Dict[str, int]) -> float:
+        salt = os.urandom(SALT_BYTES)
+        start = time.perf_counter()
+        _derive(algorithm, params, 'calibrate', salt)
+        return (time.perf_counter() - start) * 1000
+
+    if algorithm == 'scrypt':
+        # Memory grows with n, so only n is raised, keeping the usual r and p.
+        params = {'n': 2 ** 10, 'r': 8, 'p': 1}
+        elapsed = time_ms(params)
+        while elapsed < target_ms and params['n'] < 2 ** 20:
+            params['n'] *= 2
+            elapsed = time_ms(params)
+        return params, elapsed
+    # PBKDF2 costs grow linearly with the number of iterations.
+    elapsed = min(time_ms({'i': 10000}) for _ in range(3))
+    iterations = max(1000, int(10000 * target_ms / elapsed) // 1000 * 1000)
+    params = {'i': iterations}
+    return params, time_ms(params)
 
 
 async def check_access(
@@ -66,7 +191,7 @@ async def check_access(
     :param level: The access level required.
     :raises HTTPException: If no user was supplied or if the user doesn't have the required access.
     """
-    LOGGER.info(f'Checking {username} has at least {level} access.')
+    LOGGER.info('Checking %s has at least %s access.', username, level)
     if not user:
         raise HTTPException(
             status_code=500,
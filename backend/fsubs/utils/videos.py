@@ -0,0 +1,63 @@
+"""Utility functions for videos."""
+import logging
+import re
+from typing import Dict, List, Union
+
+LOGGER = logging.getLogger(__name__)
+
+TIMESTAMP_RANGE = re.compile(r'^\s*(?P<start>[0-9:.,]+)\s*(?:-->|-)\s*(?P<end>[0-9:.,]+)\s*$')
+
+
+def parse_timestamp(timestamp: str) -> float:
+    """
+    Parse a single timestamp into seconds.
+
+    Accepts ``SS``, ``MM:SS`` or ``HH:MM:SS`` with optional fractional seconds separated by
+    either a ``.`` or a ``,`` (e.g. ``01:02:03.500`` or ``01:02:03,500``).
+
+    :param timestamp: The timestamp to parse.
+    :returns: The number of seconds the timestamp represents.
+    :raises ValueError: If the timestamp cannot be parsed.
+    """
+    parts = timestamp.strip().replace(',', '.').split(':')
+    if len(parts) > 3:
+        raise ValueError(f'Invalid timestamp: {timestamp}.')
+    seconds = 0.0
+    for part in parts:
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def cue_duration(cue: str) -> float:
+    """
+    Get the duration of a single subtitle cue.
+
+    A cue with a duration is a range of the form ``start - end`` or ``start --> end``. Any other
+    cue (e.g. a single timestamp) is counted as having no duration.
+
+    :param cue: The cue to get the duration of.
+    :returns: The duration of the cue in seconds.
+    """
+    match = TIMESTAMP_RANGE.match(cue)
+    if not match:
+        return 0.0
+    try:
+        duration = parse_timestamp(match['end']) - parse_timestamp(match['start'])
+    except ValueError:
+        LOGGER.debug('Unable to parse cue: <%s>.', cue)
+        return 0.0
+    return max(duration, 0.0)
+
+
+def version_stats(timestamps: List[str]) -> Dict[str, Union[int, float]]:
+    """
+    Compute the subtitle statistics of a video version.
+
+    :param timestamps: The timestamps of the video version.
+    :returns: A dict with the ``cue_count`` and ``subs_duration`` (in seconds) of the version.
+    """
+    timestamps = timestamps or []
+    return {
+        'cue_count': len(timestamps),
+        'subs_duration': round(sum(cue_duration(cue) for cue in timestamps), 3),
+    }
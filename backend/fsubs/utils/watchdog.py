@@ -0,0 +1,154 @@
+"""Detect blocking calls on the event loop and aggregate them by call site."""
+import asyncio
+import logging
+import pathlib
+import random
+import sys
+import threading
+import time
+import traceback
+from typing import Any, Dict, List, Optional
+
+from fsubs.utils.metrics import REGISTRY
+
+LOGGER = logging.getLogger(__name__)
+
+PACKAGE_DIR = str(pathlib.Path(__file__).parent.parent.absolute())
+
+LOOP_BLOCKED = REGISTRY.counter(
+    'fsubs_event_loop_blocked_total', 'Times the event loop was blocked, by call site.', ('site',))
+LOOP_BLOCKED_DURATION = REGISTRY.histogram(
+    'fsubs_event_loop_blocked_seconds', 'How long the event loop was blocked.')
+
+
+def _call_site(frame) -> str:
+    """
+    Get the innermost fsubs frame of a stack, which is most likely the code that is blocking.
+
+    Falls back to the innermost frame if no fsubs code is on the stack.
+    """
+    innermost = frame
+    while frame is not None:
+        if frame.f_code.co_filename.startswith(PACKAGE_DIR):
+            break
+        frame = frame.f_back
+    frame = frame or innermost
+    filename = frame.f_code.co_filename
+    if filename.startswith(PACKAGE_DIR):
+        filename = 'fsubs' + filename[len(PACKAGE_DIR):]
+    return f'{filename}:{frame.f_lineno} in {frame.f_code.co_name}'
+
+
+class BlockingWatchdog():
+    """
+    Watch the event loop for blocking calls.
+
+    A heartbeat coroutine wakes up every quarter of the threshold. A watchdog thread checks that
+    the heartbeat keeps up and, when it doesn't, samples the stack of the event loop thread to find
+    what is blocking it. Stalls are aggregated by call site.
+    """
+
+    def __init__(self, max_sites: int = 100):
+        """
+        Initialize a ``BlockingWatchdog``.
+
+        :param max_sites: The maximum number of call sites to keep.
+        """
+        self.threshold = 0.0
+        self.interval = 0.0
+        self.sample_rate = 1.0
+        self.max_sites = max_sites
+        self._sites: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._beat = time.monotonic()
+        self._pending_site: Optional[str] = None
+        self._loop_thread: Optional[int] = None
+        self._stop = threading.Event()
+
+    def start(self, threshold_ms: float, sample_rate: float = 1.0):
+        """
+        Start the heartbeat and watchdog thread. Must be called from the event loop.
+
+        :param threshold_ms: How long the loop may be blocked before it is reported.
+        :param sample_rate: The fraction of stalls to capture the stack of.
+        """
+        self.threshold = threshold_ms / 1000
+        self.interval = self.threshold / 4
+        self.sample_rate = sample_rate
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        asyncio.ensure_future(self._heartbeat())
+        threading.Thread(target=self._watch, name='loop-watchdog', daemon=True).start()
+        LOGGER.info('Watching for event loop blocked over %sms.', self.threshold * 1000)
+
+    def stop(self):
+        """Stop the watchdog thread."""
+        self._stop.set()
+
+    def offenders(self) -> List[Dict[str, Any]]:
+        """
+        Get the call sites that blocked the event loop.
+
+        :returns: The call sites, the one that blocked the loop the longest in total first.
+        """
+        with self._lock:
+            sites = [dict(site) for site in self._sites.values()]
+        return sorted(sites, key=lambda site: site['total_ms'], reverse=True)
+
+    def clear(self):
+        """Forget every call site."""
+        with self._lock:
+            self._sites.clear()
+
+    async def _heartbeat(self):
+        """Beat every interval and record how long the loop was blocked when late."""
+        while not self._stop.is_set():
+            last = time.monotonic()
+            self._beat = last
+            await asyncio.sleep(self.interval)
+            blocked = time.monotonic() - last - self.interval
+            if blocked > self.threshold:
+                self._record(blocked)
+
+    def _watch(self):
+        """Sample the stack of the event loop thread whenever the heartbeat is late."""
+        sampled_beat = None
+        while not self._stop.wait(self.interval):
+            beat = self._beat
+            if beat == sampled_beat or time.monotonic() - beat - self.interval <= self.threshold:
+                continue
+            # Only sample once per stall.
+            sampled_beat = beat
+            if random.random() >= self.sample_rate:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            site = _call_site(frame)
+            with self._lock:
+                if site not in self._sites and len(self._sites) < self.max_sites:
+                    self._sites[site] = {
+                        'site': site,
+                        'count': 0,
+                        'total_ms': 0.0,
+                        'max_ms': 0.0,
+                        'stack': traceback.format_stack(frame),
+                    }
+                self._pending_site = site
+
+    def _record(self, blocked: float):
+        """Attribute a stall to the call site sampled while it was happening."""
+        LOOP_BLOCKED_DURATION.observe(blocked)
+        with self._lock:
+            site, self._pending_site = self._pending_site, None
+            entry = self._sites.get(site)
+            if entry is not None:
+                entry['count'] += 1
+                entry['total_ms'] += blocked * 1000
+                entry['max_ms'] = max(entry['max_ms'], blocked * 1000)
+        if site is not None:
+            LOOP_BLOCKED.inc(site=site)
+            LOGGER.warning('Event loop was blocked for %.1fms at: <%s>.', blocked * 1000, site)
+
+
+WATCHDOG = BlockingWatchdog()
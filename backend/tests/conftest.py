@@ -0,0 +1,68 @@
+"""Fixtures shared by the tests, which run against the memory storage engine."""
+
+import asyncio
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from fsubs.config.config import Config
+from fsubs.crud.db import get_engine
+from fsubs.crud.memory import MemoryEngine
+from fsubs.models.user import Access
+from fsubs.routers.main import create_app
+
+PASSWORD = 'password123'
+
+config = Config()
+config.read_dict({
+    'db': {'engine': 'memory'},
+    # Cheap hashes, the tests aren't about the KDF cost.
+    'kdf': {'pbkdf2_iterations': '1000'},
+    'ratelimit': {f'{name}_rate': '0' for name in ('auth', 'list', 'read', 'write')},
+})
+
+
+@pytest.fixture
+def engine() -> MemoryEngine:
+    """Get an empty memory engine."""
+    return MemoryEngine()
+
+
+@pytest.fixture
+def loop():
+    """Set a new current event loop, which the TestClient runs the app on."""
+    # asyncio.run() in earlier tests leaves no current event loop.
+    new_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(new_loop)
+    yield new_loop
+    new_loop.close()
+
+
+@pytest.fixture
+def client(loop):
+    """Get a client of an app whose shared engine is a new, empty memory engine."""
+    get_engine()._engine = MemoryEngine()
+    with TestClient(create_app(config)) as test_client:
+        deadline = time.monotonic() + 5
+        while test_client.get('/ready').status_code != 200:
+            assert time.monotonic() < deadline, 'The app never got ready.'
+            time.sleep(0.01)
+        yield test_client
+
+
+@pytest.fixture
+def login(client):
+    """Get a function creating a user and logging in as them, returning the headers to send."""
+    def login_as(username: str, access: Access = Access.basic) -> dict:
+        response = client.post(
+            '/users', json={'username': username, 'email': f'{username}@example.com',
+                            'password': PASSWORD})
+        assert response.status_code == 201, response.text
+        if access != Access.basic:
+            get_engine().update('users', response.json(), {'access': access.value})
+        response = client.post(
+            '/authenticate', data={'username': username, 'password': PASSWORD})
+        assert response.status_code == 201, response.text
+        return {'Authorization': f'Bearer {response.json()["access_token"]}'}
+    return login_as
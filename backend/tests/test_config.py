@@ -0,0 +1,66 @@
+"""Tests of passing the config on to worker processes."""
+
+import json
+import os
+import pathlib
+import subprocess
+import sys
+
+from fsubs.config.config import RESOLVED_CONFIG_VAR
+
+BACKEND_DIR = pathlib.Path(__file__).parent.parent.absolute()
+
+EXPORT = '''
+import os
+from fsubs.config.config import RESOLVED_CONFIG_VAR, Config, get_env_vars
+config = Config()
+config.read({cfg!r})
+config.read_dict(get_env_vars())
+config.read_dict({{"app": {{"workers": "3", "jwt_secret": "from_cli"}}}})
+config.export()
+print(os.environ[RESOLVED_CONFIG_VAR])
+'''
+
+WORKER = '''
+import json
+from fsubs.config.config import Config
+config = Config()
+print(json.dumps([config[section][key] for section, key in (
+    ("app", "workers"), ("app", "jwt_algorithm"), ("app", "jwt_secret"), ("db", "password"))]))
+'''
+
+
+def run_python(code: str, **env) -> str:
+    """Run Python code in a new process, with only the given ``FSUBS`` variables set."""
+    environ = {name: value for name, value in os.environ.items() if not name.startswith('FSUBS')}
+    return subprocess.run(
+        [sys.executable, '-c', code], cwd=BACKEND_DIR, env={**environ, **env}, check=True,
+        stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+
+def test_export_leaves_the_secrets_out(tmp_path):
+    """Workers get the secrets from the config files and environment, not the exported config."""
+    cfg = tmp_path / 'fsubs.ini'
+    cfg.write_text('[app]\njwt_algorithm: HS512\n\n[db]\npassword: from_file\n')
+
+    exported = run_python(EXPORT.format(cfg=str(cfg)), FSUBS_DB_PASSWORD='from_env')
+
+    assert 'from_' not in exported
+    assert json.loads(exported)['files'] == [str(cfg)]
+    # Secrets set in the environment win over the config files, like in the parent.
+    assert json.loads(run_python(
+        WORKER, FSUBS_DB_PASSWORD='from_env', **{RESOLVED_CONFIG_VAR: exported})) == [
+            '3', 'HS512', 'this_is_a_fake_secret', 'from_env']
+    assert json.loads(run_python(WORKER, **{RESOLVED_CONFIG_VAR: exported}))[-1] == 'from_file'
+
+
+def test_secrets_on_the_command_line_are_refused_with_workers():
+    """Several workers couldn't get a secret set through a CLI arg, so the CLI refuses it."""
+    environ = {name: value for name, value in os.environ.items() if not name.startswith('FSUBS')}
+    result = subprocess.run(
+        [sys.executable, '-m', 'fsubs', '--workers', '2', '--jwt-secret', 'from_cli'],
+        cwd=BACKEND_DIR, env=environ, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        universal_newlines=True, timeout=60)
+
+    assert result.returncode == 2
+    assert '--jwt-secret would not reach the worker processes' in result.stdout
@@ -0,0 +1,16 @@
+"""Tests of the database client helpers."""
+
+from pymongo import monitoring
+
+from fsubs.crud.db import client_settings
+from fsubs.utils.metrics import POOL_LISTENER
+from fsubs.utils.slow_queries import SLOW_QUERIES
+
+
+def test_only_fsubs_clients_are_monitored():
+    """The listeners are passed to fsubs' clients, importing fsubs registers none globally."""
+    assert client_settings()['event_listeners'] == [POOL_LISTENER, SLOW_QUERIES]
+    # pymongo has no public way to read the global listeners.
+    listeners = monitoring._LISTENERS
+    assert not listeners.command_listeners
+    assert not listeners.cmap_listeners
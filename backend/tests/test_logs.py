@@ -0,0 +1,41 @@
+"""Tests of keeping secrets out of the logs."""
+
+import logging
+
+import pytest
+
+from fsubs.utils.logs import RedactingFilter
+
+
+def redacted(msg: str, *args) -> str:
+    """Get a message as the ``RedactingFilter`` lets it through."""
+    record = logging.LogRecord('fsubs', logging.INFO, __file__, 1, msg, args, None)
+    assert RedactingFilter().filter(record)
+    return record.getMessage()
+
+
+@pytest.mark.parametrize('msg, args, expected', [
+    ("Creating user %s", ({'username': 'joe', 'password': 'hunter2'},),
+     "Creating user {'username': 'joe', 'password': '***'}"),
+    ('Stored %s', ({'hashed_password': b'abc', 'salt': 'def'},),
+     "Stored {'hashed_password': '***', 'salt': '***'}"),
+    ('Token: %s', ({'access_token': 'eyJ0.eyJp.c2ln', 'token_type': 'bearer'},),
+     "Token: {'access_token': '***', 'token_type': 'bearer'}"),
+    ('Headers: %s', ({'Authorization': 'Bearer eyJ0.eyJp.c2ln'},),
+     "Headers: {'Authorization': 'Bearer ***'}"),
+    ('Got Authorization: Bearer %s from %s', ('eyJ0.eyJp.c2ln', 'joe'),
+     'Got Authorization: Bearer *** from joe'),
+])
+def test_redacts_secrets(msg, args, expected):
+    """Passwords, hashes, salts and access tokens are replaced by ``***``."""
+    assert redacted(msg, *args) == expected
+
+
+def test_login_doesnt_log_the_token(client, login, caplog):
+    """Logging in doesn't log the access token, even at debug level."""
+    with caplog.at_level(logging.DEBUG, logger='fsubs'):
+        headers = login('joe')
+
+    token = headers['Authorization'].split()[-1]
+    assert 'Generated access token for joe.' in caplog.messages
+    assert not any(token in message for message in caplog.messages)
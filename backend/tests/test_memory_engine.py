@@ -0,0 +1,228 @@
+"""Tests of the memory storage engine against the Mongo semantics the DAOs rely on."""
+
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+from fsubs.crud.memory import MemoryEngine
+from fsubs.crud.mirror import MirrorSnapshot, build_mirror
+
+
+def titles(documents) -> list:
+    """Get the titles of documents."""
+    return [document.get('title') for document in documents]
+
+
+def test_get_by_either_kind_of_id(engine):
+    """Documents are read by ``ObjectId`` or its string, and projected like Mongo does."""
+    movie_id = engine.insert('movies', {'title': 'Alien', 'imdb_id': 'tt0078748'})
+
+    assert isinstance(movie_id, ObjectId)
+    assert engine.get('movies', str(movie_id)) == engine.get('movies', movie_id)
+    assert engine.get('movies', movie_id, projection={'title': True}) == {
+        '_id': movie_id, 'title': 'Alien'}
+    assert engine.get('movies', movie_id, projection={'title': True, '_id': False}) == {
+        'title': 'Alien'}
+    assert engine.get('movies', ObjectId()) is None
+    assert titles(engine.get_many('movies', [str(movie_id), ObjectId(), movie_id])) == ['Alien']
+
+
+def test_documents_are_stored_like_mongo_stores_them(engine):
+    """Stored documents are copies, with naive UTC datetimes rounded to the millisecond."""
+    created = datetime(2020, 5, 1, 12, 0, 0, 123456, tzinfo=timezone(timedelta(hours=2)))
+    document = {'title': 'Alien', 'metadata': {'date_created': created}, 'tags': ('a', 'b')}
+    movie_id = engine.insert('movies', document)
+    document['title'] = 'Changed'
+    engine.get('movies', movie_id)['metadata']['date_created'] = None
+
+    stored = engine.get('movies', movie_id)
+    assert stored['title'] == 'Alien'
+    assert stored['metadata']['date_created'] == datetime(2020, 5, 1, 10, 0, 0, 123000)
+    assert stored['tags'] == ['a', 'b']
+
+
+def test_find_filters_sorts_and_pages(engine):
+    """``find`` filters on (dotted) fields, sorts like the title collation and pages."""
+    for title, no_subs, created_by in (
+            ('banana', False, 'joe'), ('Apple', True, 'ann'), (None, False, 'joe'),
+            ('cherry', False, 'ann')):
+        engine.insert('movies', {'title': title, 'no_subs': no_subs,
+                                 'metadata': {'created_by': created_by}})
+
+    assert titles(engine.find('movies')) == ['banana', 'Apple', None, 'cherry']
+    # Case is ignored and missing values come first.
+    assert titles(engine.find('movies', sort_by='title')) == [None, 'Apple', 'banana', 'cherry']
+    assert titles(engine.find('movies', sort_by='title', descending=True, skip=1, limit=2)) == [
+        'banana', 'Apple']
+    assert titles(engine.find('movies', search={'no_subs': False, 'metadata.created_by': 'joe'},
+                              sort_by='title')) == [None, 'banana']
+    assert engine.find('movies', search={'no_subs': True}, projection={'title': True}) == [
+        {'_id': engine.find_one('movies', {'title': 'Apple'})['_id'], 'title': 'Apple'}]
+    assert engine.find('movies', search={'title': 'durian'}) == []
+
+
+def test_find_uses_the_indexes(engine):
+    """Searches on indexed fields only look at the matching documents."""
+    for imdb_id in ('tt1', 'tt2', 'tt3'):
+        engine.insert('movies', {'imdb_id': imdb_id, 'no_subs': False})
+
+    assert engine.find('movies', search={'imdb_id': 'tt2'}, explain=True) == {
+        'indexes': ['imdb_id'],
+        'winning_plan': {'stage': 'MEMORY_INDEX'},
+        'execution_stats': {'nReturned': 1, 'totalDocsExamined': 1},
+    }
+    explain = engine.find('movies', search={'no_subs': False}, explain=True)
+    assert explain['indexes'] == []
+    assert explain['execution_stats'] == {'nReturned': 3, 'totalDocsExamined': 3}
+
+
+def test_find_in_keeps_the_insertion_order(engine):
+    """``find_in`` reads the documents matching any value, in insertion order."""
+    movie_ids = [str(engine.insert('movies', {'title': str(number)})) for number in range(3)]
+    for movie_id in (movie_ids[2], movie_ids[0], movie_ids[1], movie_ids[2]):
+        engine.insert('movie_versions', {'video_base_id': movie_id})
+
+    found = engine.find_in('movie_versions', 'video_base_id', movie_ids[:1] + movie_ids[2:])
+
+    assert [version['video_base_id'] for version in found] == [
+        movie_ids[2], movie_ids[0], movie_ids[2]]
+
+
+def test_update_is_conditional_and_returns_either_side(engine):
+    """``update`` only writes if the search matches, returning the document before by default."""
+    version_id = engine.insert('movie_versions', {'video_base_id': 'a', 'disc_type': 'DVD'})
+
+    assert engine.update('movie_versions', version_id, {'disc_type': 'BD'},
+                         search={'video_base_id': 'b'}) is None
+    assert engine.get('movie_versions', version_id)['disc_type'] == 'DVD'
+    assert engine.update('movie_versions', version_id, {'disc_type': 'BD'})['disc_type'] == 'DVD'
+    assert engine.update('movie_versions', version_id, {'region': 'A'}, return_after=True,
+                         projection={'disc_type': True, 'region': True}) == {
+        '_id': version_id, 'disc_type': 'BD', 'region': 'A'}
+    # The indexes follow the update.
+    assert engine.find('movie_versions', search={'disc_type': 'DVD'}) == []
+    assert len(engine.find('movie_versions', search={'disc_type': 'BD'})) == 1
+    assert engine.update('movie_versions', ObjectId(), {'disc_type': 'BD'}) is None
+
+
+def test_increments(engine):
+    """Increments start missing fields at 0, and stats keep ``has_foreign_subs`` in sync."""
+    movie_id = engine.insert('movies', {'imdb_id': 'tt1', 'version_count': 1})
+
+    assert engine.increment('movies', {'imdb_id': 'tt1'}, {'version_count': 2, 'cue_count': 5},
+                            projection={'version_count': True, 'cue_count': True}) == {
+        '_id': movie_id, 'version_count': 3, 'cue_count': 5}
+    assert engine.increment('movies', {'imdb_id': 'tt2'}, {'version_count': 1}) is None
+    engine.increment_stats('movies', movie_id, {'foreign_subs_version_count': 1})
+    assert engine.get('movies', movie_id)['has_foreign_subs'] is True
+    engine.increment_stats('movies', str(movie_id), {'foreign_subs_version_count': -1})
+    assert engine.get('movies', movie_id)['has_foreign_subs'] is False
+
+
+def test_deletes(engine):
+    """Deletes return the deleted document, or the number of documents deleted."""
+    movie_id = engine.insert('movies', {'title': 'Alien'})
+    for disc_type in ('DVD', 'BD'):
+        engine.insert('movie_versions', {'video_base_id': str(movie_id), 'disc_type': disc_type})
+    engine.insert('movie_versions', {'video_base_id': 'other', 'disc_type': 'DVD'})
+
+    assert engine.delete('movies', str(movie_id), projection={'title': True}) == {
+        '_id': movie_id, 'title': 'Alien'}
+    assert engine.delete('movies', movie_id) is None
+    assert engine.delete_where('movie_versions', 'video_base_id', str(movie_id)) == 2
+    assert len(engine.find('movie_versions', search={'disc_type': 'DVD'})) == 1
+
+
+def test_unique_fields(engine):
+    """Unique fields reject duplicates on insert and update, and are freed by deletes."""
+    user_id = engine.insert('users', {'username': 'joe', 'email': 'joe@example.com'})
+    other_id = engine.insert('users', {'username': 'ann', 'email': 'ann@example.com'})
+
+    with pytest.raises(DuplicateKeyError):
+        engine.insert('users', {'username': 'bob', 'email': 'joe@example.com'})
+    with pytest.raises(DuplicateKeyError):
+        engine.update('users', other_id, {'username': 'joe'})
+    assert engine.get('users', other_id)['username'] == 'ann'
+    # Updating a document to its own values isn't a duplicate.
+    engine.update('users', user_id, {'username': 'joe', 'email': 'joe@example.org'})
+    engine.delete('users', user_id)
+    engine.insert('users', {'username': 'joe', 'email': 'joe@example.com'})
+
+
+def test_expired_documents_are_dropped(engine):
+    """Revocations are dropped once they expire, like with the Mongo TTL index."""
+    now = datetime.utcnow().replace(microsecond=0)
+    engine.insert('revocations', {'jti': 'old', 'expires': now - timedelta(seconds=1),
+                                  'revoked_at': now - timedelta(hours=2)})
+    engine.insert('revocations', {'jti': 'new', 'expires': now + timedelta(hours=1),
+                                  'revoked_at': now - timedelta(hours=1)})
+
+    assert [revocation['jti'] for revocation in engine.find_since(
+        'revocations', 'revoked_at', None)] == ['new']
+    assert engine.find_since('revocations', 'revoked_at', now) == []
+
+
+def test_ids_after_goes_through_a_collection(engine):
+    """``ids_after`` gives the ids in order, in batches."""
+    movie_ids = sorted(engine.insert('movies', {'title': str(number)}) for number in range(5))
+
+    batches, after = [], None
+    while True:
+        batch = engine.ids_after('movies', after, 2)
+        if not batch:
+            break
+        batches.append(batch)
+        after = batch[-1]
+
+    assert batches == [movie_ids[:2], movie_ids[2:4], movie_ids[4:]]
+
+
+def test_snapshot_round_trip(tmp_path, engine):
+    """A snapshot loads back the same documents, with their indexes and unique fields."""
+    engine.insert('users', {'username': 'joe', 'email': 'joe@example.com',
+                            'metadata': {'date_created': datetime(2020, 5, 1, 12, 0, 0, 123000)}})
+    movie_id = engine.insert('movies', {'title': 'Alien', 'imdb_id': 'tt0078748'})
+    engine.insert('movie_versions', {'video_base_id': str(movie_id), 'disc_type': 'DVD'})
+    snapshot_file = tmp_path / 'fsubs.snapshot'
+
+    assert engine.save_snapshot(snapshot_file) == 3
+    loaded = MemoryEngine(snapshot_file=str(snapshot_file))
+
+    for collection in ('users', 'movies', 'movie_versions'):
+        assert loaded.find(collection) == engine.find(collection)
+    assert loaded.find('movie_versions', search={'disc_type': 'DVD'}, explain=True)[
+        'indexes'] == ['disc_type']
+    with pytest.raises(DuplicateKeyError):
+        loaded.insert('users', {'username': 'joe', 'email': 'other@example.com'})
+    assert not (tmp_path / 'fsubs.snapshot.tmp').exists()
+
+
+def test_mirror_looks_records_up_by_id(tmp_path, engine):
+    """A mirror finds titles and their children by either kind of id, and nothing else."""
+    movie_ids = [engine.insert('movies', {'title': title, 'imdb_id': title})
+                 for title in ('Heat', 'Alien', 'Brazil', 'Ran')]
+    version_id = engine.insert(
+        'movie_versions', {'video_base_id': str(movie_ids[1]), 'disc_type': 'DVD',
+                           'timestamps': []})
+    build_mirror(engine, tmp_path / 'catalog.fsubs', batch_size=3)
+    snapshot = MirrorSnapshot(tmp_path / 'catalog.fsubs')
+    try:
+        for movie_id in movie_ids:
+            for key in (movie_id, str(movie_id)):
+                movie = json.loads(bytes(snapshot.get('movies', key)))
+                assert movie['id'] == str(movie_id)
+                assert movie['title'] == engine.get('movies', movie_id)['title']
+        assert json.loads(bytes(snapshot.get('movie_versions', version_id)))['disc_type'] == 'DVD'
+        assert [version['id'] for version in json.loads(
+            bytes(snapshot.children('movies', movie_ids[1])))] == [str(version_id)]
+        assert snapshot.children('movies', movie_ids[0]) is None
+        assert snapshot.get('movies', ObjectId()) is None
+        assert snapshot.get('movies', 'not an id') is None
+        assert snapshot.get('movies', version_id) is None
+        assert [json.loads(bytes(movie))['title'] for movie in snapshot.titles(
+            'movies', sort_by='title')] == ['Alien', 'Brazil', 'Heat', 'Ran']
+    finally:
+        snapshot.close()
@@ -0,0 +1,109 @@
+"""Tests of the filtering, sorting and indexing of title listings."""
+
+import itertools
+
+import pytest
+
+from fsubs.crud.queries import (
+    FILTER_FIELDS, SORT_FIELDS, TITLE_INDEXES, VERSION_FILTER_FIELDS, VERSION_INDEXES,
+    title_pipeline)
+from fsubs.models.user import Access
+
+
+@pytest.mark.parametrize('sort_field', SORT_FIELDS.values())
+@pytest.mark.parametrize('filter_fields', [
+    set(filter_fields)
+    for count in range(len(FILTER_FIELDS) + 1)
+    for filter_fields in itertools.combinations(FILTER_FIELDS, count)])
+def test_every_filter_and_sort_has_an_index(filter_fields, sort_field):
+    """Every combination of filters and sort has an index with the filters then the sort."""
+    prefixes = set()
+    for index in TITLE_INDEXES:
+        keys = list(index.document['key'])
+        prefixes.add((frozenset(keys[:-2]), keys[-2]))
+    assert (frozenset(filter_fields), sort_field) in prefixes
+
+
+@pytest.mark.parametrize('filter_fields', [
+    set(filter_fields)
+    for count in range(len(VERSION_FILTER_FIELDS) + 1)
+    for filter_fields in itertools.combinations(VERSION_FILTER_FIELDS, count)])
+def test_every_version_filter_has_an_index(filter_fields):
+    """Every combination of version filters has an index with the title then the filters."""
+    assert ('video_base_id', frozenset(filter_fields)) in {
+        (keys[0], frozenset(keys[1:]))
+        for keys in (list(index.document['key']) for index in VERSION_INDEXES)}
+
+
+def test_title_pipeline_joins_one_child_per_title():
+    """The version filter is a join bounded by the page, not a list of every matching id."""
+    pipeline = title_pipeline(
+        {'no_subs': False}, ('movie_versions', {'disc_type': 'DVD'}), limit=10, skip=20,
+        sort_by='title', projection={'_id': True, 'title': True})
+
+    assert pipeline[0] == {'$match': {'no_subs': False}}
+    assert pipeline[1] == {'$sort': {'title': 1, '_id': 1}}
+    lookup = next(stage['$lookup'] for stage in pipeline if '$lookup' in stage)
+    assert lookup['from'] == 'movie_versions'
+    assert lookup['foreignField'] == 'video_base_id'
+    assert lookup['pipeline'][:2] == [{'$match': {'disc_type': 'DVD'}}, {'$limit': 1}]
+    assert pipeline[-3:] == [
+        {'$skip': 20}, {'$limit': 10}, {'$project': {'_id': True, 'title': True}}]
+    assert '$in' not in repr(pipeline)
+
+
+def test_memory_find_with_children(engine):
+    """Only titles with a matching child are read, in order and paginated after filtering."""
+    titles = {}
+    for title, disc_types in (('d', ['DVD']), ('a', ['BD', 'DVD']), ('c', []), ('b', ['DVD'])):
+        titles[title] = engine.insert('movies', {'title': title, 'no_subs': title != 'b'})
+        for disc_type in disc_types:
+            engine.insert(
+                'movie_versions', {'video_base_id': str(titles[title]), 'disc_type': disc_type})
+    children = ('movie_versions', {'disc_type': 'DVD'})
+
+    def found(**kwargs):
+        return [movie['title'] for movie in engine.find('movies', children=children, **kwargs)]
+
+    assert found() == ['d', 'a', 'b']
+    assert found(sort_by='title') == ['a', 'b', 'd']
+    assert found(sort_by='title', descending=True, skip=1, limit=1) == ['b']
+    assert found(search={'no_subs': True}, sort_by='title') == ['a', 'd']
+    assert [movie['title'] for movie in engine.find(
+        'movies', children=('movie_versions', {'disc_type': 'BD'}))] == ['a']
+    explain = engine.find('movies', children=children, sort_by='title', limit=1, explain=True)
+    assert explain['indexes'] == ['title_sort', 'video_base_id']
+    assert explain['execution_stats'] == {'nReturned': 1, 'totalDocsExamined': 1}
+
+
+def test_version_filters_through_the_api(client, login):
+    """GET /movies filters movies by their versions."""
+    headers = login('editor')
+    movie_ids = {}
+    for title, disc_type in (('Alien', 'DVD'), ('Brazil', 'BD'), ('Casablanca', None)):
+        movie_ids[title] = client.post(
+            '/movies', json={'title': title, 'imdb_id': title}, headers=headers).json()
+        if disc_type:
+            response = client.post(
+                f'/movies/{movie_ids[title]}/versions',
+                json={'disc_type': disc_type, 'timestamps': []}, headers=headers)
+            assert response.status_code == 201, response.text
+
+    response = client.get('/movies', params={'disc_type': 'DVD', 'sort': 'title'})
+
+    assert response.status_code == 200
+    assert [movie['id'] for movie in response.json()] == [movie_ids['Alien']]
+
+
+def test_explain_requires_admin(client, login):
+    """Only admins can get the query plan of a listing."""
+    basic = login('basic')
+    admin = login('admin', access=Access.admin)
+
+    assert client.get('/movies', params={'explain': True}).status_code == 401
+    assert client.get('/tv_shows', params={'explain': True}, headers=basic).status_code == 403
+    response = client.get('/movies', params={'explain': True, 'sort': 'title'}, headers=admin)
+    assert response.status_code == 200
+    assert response.json()['indexes'] == ['title_sort']
+    # Listings without explain stay open to anonymous users.
+    assert client.get('/movies').status_code == 200
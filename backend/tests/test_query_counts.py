@@ -0,0 +1,132 @@
+"""Tests pinning the number of database round trips each endpoint makes."""
+
+import asyncio
+
+import pytest
+
+from fsubs.crud.movie import MovieDAO
+from fsubs.models.user import Access
+from fsubs.utils.timing import assert_query_count, count_queries
+
+TIMESTAMPS = ['00:01:00 - 00:01:02.5']
+
+
+@pytest.fixture
+def catalog(client, login):
+    """Create two movies with a version and a tv show with an episode, returning their ids."""
+    headers = login('editor')
+    ids = {'headers': headers, 'power': login('power', access=Access.power)}
+    ids['movies'] = [
+        client.post('/movies', json={'title': title, 'imdb_id': title}, headers=headers).json()
+        for title in ('Alien', 'Brazil')]
+    ids['version'] = client.post(
+        f'/movies/{ids["movies"][0]}/versions',
+        json={'disc_type': 'DVD', 'timestamps': TIMESTAMPS}, headers=headers).json()
+    ids['tv_show'] = client.post(
+        '/tv_shows', json={'title': 'Dark', 'imdb_id': 'Dark'}, headers=headers).json()
+    ids['episode'] = client.post(
+        f'/tv_shows/{ids["tv_show"]}/episodes',
+        json={'title': 'Secrets', 'imdb_id': 'Secrets', 'season': 1, 'episode': 1},
+        headers=headers).json()
+    return ids
+
+
+@pytest.mark.parametrize('path, params, expected', [
+    ('/movies', {}, 1),
+    ('/movies', {'disc_type': 'DVD', 'sort': 'title'}, 1),
+    ('/tv_shows', {'no_subs': False}, 1),
+])
+def test_list_queries(client, catalog, path, params, expected):
+    """A page of titles is one round trip, even when filtered by their versions."""
+    response = client.get(path, params=params)
+
+    assert response.status_code == 200
+    assert_query_count(response, expected)
+
+
+def test_detail_queries(client, catalog):
+    """Reading a single document is one round trip, listing a title's children two at most."""
+    movie_id = catalog['movies'][0]
+    for path, expected in (
+            (f'/movies/{movie_id}', 1),
+            (f'/movies/versions/{catalog["version"]}', 1),
+            (f'/movies/{movie_id}/versions', 1),
+            (f'/tv_shows/{catalog["tv_show"]}', 1),
+            (f'/tv_shows/episodes/{catalog["episode"]}', 1),
+            # The tv show is read first to tell a missing show from one without episodes.
+            (f'/tv_shows/{catalog["tv_show"]}/episodes', 2)):
+        response = client.get(path)
+        assert response.status_code == 200, path
+        assert_query_count(response, expected)
+
+
+def test_batch_queries(client, catalog):
+    """Batch reads are one round trip whatever the number of ids."""
+    for path, ids in (
+            ('/movies', catalog['movies']),
+            ('/movies/versions', [catalog['version']] * 3),
+            ('/tv_shows/episodes', [catalog['episode']])):
+        response = client.get(path, params={'ids': ids})
+        assert response.status_code == 200, path
+        assert len(response.json()) == len(ids)
+        assert_query_count(response, 1)
+
+
+def test_write_queries(client, catalog):
+    """Writes make a fixed number of round trips, including keeping the stats up to date."""
+    headers, power = catalog['headers'], catalog['power']
+    movie_id, other_movie_id = catalog['movies']
+
+    response = client.post('/movies', json={'title': 'Heat', 'imdb_id': 'Heat'}, headers=headers)
+    assert response.status_code == 201
+    assert_query_count(response, 1)
+
+    # Read the movie, insert the version, update the movie's stats.
+    response = client.post(f'/movies/{other_movie_id}/versions',
+                           json={'disc_type': 'BD', 'timestamps': []}, headers=headers)
+    assert response.status_code == 201
+    assert_query_count(response, 3)
+
+    # Read the user, read the old version, update it, update the movie's stats.
+    response = client.put(
+        f'/movies/versions/{catalog["version"]}',
+        json={'video_base_id': movie_id, 'disc_type': 'BD', 'timestamps': []}, headers=headers)
+    assert response.status_code == 201
+    assert_query_count(response, 4)
+
+    # Read the user, read the old movie, update it.
+    response = client.put(
+        f'/movies/{movie_id}', json={'title': 'Aliens', 'imdb_id': 'Alien'}, headers=power)
+    assert response.status_code == 201
+    assert_query_count(response, 3)
+
+    # Read the user, read and delete the version, update the movie's stats.
+    response = client.delete(f'/movies/versions/{catalog["version"]}', headers=headers)
+    assert response.status_code == 204
+    assert_query_count(response, 4)
+
+    # Read the user, delete the episode, update the tv show's stats.
+    response = client.delete(f'/tv_shows/episodes/{catalog["episode"]}', headers=power)
+    assert response.status_code == 204
+    assert_query_count(response, 3)
+
+    # Read the user, delete the movie, delete its versions, reset its stats.
+    response = client.delete(f'/movies/{other_movie_id}', headers=power)
+    assert response.status_code == 204
+    assert_query_count(response, 4)
+
+
+def test_backfill_queries(engine):
+    """The backfill makes four round trips per batch of movies, whatever their versions."""
+    for number in range(5):
+        movie_id = engine.insert('movies', {'title': str(number), 'imdb_id': str(number)})
+        for _ in range(number):
+            engine.insert(
+                'movie_versions', {'video_base_id': str(movie_id), 'timestamps': TIMESTAMPS})
+
+    with count_queries() as stats:
+        processed = asyncio.run(MovieDAO(engine=engine).backfill_stats(batch_size=2))
+
+    assert processed == 5
+    # Three batches, then the read finding no more movies.
+    assert stats.queries == 3 * 4 + 1
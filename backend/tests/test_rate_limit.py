@@ -0,0 +1,26 @@
+"""Tests of building the rate limits from the config."""
+
+from configparser import ConfigParser
+
+from fsubs.utils.rate_limit import MemoryBackend, rate_limits_from_config
+
+
+def ratelimit_config(**values) -> ConfigParser:
+    """Get a config with only a ``[ratelimit]`` section."""
+    config = ConfigParser()
+    config.read_dict({'ratelimit': {
+        'backend': 'memory', 'max_keys': '10', 'list_page_size': '20',
+        **{f'{name}_{setting}': '0' for name in ('auth', 'list', 'read', 'write')
+           for setting in ('rate', 'burst')},
+        **values}})
+    return config
+
+
+def test_mongo_backend_without_mongo_falls_back_to_memory():
+    """Without a Mongo client, shared buckets are kept in memory rather than failing."""
+    rate_limits = rate_limits_from_config(
+        ratelimit_config(backend='mongo', read_rate='2', read_burst='5'), client=None)
+
+    assert isinstance(rate_limits['backend'], MemoryBackend)
+    assert list(rate_limits['limits']) == ['read']
+    assert rate_limits['limits']['read'].burst == 5
@@ -0,0 +1,14 @@
+"""Tests of running the uvicorn server."""
+
+import socket
+
+from fsubs.utils.server import ServerConfig
+
+
+def test_shared_socket_has_no_delay():
+    """The socket shared by the workers turns off Nagle's algorithm for the connections."""
+    sock = ServerConfig('fsubs.routers.main:app', host='127.0.0.1', port=0).bind_socket()
+    try:
+        assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+    finally:
+        sock.close()
@@ -0,0 +1,29 @@
+"""Tests of serving stale responses while the database is unavailable."""
+
+import time
+
+from fsubs.utils.breaker import BREAKER
+
+STALE = '110 - "Response is Stale"'
+
+
+def test_only_the_catalog_is_served_stale(client, login, monkeypatch):
+    """Catalog pages are served stale while the circuit is open, probes and metrics never are."""
+    client.post('/movies', json={'title': 'Alien', 'imdb_id': 'Alien'}, headers=login('editor'))
+    for path in ('/movies', '/health', '/ready', '/metrics'):
+        assert client.get(path).status_code == 200
+
+    monkeypatch.setattr(BREAKER, '_opened_at', time.monotonic())
+    client.app.state.ready = False
+
+    response = client.get('/movies')
+    assert response.status_code == 200
+    assert response.headers['warning'] == STALE
+    assert [movie['title'] for movie in response.json()] == ['Alien']
+    response = client.get('/ready')
+    assert response.status_code == 503
+    assert 'warning' not in response.headers
+    for path in ('/health', '/metrics'):
+        response = client.get(path)
+        assert response.status_code == 200
+        assert 'warning' not in response.headers, path
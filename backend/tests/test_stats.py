@@ -0,0 +1,126 @@
+"""Tests of the version statistics the DAOs keep on movies and tv shows."""
+
+import asyncio
+
+from fsubs.crud.movie import MovieDAO
+from fsubs.crud.stats import VERSION_STATS
+from fsubs.crud.tvshow import TVShowDAO
+
+TIMESTAMPS = ['00:01:00 - 00:01:02.5', '00:10:00 --> 00:10:01']
+
+
+def movie_stats(engine, movie_id) -> dict:
+    """Get the statistics of a movie."""
+    return engine.get('movies', movie_id, projection={field: True for field in VERSION_STATS})
+
+
+def test_create_and_delete_version(engine):
+    """Creating and deleting versions updates the stats of their movie."""
+    dao = MovieDAO(engine=engine)
+
+    async def scenario():
+        movie_id = await dao.create({'title': 'Heat', 'imdb_id': 'tt0113277'})
+        version_id = await dao.create_version(
+            {'video_base_id': str(movie_id), 'timestamps': TIMESTAMPS})
+        await dao.create_version({'video_base_id': str(movie_id), 'timestamps': []})
+        created = movie_stats(engine, movie_id)
+        await dao.delete_version(version_id)
+        return created, movie_stats(engine, movie_id)
+
+    created, deleted = asyncio.run(scenario())
+    assert created['version_count'] == 2
+    assert created['foreign_subs_version_count'] == 1
+    assert created['has_foreign_subs'] is True
+    assert created['cue_count'] == 2
+    assert created['subs_duration'] == 3.5
+    assert deleted['version_count'] == 1
+    assert deleted['has_foreign_subs'] is False
+    assert deleted['cue_count'] == 0
+    assert deleted['subs_duration'] == 0
+
+
+def test_moving_a_version_moves_its_stats(engine):
+    """Moving a version to another movie moves its stats along."""
+    dao = MovieDAO(engine=engine)
+
+    async def scenario():
+        old_movie_id = await dao.create({'title': 'Alien', 'imdb_id': 'tt0078748'})
+        new_movie_id = await dao.create({'title': 'Aliens', 'imdb_id': 'tt0090605'})
+        version_id = await dao.create_version(
+            {'video_base_id': str(old_movie_id), 'timestamps': TIMESTAMPS})
+        updated = await dao.update_version(
+            version_id, {'video_base_id': str(new_movie_id), 'timestamps': TIMESTAMPS[:1]})
+        return old_movie_id, new_movie_id, updated
+
+    old_movie_id, new_movie_id, updated = asyncio.run(scenario())
+    assert updated['video_base_id'] == str(new_movie_id)
+    old_stats = movie_stats(engine, old_movie_id)
+    assert old_stats['version_count'] == 0
+    assert old_stats['foreign_subs_version_count'] == 0
+    assert old_stats['has_foreign_subs'] is False
+    assert old_stats['cue_count'] == 0
+    assert old_stats['subs_duration'] == 0
+    new_stats = movie_stats(engine, new_movie_id)
+    assert new_stats['version_count'] == 1
+    assert new_stats['foreign_subs_version_count'] == 1
+    assert new_stats['has_foreign_subs'] is True
+    assert new_stats['cue_count'] == 1
+    assert new_stats['subs_duration'] == 2.5
+
+
+def test_movie_backfill_recomputes_from_timestamps(engine):
+    """The movie backfill computes the stats from the timestamps of the versions."""
+    movie_id = engine.insert('movies', {'title': 'Ran', 'imdb_id': 'tt0089881'})
+    version_id = engine.insert(
+        'movie_versions', {'video_base_id': str(movie_id), 'timestamps': TIMESTAMPS})
+
+    processed = asyncio.run(MovieDAO(engine=engine).backfill_stats(batch_size=1))
+
+    assert processed == 1
+    assert movie_stats(engine, movie_id) == {
+        '_id': movie_id,
+        'version_count': 1,
+        'foreign_subs_version_count': 1,
+        'has_foreign_subs': True,
+        'cue_count': 2,
+        'subs_duration': 3.5,
+    }
+    version = engine.get('movie_versions', version_id)
+    assert version['cue_count'] == 2
+    assert version['subs_duration'] == 3.5
+
+
+def test_tv_show_backfill_counts_episodes(engine):
+    """The tv show backfill counts the episodes of each show, and leaves the episodes alone."""
+    tv_show_id = engine.insert('tv_shows', {'title': 'Dark', 'imdb_id': 'tt5753856'})
+    other_tv_show_id = engine.insert(
+        'tv_shows', {'title': 'Lost', 'imdb_id': 'tt0411008', 'episode_count': 3})
+    for number in (1, 2):
+        engine.insert(
+            'tv_show_episodes', {'video_base_id': str(tv_show_id), 'season': 1, 'episode': number})
+    episodes_before = engine.find('tv_show_episodes')
+
+    processed = asyncio.run(TVShowDAO(engine=engine).backfill_stats(batch_size=1))
+
+    assert processed == 2
+    assert engine.get('tv_shows', tv_show_id)['episode_count'] == 2
+    assert engine.get('tv_shows', other_tv_show_id)['episode_count'] == 0
+    assert engine.find('tv_show_episodes') == episodes_before
+
+
+def test_tv_shows_have_no_version_stats(client, login):
+    """Episodes have no versions, so neither they nor their show claim to have foreign subs."""
+    headers = login('editor')
+    tv_show_id = client.post(
+        '/tv_shows', json={'title': 'Dark', 'imdb_id': 'tt5753856'}, headers=headers).json()
+    episode_id = client.post(
+        f'/tv_shows/{tv_show_id}/episodes',
+        json={'title': 'Secrets', 'imdb_id': 'tt5753859', 'season': 1, 'episode': 1},
+        headers=headers).json()
+
+    tv_show = client.get(f'/tv_shows/{tv_show_id}').json()
+    episode = client.get(f'/tv_shows/episodes/{episode_id}').json()
+
+    assert tv_show['episode_count'] == 1
+    for document in (tv_show, episode):
+        assert not set(VERSION_STATS) & set(document)
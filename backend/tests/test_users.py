@@ -0,0 +1,37 @@
+"""Tests of the user endpoints."""
+
+import asyncio
+
+from fsubs.crud.db import get_engine
+from fsubs.utils import users as user_utils
+
+
+def test_passwords_are_hashed_off_the_event_loop(client, login, monkeypatch):
+    """Creating, updating and patching users hash their password in the executor."""
+    hash_password = user_utils.hash_password
+    hashed_on_loop = []
+
+    def hash_and_record(password, *args, **kwargs):
+        """Hash a password, recording whether it's on the thread of the event loop."""
+        try:
+            asyncio.get_running_loop()
+            hashed_on_loop.append(True)
+        except RuntimeError:
+            hashed_on_loop.append(False)
+        return hash_password(password, *args, **kwargs)
+
+    monkeypatch.setattr(user_utils, 'hash_password', hash_and_record)
+    headers = login('alice')
+    user_id = get_engine().find_one('users', {'username': 'alice'})['_id']
+
+    response = client.put(f'/users/userid/{user_id}',
+                          json={'email': 'alice@example.org', 'password': 'password456'},
+                          headers=headers)
+    assert response.status_code == 201, response.text
+    response = client.patch(
+        f'/users/userid/{user_id}', json={'password': 'password789'}, headers=headers)
+    assert response.status_code == 201, response.text
+
+    assert hashed_on_loop == [False, False, False]
+    response = client.post('/authenticate', data={'username': 'alice', 'password': 'password789'})
+    assert response.status_code == 201
@@ -0,0 +1,103 @@
+"""Tests of warming up workers before they take traffic."""
+
+import signal
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+from pymongo.errors import OperationFailure, ServerSelectionTimeoutError
+
+from fsubs.config.config import Config
+from fsubs.crud.db import get_engine
+from fsubs.crud.memory import MemoryEngine
+from fsubs.routers import authenticate, main
+from fsubs.utils.auth import create_access_token, decode_access_token
+from fsubs.utils.revocation import RevocationList
+
+# Each attempt pings once per connection of the pool.
+CONNECTIONS = Config()["db"].getint("min_pool_size")
+
+
+@pytest.fixture
+def failing_engine(loop, monkeypatch):
+    """Get a memory engine whose pings raise the errors put in its ``errors`` list first."""
+    engine = MemoryEngine()
+    engine.errors = []
+    engine.pings = 0
+    ping = engine.ping
+
+    def failing_ping():
+        """Raise the next error, or ping if there are none left."""
+        engine.pings += 1
+        if engine.errors:
+            raise engine.errors.pop(0)
+        return ping()
+
+    monkeypatch.setattr(engine, 'ping', failing_ping)
+    monkeypatch.setattr(main, 'WARM_UP_RETRY_SECONDS', (0.01,))
+    get_engine()._engine = engine
+    return engine
+
+
+def wait_for(client: TestClient, path: str, status_code: int) -> dict:
+    """Poll an endpoint until it answers with a status code, returning the body."""
+    deadline = time.monotonic() + 5
+    while True:
+        response = client.get(path)
+        if response.status_code == status_code:
+            return response.json()
+        assert time.monotonic() < deadline, f'{path} never answered {status_code}.'
+        time.sleep(0.01)
+
+
+def test_retries_while_the_database_is_unreachable(failing_engine, monkeypatch):
+    """The worker gets ready once the database can be reached."""
+    failing_engine.errors = [ServerSelectionTimeoutError('No servers.')] * 2
+    kills = []
+    monkeypatch.setattr(main.os, 'kill', lambda *args: kills.append(args))
+
+    with TestClient(main.create_app()) as client:
+        assert wait_for(client, '/ready', 200)['status'] == 'ready'
+
+    # Both errors fail the first attempt.
+    assert failing_engine.pings == 2 * CONNECTIONS
+    assert kills == []
+
+
+def test_fails_on_other_errors(failing_engine, monkeypatch):
+    """The worker stops on errors that retrying won't fix, like bad credentials."""
+    failing_engine.errors = [OperationFailure('Authentication failed.', code=18)]
+    kills = []
+    monkeypatch.setattr(main.os, 'kill', lambda *args: kills.append(args))
+
+    with TestClient(main.create_app()) as client:
+        assert wait_for(client, '/health', 503) == {'status': 'failed'}
+        assert client.get('/ready').json() == {'status': 'failed'}
+
+    assert failing_engine.pings == CONNECTIONS
+    assert kills == [(main.os.getpid(), signal.SIGTERM)]
+
+
+def test_rejects_tokens_until_the_revocations_are_loaded(failing_engine, loop, monkeypatch):
+    """Tokens get a 503 while warming up, since they may have been revoked."""
+    failing_engine.errors = [ServerSelectionTimeoutError('No servers.')] * 10 ** 6
+    revocations = RevocationList()
+    monkeypatch.setattr(main, 'REVOCATIONS', revocations)
+    monkeypatch.setattr(authenticate, 'REVOCATIONS', revocations)
+
+    with TestClient(main.create_app()) as client:
+        token = create_access_token(data={'identity': 'joe', 'tv': 0}).decode()
+        loop.run_until_complete(authenticate.REVOCATION_DAO.revoke_token(
+            jti=decode_access_token(token)['jti'], identity='joe',
+            expires=datetime.utcnow() + timedelta(hours=1)))
+        headers = {'Authorization': f'Bearer {token}'}
+
+        response = client.get('/authenticate', headers=headers)
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '5'
+        assert client.get('/ready').status_code == 503
+
+        failing_engine.errors.clear()
+        wait_for(client, '/ready', 200)
+        assert client.get('/authenticate', headers=headers).status_code == 401